@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Streaming Grouped Aggregation of Index Results
+
+Summarizes scored batches per group (e.g. LabelName, an info field of the
+export or source_file) and index without keeping the per-sample rows:
+
+- count, mean, standard deviation, min and max from running moments, updated
+  per batch with the parallel form of Welford's algorithm (Chan et al.)
+- quantiles from a DDSketch per group and index: values are counted in
+  logarithmic buckets, so every quantile is within the relative accuracy
+  (default 0.5%) of a value of the requested rank
+
+Both states are mergeable: workers aggregate their files (or parts of
+files) and the parent merges the partial aggregates, giving the same counts,
+sketches and (up to rounding) moments as a single pass. NaN and infinite
+values are counted as missing and left out of the statistics.
+
+score_exports.py --aggregate-by writes the summary instead of the sample
+table; this script aggregates an existing index table the same way.
+
+Usage: python aggregation.py <indices.csv | .parquet | .arrow> <summary.csv> --by LabelName [--quantiles 0.05,0.5,0.95]
+
+Requirements: pip install numpy (Parquet/Arrow files additionally need pyarrow)
+"""
+
+import argparse
+import math
+import sys
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+
+from table_writers import iter_arrow_batches, open_table_writer
+
+
+DEFAULT_RELATIVE_ACCURACY = 0.005
+DEFAULT_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+# Values closer to zero than this are counted as zero by the sketches
+ZERO_THRESHOLD = 1e-12
+SUMMARY_COLUMNS = ['count', 'missing', 'mean', 'std', 'min', 'max']
+
+
+class QuantileSketch:
+    """DDSketch: counts of values in logarithmic buckets with a relative accuracy guarantee."""
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        # Dense bucket counts of positive and negative values: (offset, counts)
+        self._stores = {1: (0, np.zeros(0, np.int64)), -1: (0, np.zeros(0, np.int64))}
+        self.zero_count = 0
+
+    @property
+    def count(self) -> int:
+        return int(self.zero_count + sum(counts.sum() for _, counts in self._stores.values()))
+
+    def _add_keys(self, sign: int, keys: np.ndarray, counts: Optional[np.ndarray] = None):
+        if len(keys) == 0:
+            return
+        offset, store = self._stores[sign]
+        low = int(keys.min())
+        high = int(keys.max())
+        if len(store) == 0:
+            offset = low
+            store = np.zeros(high - low + 1, np.int64)
+        elif low < offset or high >= offset + len(store):
+            new_offset = min(low, offset)
+            grown = np.zeros(max(high, offset + len(store) - 1) - new_offset + 1, np.int64)
+            grown[offset - new_offset:offset - new_offset + len(store)] = store
+            offset, store = new_offset, grown
+        store += np.bincount(keys - offset, weights=counts, minlength=len(store)).astype(np.int64)
+        self._stores[sign] = (offset, store)
+
+    def add(self, values: np.ndarray):
+        """Add finite values."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        magnitude = np.abs(values)
+        nonzero = magnitude > ZERO_THRESHOLD
+        self.zero_count += int(len(values) - nonzero.sum())
+        keys = np.ceil(np.log(magnitude[nonzero]) / self._log_gamma).astype(np.int64)
+        positive = values[nonzero] > 0
+        self._add_keys(1, keys[positive])
+        self._add_keys(-1, keys[~positive])
+
+    def merge(self, other: 'QuantileSketch'):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches of different relative accuracy")
+        self.zero_count += other.zero_count
+        for sign, (offset, store) in other._stores.items():
+            used = np.flatnonzero(store)
+            self._add_keys(sign, used + offset, store[used])
+
+    def _value(self, keys: np.ndarray) -> np.ndarray:
+        return 2.0 * np.exp(keys * self._log_gamma) / (self.gamma + 1)
+
+    def quantiles(self, quantiles: Sequence[float]) -> np.ndarray:
+        """Estimated value at each quantile (NaN for an empty sketch)."""
+        negative_offset, negative = self._stores[-1]
+        positive_offset, positive = self._stores[1]
+        # Bucket values in ascending order: large negative magnitudes first
+        values = np.concatenate([-self._value(negative_offset + np.arange(len(negative)))[::-1], [0.0],
+                                 self._value(positive_offset + np.arange(len(positive)))])
+        counts = np.concatenate([negative[::-1], [self.zero_count], positive])
+        total = counts.sum()
+        if total == 0:
+            return np.full(len(quantiles), np.nan)
+        cumulative = np.cumsum(counts)
+        ranks = np.clip(np.asarray(quantiles, dtype=np.float64), 0, 1) * (total - 1)
+        return values[np.searchsorted(cumulative, ranks, side='right')]
+
+
+class GroupState:
+    """Running moments (all indices at once) and lazily created sketches of one group."""
+
+    def __init__(self, n_indices: int):
+        self.count = np.zeros(n_indices, np.int64)
+        self.missing = np.zeros(n_indices, np.int64)
+        self.mean = np.zeros(n_indices)
+        self.m2 = np.zeros(n_indices)
+        self.min = np.full(n_indices, np.inf)
+        self.max = np.full(n_indices, -np.inf)
+        self.sketches: Dict[int, QuantileSketch] = {}
+
+    def combine_moments(self, count: np.ndarray, mean: np.ndarray, m2: np.ndarray):
+        """Merge the moments of another set of values into the running ones (Chan et al.)."""
+        total = self.count + count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = mean - self.mean
+            share = np.where(total > 0, count / total, 0.0)
+            self.mean = np.where(count > 0, self.mean + delta * share, self.mean)
+            self.m2 = np.where(count > 0, self.m2 + m2 + delta * delta * self.count * share, self.m2)
+        self.count = total
+
+
+class GroupedAggregator:
+    """Per-group, per-index moments and quantile sketches of scored batches."""
+
+    def __init__(self, index_names: Sequence[str], group_columns: Sequence[str],
+                 relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY):
+        self.index_names = list(index_names)
+        self.group_columns = list(group_columns)
+        self.relative_accuracy = relative_accuracy
+        self._positions = {name: k for k, name in enumerate(self.index_names)}
+        self.groups: Dict[Tuple, GroupState] = {}
+        # Rows aggregated, including merged aggregates
+        self.n_rows = 0
+
+    def _group_rows(self, meta: Mapping[str, Sequence], n_rows: int) -> Dict[Tuple, np.ndarray]:
+        columns = [[None] * n_rows if meta.get(name) is None else meta[name] for name in self.group_columns]
+        rows: Dict[Tuple, List[int]] = {}
+        for row, key in enumerate(zip(*columns) if columns else [()] * n_rows):
+            rows.setdefault(key, []).append(row)
+        return {key: np.asarray(positions, dtype=np.intp) for key, positions in rows.items()}
+
+    def update(self, meta: Mapping[str, Sequence], scores: Mapping[str, np.ndarray], n_rows: int):
+        """Add one scored batch: metadata columns and {index: values} with n_rows rows each."""
+        if n_rows == 0:
+            return
+        self.n_rows += n_rows
+        names = [name for name in scores if name in self._positions]
+        positions = np.asarray([self._positions[name] for name in names], dtype=np.intp)
+        matrix = np.column_stack([np.asarray(scores[name], dtype=np.float64) for name in names]) if names \
+            else np.zeros((n_rows, 0))
+        for key, rows in self._group_rows(meta, n_rows).items():
+            state = self.groups.get(key)
+            if state is None:
+                state = self.groups[key] = GroupState(len(self.index_names))
+            # Indices absent from the batch (not computable for its sensor) are missing
+            state.missing += len(rows)
+            values = matrix[rows]
+            finite = np.isfinite(values)
+            count = finite.sum(axis=0)
+            state.missing[positions] -= count
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.where(finite, values, 0.0).sum(axis=0) / np.maximum(count, 1)
+                m2 = (np.where(finite, values - mean, 0.0) ** 2).sum(axis=0)
+            full_count = np.zeros(len(self.index_names), np.int64)
+            full_mean = np.zeros(len(self.index_names))
+            full_m2 = np.zeros(len(self.index_names))
+            full_count[positions] = count
+            full_mean[positions] = mean
+            full_m2[positions] = m2
+            state.combine_moments(full_count, full_mean, full_m2)
+            state.min[positions] = np.minimum(state.min[positions], np.where(finite, values, np.inf).min(axis=0))
+            state.max[positions] = np.maximum(state.max[positions], np.where(finite, values, -np.inf).max(axis=0))
+            for j in np.flatnonzero(count):
+                k = int(positions[j])
+                sketch = state.sketches.get(k)
+                if sketch is None:
+                    sketch = state.sketches[k] = QuantileSketch(self.relative_accuracy)
+                sketch.add(values[finite[:, j], j])
+
+    def merge(self, other: 'GroupedAggregator'):
+        """Merge the partial aggregate of another worker (same indices and group columns)."""
+        if other.index_names != self.index_names or other.group_columns != self.group_columns:
+            raise ValueError("Cannot merge aggregates of different indices or group columns")
+        self.n_rows += other.n_rows
+        for key, theirs in other.groups.items():
+            state = self.groups.get(key)
+            if state is None:
+                self.groups[key] = theirs
+                continue
+            state.combine_moments(theirs.count, theirs.mean, theirs.m2)
+            state.missing += theirs.missing
+            state.min = np.minimum(state.min, theirs.min)
+            state.max = np.maximum(state.max, theirs.max)
+            for k, sketch in theirs.sketches.items():
+                if k in state.sketches:
+                    state.sketches[k].merge(sketch)
+                else:
+                    state.sketches[k] = sketch
+
+    def summary(self, quantiles: Sequence[float] = DEFAULT_QUANTILES) -> Tuple[Dict[str, List], np.ndarray]:
+        """(group and index columns, value matrix) with one row per group and index with values.
+
+        Value columns are SUMMARY_COLUMNS followed by the quantiles; std is the
+        sample standard deviation (NaN for fewer than two values), like R's sd().
+        """
+        meta: Dict[str, List] = {name: [] for name in self.group_columns + ['index']}
+        rows = []
+        for key, state in self.groups.items():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                std = np.where(state.count > 1, np.sqrt(state.m2 / (state.count - 1)), np.nan)
+            for k in np.flatnonzero(state.count):
+                for name, value in zip(self.group_columns, key):
+                    meta[name].append(value)
+                meta['index'].append(self.index_names[k])
+                estimates = np.clip(state.sketches[k].quantiles(quantiles), state.min[k], state.max[k])
+                rows.append(np.concatenate([[state.count[k], state.missing[k], state.mean[k], std[k],
+                                             state.min[k], state.max[k]], estimates]))
+        matrix = np.asarray(rows, dtype=np.float64).reshape(len(rows), len(SUMMARY_COLUMNS) + len(quantiles))
+        return meta, matrix
+
+    def write(self, output_file: Path, quantiles: Sequence[float] = DEFAULT_QUANTILES) -> int:
+        """Write the summary table (.csv, .parquet or .arrow), returning the number of rows."""
+        meta, matrix = self.summary(quantiles)
+        value_columns = SUMMARY_COLUMNS + [quantile_column(q) for q in quantiles]
+        with open_table_writer(output_file, value_columns, list(meta)) as writer:
+            writer.write_batch(matrix, meta)
+        return matrix.shape[0]
+
+
+def quantile_column(quantile: float) -> str:
+    return f"q{quantile:g}"
+
+
+def parse_quantiles(text: str) -> List[float]:
+    quantiles = [float(value) for value in text.split(',') if value.strip()]
+    if any(not 0 <= q <= 1 for q in quantiles):
+        raise ValueError("Quantiles must be between 0 and 1")
+    return quantiles
+
+
+def aggregate_table(input_file: Path, group_columns: Sequence[str], meta_columns: Sequence[str] = ('uuid', 'filename'),
+                    relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY) -> GroupedAggregator:
+    """Aggregate an index table written by score_exports.py batch by batch.
+
+    Every column besides source_file, sample, `meta_columns` and
+    `group_columns` is taken as an index.
+    """
+    non_index = {'source_file', 'sample'} | set(meta_columns) | set(group_columns)
+    if Path(input_file).suffix.lower() == '.csv':
+        import csv
+        with open(input_file, 'r', encoding='utf-8', newline='') as f:
+            sample = f.readline()
+            f.seek(0)
+            reader = csv.reader(f, delimiter=';' if sample.count(';') > sample.count(',') else ',')
+            header = next(reader)
+            index_names = [name for name in header if name not in non_index]
+            aggregator = GroupedAggregator(index_names, group_columns, relative_accuracy)
+            rows = []
+            for row in reader:
+                rows.append(row)
+                if len(rows) == 4096:
+                    _update_from_rows(aggregator, header, rows)
+                    rows = []
+            _update_from_rows(aggregator, header, rows)
+        return aggregator
+    names, batches = iter_arrow_batches(input_file, 4096)
+    index_names = [name for name in names if name not in non_index]
+    aggregator = GroupedAggregator(index_names, group_columns, relative_accuracy)
+    for batch in batches:
+        meta = {name: batch.column(name).to_pylist() if name in names else None for name in group_columns}
+        # Nulls become NaN
+        scores = {name: batch.column(name).to_numpy(zero_copy_only=False) for name in index_names}
+        aggregator.update(meta, scores, batch.num_rows)
+    return aggregator
+
+
+def _update_from_rows(aggregator: GroupedAggregator, header: List[str], rows: List[List[str]]):
+    if not rows:
+        return
+    columns = dict(zip(header, zip(*rows)))
+    meta = {name: [None if value == 'NA' else value for value in columns[name]] if name in columns else None
+            for name in aggregator.group_columns}
+    scores = {}
+    for name in aggregator.index_names:
+        text = np.asarray(columns[name], dtype=object)
+        text[(text == 'NA') | (text == '')] = 'nan'
+        scores[name] = text.astype(np.float64)
+    aggregator.update(meta, scores, len(rows))
+
+
+def main():
+    """Aggregate an existing index table per group."""
+    if len(sys.argv) < 3:
+        print("Usage: python aggregation.py <indices.csv | .parquet | .arrow> <summary.csv> --by LabelName "
+              "[--quantiles 0.05,0.5,0.95]")
+        print("\nExample: python aggregation.py indices.parquet summary.csv --by source_file,LabelName")
+        print("\nRequirements:")
+        print("  pip install numpy (Parquet/Arrow files additionally need pyarrow)")
+        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Aggregate an index table per group.")
+    parser.add_argument('input', type=Path, help="Index table written by score_exports.py")
+    parser.add_argument('output', type=Path, help="Summary table (.csv, .parquet or .arrow)")
+    parser.add_argument('--by', required=True, help="Comma-separated group columns")
+    parser.add_argument('--meta-columns', default='uuid,filename',
+                        help="Comma-separated metadata columns of the table that are not indices (default: uuid,filename)")
+    parser.add_argument('--quantiles', default=','.join(f"{q:g}" for q in DEFAULT_QUANTILES),
+                        help="Comma-separated quantiles (default: 0.05,0.25,0.5,0.75,0.95)")
+    parser.add_argument('--accuracy', type=float, default=DEFAULT_RELATIVE_ACCURACY,
+                        help=f"Relative accuracy of the quantiles (default: {DEFAULT_RELATIVE_ACCURACY})")
+    args = parser.parse_args()
+    group_columns = [name.strip() for name in args.by.split(',') if name.strip()]
+    meta_columns = [name.strip() for name in args.meta_columns.split(',') if name.strip()]
+    try:
+        quantiles = parse_quantiles(args.quantiles)
+        aggregator = aggregate_table(args.input, group_columns, meta_columns, args.accuracy)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    n_rows = aggregator.write(args.output, quantiles)
+    print(f"✅ {len(aggregator.groups)} groups, {n_rows} summary rows")
+    print(f"📊 Summary saved to: {args.output.absolute()}")
+
+
+if __name__ == "__main__":
+    main()
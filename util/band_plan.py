@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+Band Resolution Planner
+
+This module resolves the <Wavelengths><Band> definitions of all compiled
+spectral indices against a sensor wavelength/FWHM grid once, producing a
+compact integer gather table. Band values for the whole catalogue are then
+obtained from a reflectance batch with a single fancy-indexing operation,
+following the band selection rules of the R calculate_index() function:
+
+- a channel matches a band if (wl + fwhm/2) >= min and (wl - fwhm/2) <= max
+- "min-distance" picks the matching channel closest to the band center
+- "min-reflectance" picks the matching channel with the lowest reflectance
+  per sample (vectorized argmin over the band window)
+- "weighted" integrates all matching channels, weighted by the mean of their
+  Gaussian response (from the FWHM) over the band range and normalized to
+  sum 1; a band matching a single channel is that channel
+- an index is NA if any band has no matching channel, or if two of its bands
+  resolve to the same channel (for "weighted": the same channel weights)
+
+The weights of all multi-channel "weighted" bands form one sparse
+(n_channels, n_weighted_bands) matrix per grid, so their values for a batch
+come from a single sparse product (BandWeights).
+
+Usage: python band_plan.py <path_to_xml_folder> <sensor_json>
+
+Requirements: pip install numpy
+"""
+
+import json
+import math
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from index_engine import CompiledIndex, SpectralIndexEngine
+
+
+def _first_field(sensor_info: Dict, field_names: Sequence[str]):
+    """Return the first non-empty field of a sensor metadata record."""
+    for field_name in field_names:
+        value = sensor_info.get(field_name)
+        if value is not None:
+            return value
+    return None
+
+
+def gaussian_band_weights(band_min: float, band_max: float, wavelengths: np.ndarray,
+                          fwhm: Optional[np.ndarray]) -> np.ndarray:
+    """Normalized weights of channels for a band range: mean Gaussian response over the range.
+
+    A point band (min == max) takes the response at its wavelength; without a
+    FWHM every channel weighs the same.
+    """
+    if fwhm is None:
+        return np.full(len(wavelengths), 1.0 / len(wavelengths))
+    weights = np.empty(len(wavelengths))
+    for k, (wavelength, width) in enumerate(zip(wavelengths, fwhm)):
+        sigma = width / (2.0 * math.sqrt(2.0 * math.log(2.0)))
+        if sigma <= 0:
+            # Infinitely narrow response: inside the range or not
+            weights[k] = 1.0 if band_min <= wavelength <= band_max else 0.0
+        elif band_max > band_min:
+            scale = sigma * math.sqrt(2.0)
+            covered = 0.5 * (math.erf((band_max - wavelength) / scale) - math.erf((band_min - wavelength) / scale))
+            weights[k] = covered * sigma * math.sqrt(2.0 * math.pi) / (band_max - band_min)
+        else:
+            weights[k] = math.exp(-0.5 * ((band_min - wavelength) / sigma) ** 2)
+    total = weights.sum()
+    if not total > 0:
+        return np.full(len(wavelengths), 1.0 / len(wavelengths))
+    return weights / total
+
+
+class BandWeights:
+    """Sparse (n_channels, n_columns) band weight matrix in compressed column layout."""
+
+    def __init__(self, n_channels: int, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray):
+        self.n_channels = n_channels
+        # Column k holds channels indices[indptr[k]:indptr[k + 1]] with weights data[...]
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    @classmethod
+    def from_columns(cls, n_channels: int, columns: Sequence[Tuple[np.ndarray, np.ndarray]]) -> 'BandWeights':
+        """Build the matrix from (channels, weights) pairs, one per column."""
+        indptr = np.zeros(len(columns) + 1, dtype=np.intp)
+        indptr[1:] = np.cumsum([len(channels) for channels, _ in columns])
+        indices = np.concatenate([channels for channels, _ in columns]).astype(np.intp) if columns \
+            else np.zeros(0, np.intp)
+        data = np.concatenate([weights for _, weights in columns]) if columns else np.zeros(0)
+        return cls(n_channels, indptr, indices, data)
+
+    @property
+    def n_columns(self) -> int:
+        return len(self.indptr) - 1
+
+    def column(self, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self.indices[self.indptr[k]:self.indptr[k + 1]], self.data[self.indptr[k]:self.indptr[k + 1]]
+
+    def columns(self, keep: Sequence[int]) -> 'BandWeights':
+        return BandWeights.from_columns(self.n_channels, [self.column(k) for k in keep])
+
+    def apply(self, reflectance: np.ndarray) -> np.ndarray:
+        """(n_samples, n_columns) = reflectance @ weights; NaN in any weighted channel gives NaN.
+
+        Sums run in channel order per column, so a column has the same value
+        whichever other columns the matrix holds.
+        """
+        n_samples = reflectance.shape[0]
+        result = np.empty((self.n_columns, n_samples), dtype=reflectance.dtype)
+        if self.n_columns == 0:
+            return result.T
+        data = self.data.astype(reflectance.dtype, copy=False)
+        # Channel-major copy, so that every channel is one contiguous row
+        channels_first = np.ascontiguousarray(reflectance.T)
+        term = np.empty(n_samples, dtype=reflectance.dtype)
+        for k in range(self.n_columns):
+            start, stop = self.indptr[k], self.indptr[k + 1]
+            column = result[k]
+            np.multiply(channels_first[self.indices[start]], data[start], out=column)
+            for position in range(start + 1, stop):
+                np.multiply(channels_first[self.indices[position]], data[position], out=term)
+                column += term
+        return result.T
+
+    def to_dense(self) -> np.ndarray:
+        dense = np.zeros((self.n_channels, self.n_columns))
+        for k in range(self.n_columns):
+            channels, weights = self.column(k)
+            dense[channels, k] = weights
+        return dense
+
+
+class BandPlan:
+    """Precomputed band-to-channel gather table for one wavelength grid."""
+
+    def __init__(self, wavelengths: np.ndarray, fwhm: Optional[np.ndarray], index_names: List[str],
+                 index_columns: Dict[str, np.ndarray], band_keys: List[Tuple[str, str]],
+                 gather: np.ndarray, missing: np.ndarray, dynamic_bands: np.ndarray,
+                 dynamic_windows: np.ndarray, static_invalid: np.ndarray, dynamic_indices: np.ndarray,
+                 weighted_bands: Optional[np.ndarray] = None, band_weights: Optional[BandWeights] = None):
+        self.wavelengths = wavelengths
+        self.fwhm = fwhm
+        self.index_names = index_names
+        # Column positions of each index's bands in the gathered matrix
+        self.index_columns = index_columns
+        # (index name, band name) for every gathered column
+        self.band_keys = band_keys
+        # Channel per gathered column, -1 where the band is missing
+        self.gather = gather
+        self.missing = missing
+        # Columns resolved per sample ("min-reflectance") and their channel windows
+        self.dynamic_bands = dynamic_bands
+        self.dynamic_windows = dynamic_windows
+        # Per-index NA mask known from the grid alone (missing or duplicate bands)
+        self.static_invalid = static_invalid
+        # Indices whose duplicate check depends on per-sample selections
+        self.dynamic_indices = dynamic_indices
+        # Columns integrating several channels ("weighted") and their weight matrix columns
+        self.weighted_bands = np.zeros(0, np.intp) if weighted_bands is None else weighted_bands
+        self.band_weights = BandWeights.from_columns(len(wavelengths), []) if band_weights is None else band_weights
+        self._pruned = None
+        self._subsets: Dict[frozenset, 'BandPlan'] = {}
+
+    @property
+    def n_channels(self) -> int:
+        return len(self.wavelengths)
+
+    def computable_indices(self) -> List[str]:
+        """Names of indices that are not NA by construction on this grid."""
+        return [name for name, invalid in zip(self.index_names, self.static_invalid) if not invalid]
+
+    def pruned(self) -> 'BandPlan':
+        """Plan restricted to the computable indices, so their band values alone are gathered."""
+        if self._pruned is None:
+            if not self.static_invalid.any():
+                self._pruned = self
+            else:
+                self._pruned = self.subset([name for name, invalid in zip(self.index_names, self.static_invalid)
+                                            if not invalid])
+        return self._pruned
+
+    def subset(self, index_names: Sequence[str]) -> 'BandPlan':
+        """Plan gathering only the bands of `index_names` (cached per set of names)."""
+        key = frozenset(index_names)
+        plan = self._subsets.get(key)
+        if plan is not None:
+            return plan
+        keep = [name for name in self.index_names if name in key]
+        positions = {name: k for k, name in enumerate(self.index_names)}
+        columns = np.concatenate([self.index_columns[name] for name in keep]) if keep else np.zeros(0, np.intp)
+        position = np.full(len(self.gather), -1, dtype=np.intp)
+        position[columns] = np.arange(len(columns))
+        dynamic = [k for k, column in enumerate(self.dynamic_bands) if position[column] >= 0]
+        weighted = [k for k, column in enumerate(self.weighted_bands) if position[column] >= 0]
+        kept = {name: k for k, name in enumerate(keep)}
+        plan = self._subsets[key] = BandPlan(
+            wavelengths=self.wavelengths,
+            fwhm=self.fwhm,
+            index_names=keep,
+            index_columns={name: position[self.index_columns[name]] for name in keep},
+            band_keys=[self.band_keys[column] for column in columns],
+            gather=self.gather[columns],
+            missing=self.missing[columns],
+            dynamic_bands=position[self.dynamic_bands[dynamic]],
+            dynamic_windows=self.dynamic_windows[dynamic],
+            static_invalid=self.static_invalid[[positions[name] for name in keep]],
+            dynamic_indices=np.asarray([kept[self.index_names[k]] for k in self.dynamic_indices
+                                        if self.index_names[k] in kept], dtype=np.intp),
+            weighted_bands=position[self.weighted_bands[weighted]],
+            band_weights=self.band_weights.columns(weighted),
+        )
+        return plan
+
+    def select_channels(self, reflectance: np.ndarray) -> np.ndarray:
+        """Return the selected channel of every gathered column per sample (-1 if missing).
+
+        Multi-channel "weighted" columns get distinct codes below -1, so that
+        they never equal another column in the duplicate check.
+        """
+        n_samples = reflectance.shape[0]
+        selected = np.broadcast_to(self.gather, (n_samples, len(self.gather)))
+        if len(self.dynamic_bands) == 0 and len(self.weighted_bands) == 0:
+            return selected
+        selected = selected.copy()
+        for column, window in zip(self.dynamic_bands, self.dynamic_windows):
+            selected[:, column] = self.select_in_window(reflectance, window)
+        selected[:, self.weighted_bands] = -2 - np.arange(len(self.weighted_bands))
+        return selected
+
+    def select_in_window(self, reflectance: np.ndarray, window: np.ndarray) -> np.ndarray:
+        """Channel with the lowest non-NaN reflectance inside a window per sample (-1 if none)."""
+        valid = window & ~np.isnan(reflectance)
+        masked = np.where(valid, reflectance, np.inf)
+        best = masked.argmin(axis=1)
+        has_valid = valid.any(axis=1)
+        # argmin lands outside the window only if every candidate is +inf
+        outside = ~valid[np.arange(reflectance.shape[0]), best] & has_valid
+        best[outside] = valid[outside].argmax(axis=1)
+        return np.where(has_valid, best, -1)
+
+    def gather_values(self, reflectance, dtype=np.float64) -> Tuple[np.ndarray, np.ndarray]:
+        """Gather all catalogue band values from an (n_samples, n_channels) batch.
+
+        Returns the (n_samples, n_columns) band value matrix (NaN for missing
+        bands) in `dtype` together with the selected channel matrix.
+        """
+        reflectance = np.asarray(reflectance, dtype=dtype)
+        if reflectance.ndim == 1:
+            reflectance = reflectance.reshape(1, -1)
+        if reflectance.shape[1] != self.n_channels:
+            raise ValueError(f"Reflectance has {reflectance.shape[1]} channels, plan expects {self.n_channels}")
+        selected = self.select_channels(reflectance)
+        if len(self.dynamic_bands) == 0:
+            values = reflectance[:, np.where(self.missing, 0, self.gather)]
+            values[:, self.missing] = np.nan
+        else:
+            rows = np.arange(reflectance.shape[0])[:, None]
+            values = reflectance[rows, np.maximum(selected, 0)]
+            values[selected < 0] = np.nan
+        if len(self.weighted_bands):
+            values[:, self.weighted_bands] = self.band_weights.apply(reflectance)
+        return values, selected
+
+    def invalid_mask(self, values: np.ndarray, selected: np.ndarray) -> np.ndarray:
+        """Per-sample, per-index NA mask (n_samples, n_indices) for gathered values."""
+        n_samples = values.shape[0]
+        invalid = np.broadcast_to(self.static_invalid, (n_samples, len(self.index_names))).copy()
+        nan_values = np.isnan(values)
+        for k, name in enumerate(self.index_names):
+            columns = self.index_columns[name]
+            if len(columns) > 0:
+                invalid[:, k] |= nan_values[:, columns].any(axis=1)
+        for k in self.dynamic_indices:
+            columns = self.index_columns[self.index_names[k]]
+            chosen = selected[:, columns]
+            for a in range(len(columns)):
+                for b in range(a + 1, len(columns)):
+                    invalid[:, k] |= chosen[:, a] == chosen[:, b]
+        return invalid
+
+
+class BandPlanner:
+    """Builds and caches BandPlans for the indices of a SpectralIndexEngine."""
+
+    def __init__(self, indices: Sequence[CompiledIndex]):
+        self.indices = list(indices)
+        self._cache: Dict[Tuple, BandPlan] = {}
+
+    def _channel_window(self, band: Dict, wavelengths: np.ndarray, margin: np.ndarray) -> np.ndarray:
+        return ((wavelengths + margin) >= band['min']) & ((wavelengths - margin) <= band['max'])
+
+    def plan(self, wavelengths, fwhm=None) -> BandPlan:
+        """Return the (cached) BandPlan for a wavelength grid and optional FWHM per channel."""
+        wavelengths = np.asarray(wavelengths, dtype=np.float64).ravel()
+        if fwhm is not None:
+            fwhm = np.asarray(fwhm, dtype=np.float64).ravel()
+            if len(fwhm) != len(wavelengths):
+                raise ValueError("`fwhm` must be a numeric vector of the same length as `wavelengths`.")
+        key = (wavelengths.tobytes(), None if fwhm is None else fwhm.tobytes())
+        plan = self._cache.get(key)
+        if plan is None:
+            plan = self._build(wavelengths, fwhm)
+            self._cache[key] = plan
+        return plan
+
+    def plan_for_sensor(self, sensor_info: Dict) -> BandPlan:
+        """Return the BandPlan for a sensor metadata record.
+
+        Channel values are preferred over LED values and real values over
+        nominal ones; heads without a channel grid fall back to their LEDs.
+        """
+        wavelengths = _first_field(sensor_info, ('channel_wl_real', 'channel_wl_nom', 'led_wl_real', 'led_wl_nom'))
+        if wavelengths is None:
+            raise ValueError("Cannot load center wavelength from sensor metadata")
+        fwhm = _first_field(sensor_info, ('channel_fwhm_real', 'channel_fwhm_nom', 'led_fwhm_real', 'led_fwhm_nom'))
+        if fwhm is not None and len(fwhm) != len(wavelengths):
+            fwhm = None
+        if fwhm is not None:
+            fwhm = [np.nan if value is None else value for value in fwhm]
+        return self.plan(wavelengths, fwhm)
+
+    def _build(self, wavelengths: np.ndarray, fwhm: Optional[np.ndarray]) -> BandPlan:
+        margin = np.zeros_like(wavelengths) if fwhm is None else 0.5 * fwhm
+        index_names = []
+        index_columns = {}
+        band_keys = []
+        gather = []
+        dynamic_bands = []
+        dynamic_windows = []
+        static_invalid = []
+        dynamic_indices = []
+        weighted_bands = []
+        weight_columns = []
+
+        for index in self.indices:
+            first_column = len(band_keys)
+            channels = []
+            has_dynamic = False
+            for band in index.bands:
+                window = self._channel_window(band, wavelengths, margin)
+                candidates = np.flatnonzero(window)
+                column = len(band_keys)
+                band_keys.append((index.name, band['name']))
+                if len(candidates) == 0:
+                    gather.append(-1)
+                    channels.append(-1)
+                elif band['select'] == 'min-distance':
+                    center = (band['min'] + band['max']) / 2
+                    best = int(candidates[np.argmin(np.abs(wavelengths[candidates] - center))])
+                    gather.append(best)
+                    channels.append(best)
+                elif band['select'] == 'min-reflectance':
+                    # Resolved per sample; keep the first candidate as placeholder
+                    gather.append(int(candidates[0]))
+                    dynamic_bands.append(column)
+                    dynamic_windows.append(window)
+                    has_dynamic = True
+                elif band['select'] == 'weighted':
+                    weights = gaussian_band_weights(band['min'], band['max'], wavelengths[candidates],
+                                                    None if fwhm is None else fwhm[candidates])
+                    gather.append(int(candidates[0]))
+                    if len(candidates) == 1:
+                        channels.append(int(candidates[0]))
+                    else:
+                        # Bands with equal weights are duplicates, like bands on the same channel
+                        channels.append((tuple(candidates.tolist()), weights.tobytes()))
+                        weighted_bands.append(column)
+                        weight_columns.append((candidates, weights))
+                else:
+                    raise ValueError(f"Unknown select attribute value: {band['select']}")
+            index_columns[index.name] = np.arange(first_column, len(band_keys), dtype=np.intp)
+            missing = -1 in channels
+            duplicated = len(set(channels)) != len(channels)
+            static_invalid.append(missing or duplicated)
+            if has_dynamic and not (missing or duplicated):
+                dynamic_indices.append(len(index_names))
+            index_names.append(index.name)
+
+        gather = np.asarray(gather, dtype=np.intp)
+        return BandPlan(
+            wavelengths=wavelengths,
+            fwhm=fwhm,
+            index_names=index_names,
+            index_columns=index_columns,
+            band_keys=band_keys,
+            gather=gather,
+            missing=gather < 0,
+            dynamic_bands=np.asarray(dynamic_bands, dtype=np.intp),
+            dynamic_windows=np.asarray(dynamic_windows, dtype=bool).reshape(len(dynamic_bands), len(wavelengths)),
+            static_invalid=np.asarray(static_invalid, dtype=bool),
+            dynamic_indices=np.asarray(dynamic_indices, dtype=np.intp),
+            weighted_bands=np.asarray(weighted_bands, dtype=np.intp),
+            band_weights=BandWeights.from_columns(len(wavelengths), weight_columns),
+        )
+
+
+def main():
+    """Print the resolved channel of every band for a sensor metadata file."""
+    if len(sys.argv) != 3:
+        print("Usage: python band_plan.py <path_to_xml_folder> <sensor_json>")
+        print("\nExample: python band_plan.py ../inst/extdata/indices/ "
+              "../inst/extdata/sensors/20250905_B6448_S8330_VI25_FW2_AE_AC.json")
+        print("\nRequirements:")
+        print("  pip install numpy")
+        sys.exit(1)
+    engine = SpectralIndexEngine()
+    errors = engine.load_folder(Path(sys.argv[1]))
+    for file_name, error in errors.items():
+        print(f"❌ Error compiling {file_name}: {error}")
+    with open(sys.argv[2], 'r', encoding='utf-8') as f:
+        sensor_info = json.load(f)
+    plan = BandPlanner(engine.indices.values()).plan_for_sensor(sensor_info)
+    for k, name in enumerate(plan.index_names):
+        bands = []
+        for column in plan.index_columns[name]:
+            band_name = plan.band_keys[column][1]
+            if column in plan.dynamic_bands:
+                bands.append(f"{band_name}=min-reflectance")
+            elif column in plan.weighted_bands:
+                channels, weights = plan.band_weights.column(int(np.flatnonzero(plan.weighted_bands == column)[0]))
+                bands.append(f"{band_name}=" + "+".join(f"{w:.2f}*{plan.wavelengths[c]:g}"
+                                                        for c, w in zip(channels, weights)))
+            elif plan.missing[column]:
+                bands.append(f"{band_name}=NA")
+            else:
+                bands.append(f"{band_name}={plan.wavelengths[plan.gather[column]]:g}")
+        status = "✗" if plan.static_invalid[k] else "✓"
+        print(f"{status} {name}: {', '.join(bands)}")
+    print(f"\n📊 Computable indices: {len(plan.computable_indices())} of {len(plan.index_names)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Index Pipeline Benchmark
+
+Times the stages of the Python index pipeline on the shipped example data and
+on synthetic scaled-up variants of the example reflectance list:
+
+- mathml_conversion: MathMLConverter formula conversion of every index XML
+- index_compile: compiling all index XML files (SpectralIndexEngine)
+- json_decode: streaming decode and calibration of the ScanCorder JSON export
+- band_selection: building the BandPlan and gathering the band values
+- index_evaluation: evaluating every index separately on gathered values
+- catalogue_scoring: scoring the full catalogue (SpectralIndexEngine.score)
+- catalogue_generation / table_generation: building the index catalogue
+  artifact and the Excel table
+- import: cold import time of the util modules, each in a fresh interpreter,
+  together with the heavy packages (SymPy, matplotlib, pandas) it pulls in;
+  none of them should load before LaTeX, image or Excel output is requested
+
+For every stage the best wall time over the repeats, the throughput (items per
+second: samples, or XML files for the catalogue stages) and the peak traced
+memory of a separate run are reported. Each run is appended as one JSON line
+to a history file and compared with the previous run of the same stage and
+size, so regressions show up as warnings.
+
+Usage: python benchmark_pipeline.py [--sizes 10000,100000] [--repeat 3] [--history bench_history.jsonl]
+           [--startup-only]
+
+Requirements: pip install numpy sympy pandas openpyxl
+"""
+
+import argparse
+import gc
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from band_plan import BandPlanner
+from index_engine import SpectralIndexEngine
+from reflectance_list_reader import ReflectanceListReader
+from sensor_registry import get_registry
+
+
+UTIL_DIR = Path(__file__).resolve().parent
+REPO_DIR = UTIL_DIR.parent
+DEFAULT_XML_FOLDER = REPO_DIR / 'inst' / 'extdata' / 'indices'
+EXAMPLE_JSON = REPO_DIR / 'example' / 'data' / 'Compolytics_R-Package_VI_Test_File.json'
+EXAMPLE_REFLECTANCE_LIST = REPO_DIR / 'example' / 'data' / 'Reflectance_List_S8330_ColorChecker.csv'
+DEFAULT_HISTORY = "bench_history.jsonl"
+DEFAULT_CHUNK_SIZE = 65536
+
+# Modules whose import time is tracked, and the packages they must not import eagerly
+STARTUP_MODULES = ['mathml_core', 'index_engine', 'index_catalogue', 'catalogue_dag', 'score_exports',
+                   'mathml_converter', 'generate_indices_images', 'generate_indices_table']
+HEAVY_MODULES = ['sympy', 'matplotlib', 'pandas']
+
+_IMPORT_PROBE = """
+import json, sys, time
+sys.path.insert(0, {util_dir!r})
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def load_reflectance_list(csv_file: Path) -> Tuple[np.ndarray, np.ndarray]:
+    """Read a reflectance list CSV, returning (wavelengths, reflectance matrix)."""
+    reader = ReflectanceListReader(csv_file)
+    return reader.wavelengths, reader.read().values
+
+
+def scale_up(reflectance: np.ndarray, n_samples: int, seed: int = 0) -> np.ndarray:
+    """Tile the example spectra to n_samples rows with 1% multiplicative noise."""
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, reflectance.shape[0], n_samples)
+    return reflectance[rows] * rng.normal(1.0, 0.01, (n_samples, reflectance.shape[1]))
+
+
+def measure_import(module: str) -> Dict:
+    """Import time of a module in a fresh interpreter and the heavy packages loaded with it."""
+    probe = _IMPORT_PROBE.format(util_dir=str(UTIL_DIR), module=module, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', probe], cwd=UTIL_DIR, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class PipelineBenchmark:
+    """Runs and records the pipeline stages."""
+
+    def __init__(self, xml_folder: Path, repeat: int = 3, measure_memory: bool = True,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.xml_folder = Path(xml_folder)
+        self.repeat = repeat
+        self.measure_memory = measure_memory
+        self.chunk_size = chunk_size
+        self.results: List[Dict] = []
+        self.engine = SpectralIndexEngine()
+        self.engine.load_folder(self.xml_folder)
+
+    def measure(self, stage: str, dataset: str, n_items: int, func: Callable, **extra) -> Dict:
+        """Time `func` (best of `repeat`) and trace its peak memory in one extra run."""
+        times = []
+        for _ in range(self.repeat):
+            gc.collect()
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        peak_mb = None
+        if self.measure_memory:
+            gc.collect()
+            tracemalloc.start()
+            func()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        best = min(times)
+        result = dict(extra, stage=stage, dataset=dataset, items=n_items, seconds=best,
+                      items_per_sec=n_items / best if best > 0 else None, peak_mb=peak_mb)
+        self.results.append(result)
+        rate = f"{result['items_per_sec']:,.0f}/s" if result['items_per_sec'] else "-"
+        memory = f"{peak_mb:,.1f} MB" if peak_mb is not None else "-"
+        print(f"⏱️ {stage:<20} {dataset:<22} {n_items:>9,} items  {best * 1000:10.2f} ms  {rate:>14}  peak {memory}")
+        return result
+
+    def _chunks(self, reflectance: np.ndarray):
+        for start in range(0, reflectance.shape[0], self.chunk_size):
+            yield reflectance[start:start + self.chunk_size]
+
+    def run_definition_stages(self, include_table: bool = True):
+        """Stages that process the index XML files."""
+        import xml.etree.ElementTree as ET
+        from mathml_converter import MathMLConverter
+        xml_files = sorted(self.xml_folder.glob("*.xml"))
+        converter = MathMLConverter()
+        mathml_elements = [self.engine._find_mathml_element(ET.parse(f).getroot()) for f in xml_files]
+        self.measure('mathml_conversion', 'indices', len(xml_files),
+                     lambda: [converter.convert_to_sympy_string(element) for element in mathml_elements])
+        self.measure('index_compile', 'indices', len(xml_files),
+                     lambda: SpectralIndexEngine().load_folder(self.xml_folder))
+
+        from index_catalogue import CatalogueCompiler
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            artifact = Path(tmp_dir) / 'bench.scic'
+            self.measure('catalogue_generation', 'indices', len(xml_files),
+                         lambda: CatalogueCompiler().compile_folder(self.xml_folder, artifact))
+            if include_table:
+                from generate_indices_table import SpectralIndexTableGenerator
+                table = Path(tmp_dir) / 'bench.xlsx'
+                self.measure('table_generation', 'indices', len(xml_files),
+                             lambda: _quiet(SpectralIndexTableGenerator().generate_excel_table,
+                                            self.xml_folder, table))
+
+    def run_startup_stage(self, modules: List[str] = STARTUP_MODULES) -> List[str]:
+        """Cold import times (best of `repeat` fresh interpreters); returns modules loading heavy packages."""
+        eager = []
+        for module in modules:
+            probes = [measure_import(module) for _ in range(self.repeat)]
+            best = min(probe['seconds'] for probe in probes)
+            heavy = probes[0]['heavy']
+            self.results.append({'stage': 'import', 'dataset': module, 'items': 1, 'seconds': best,
+                                 'items_per_sec': None, 'peak_mb': None, 'heavy_modules': heavy})
+            print(f"⏱️ {'import':<20} {module:<22} {best * 1000:10.2f} ms"
+                  f"{'  loads ' + ', '.join(heavy) if heavy else ''}")
+            if heavy:
+                eager.append(f"{module} imports {', '.join(heavy)}")
+        return eager
+
+    def run_decode_stage(self, json_file: Path):
+        """Streaming decode plus calibration of a ScanCorder export."""
+        from calibration import calibrate_batch
+        from scancorder_regular_decode import RegularScannerStreamDecoder
+        decoder = RegularScannerStreamDecoder()
+        n_samples = sum(len(batch) for batch in decoder.iter_batches(json_file))
+        self.measure('json_decode', json_file.stem[:22], n_samples,
+                     lambda: [calibrate_batch(batch) for batch in decoder.iter_batches(json_file)])
+
+    def run_sample_stages(self, dataset: str, wavelengths: np.ndarray, fwhm: Optional[np.ndarray],
+                          reflectance: np.ndarray):
+        """Band selection, per-index evaluation and full scoring on a reflectance matrix."""
+        n_samples = reflectance.shape[0]
+        indices = list(self.engine.indices.values())
+
+        def select_bands():
+            plan = BandPlanner(indices).plan(wavelengths, fwhm)
+            for chunk in self._chunks(reflectance):
+                plan.gather_values(chunk)
+        self.measure('band_selection', dataset, n_samples, select_bands)
+
+        plan = BandPlanner(indices).plan(wavelengths, fwhm)
+        computable = plan.computable_indices()
+        per_index = {name: 0.0 for name in computable}
+
+        def evaluate_indices():
+            for chunk in self._chunks(reflectance):
+                values, _ = plan.gather_values(chunk)
+                for name in computable:
+                    start = time.perf_counter()
+                    self.engine.indices[name].evaluate(values[:, plan.index_columns[name]])
+                    per_index[name] += time.perf_counter() - start
+        self.measure('index_evaluation', dataset, n_samples, evaluate_indices, n_indices=len(computable))
+        slowest = sorted(per_index.items(), key=lambda item: -item[1])[:5]
+        print(f"   slowest indices: {', '.join(name for name, _ in slowest)}")
+
+        self.measure('catalogue_scoring', dataset, n_samples,
+                     lambda: [self.engine.score(chunk, plan) for chunk in self._chunks(reflectance)],
+                     n_indices=len(computable))
+
+
+def _quiet(func: Callable, *args, **kwargs):
+    """Call a function with its progress output suppressed."""
+    import contextlib
+    import io
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args, **kwargs)
+
+
+def compare_with_history(results: List[Dict], history: List[Dict], threshold: float) -> List[str]:
+    """Warnings for stages that got slower than the previous run by more than `threshold`."""
+    previous = {}
+    for run in history:
+        for result in run.get('results', []):
+            previous[(result['stage'], result['dataset'], result['items'])] = result
+    warnings = []
+    for result in results:
+        before = previous.get((result['stage'], result['dataset'], result['items']))
+        if before and before.get('seconds') and result['seconds'] > before['seconds'] * (1 + threshold):
+            warnings.append(f"{result['stage']} on {result['dataset']} ({result['items']:,} items): "
+                            f"{before['seconds'] * 1000:.2f} ms -> {result['seconds'] * 1000:.2f} ms")
+    return warnings
+
+
+def load_history(history_file: Path) -> List[Dict]:
+    if not history_file.exists():
+        return []
+    with open(history_file, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the spectral index pipeline stages.")
+    parser.add_argument('--xml-folder', type=Path, default=DEFAULT_XML_FOLDER, help="Folder with index XML files")
+    parser.add_argument('--sizes', default='10000,100000',
+                        help="Comma-separated synthetic sample counts (default: 10000,100000)")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed repetitions per stage (default: 3)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"Samples scored per call (default: {DEFAULT_CHUNK_SIZE})")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the peak memory runs")
+    parser.add_argument('--no-table', action='store_true', help="Skip the Excel table generation stage")
+    parser.add_argument('--history', type=Path, default=Path(DEFAULT_HISTORY),
+                        help=f"JSON lines file the results are appended to (default: {DEFAULT_HISTORY})")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Relative slow-down reported as regression (default: 0.2)")
+    parser.add_argument('--startup-only', action='store_true', help="Only run the import time stage")
+    return parser.parse_args()
+
+
+def main():
+    """Run all benchmark stages and append the results to the history."""
+    args = parse_arguments()
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    benchmark = PipelineBenchmark(args.xml_folder, args.repeat, not args.no_memory, args.chunk_size)
+    print(f"📄 {len(benchmark.engine.indices)} indices from {args.xml_folder}")
+
+    eager_imports = benchmark.run_startup_stage()
+    if not args.startup_only:
+        benchmark.run_definition_stages(include_table=not args.no_table)
+        benchmark.run_decode_stage(EXAMPLE_JSON)
+
+        wavelengths, reflectance = load_reflectance_list(EXAMPLE_REFLECTANCE_LIST)
+        sensor = get_registry().lookup(EXAMPLE_REFLECTANCE_LIST.stem)
+        fwhm = sensor.channel_fwhm_real if sensor is not None else None
+        if fwhm is not None and len(fwhm) != len(wavelengths):
+            fwhm = None
+        benchmark.run_sample_stages('reflectance_list', wavelengths, fwhm, reflectance)
+        for size in sizes:
+            benchmark.run_sample_stages(f'synthetic_{size}', wavelengths, fwhm, scale_up(reflectance, size))
+
+    history = load_history(args.history)
+    warnings = compare_with_history(benchmark.results, history, args.threshold)
+    run = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'results': benchmark.results,
+    }
+    with open(args.history, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(run) + '\n')
+
+    print(f"\n{'='*60}")
+    for eager in eager_imports:
+        print(f"⚠️ Eager heavy import: {eager}")
+    if warnings:
+        print(f"⚠️ Regressions above {args.threshold:.0%} compared to the previous run:")
+        for warning in warnings:
+            print(f"   {warning}")
+    else:
+        print("✅ No regressions compared to the previous run")
+    print(f"📊 Results appended to: {args.history.absolute()}")
+    print(f"{'='*60}")
+
+
+if __name__ == "__main__":
+    main()
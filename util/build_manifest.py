@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Incremental Build Manifest
+
+Keeps track of the content hash of every input XML file (combined with the
+version of the generator that produced the output) so that the util scripts
+only regenerate outputs for index files that changed since the previous run.
+
+The manifest is a small JSON file stored next to the generated outputs.
+"""
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+
+class BuildManifest:
+    """Maps input file names to the content hash they were last built from."""
+
+    def __init__(self, manifest_path: Path, renderer_version: str):
+        self.manifest_path = Path(manifest_path)
+        self.renderer_version = renderer_version
+        self.entries: Dict[str, Dict] = {}
+
+    def load(self) -> 'BuildManifest':
+        """Load a previous manifest; a missing or unreadable manifest starts empty."""
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.entries = data.get('entries', {})
+        except (OSError, ValueError):
+            self.entries = {}
+        return self
+
+    def save(self):
+        """Write the manifest to disk."""
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.manifest_path, 'w', encoding='utf-8') as f:
+            json.dump({'entries': self.entries}, f, indent=2, sort_keys=True)
+
+    def content_hash(self, input_file: Path) -> str:
+        """Hash of the input file content plus the renderer version."""
+        digest = hashlib.sha256()
+        digest.update(self.renderer_version.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(Path(input_file).read_bytes())
+        return digest.hexdigest()
+
+    def is_current(self, input_file: Path, content_hash: str, output_file: Optional[Path] = None) -> bool:
+        """True if the input was already built from this exact content (and the output still exists)."""
+        entry = self.entries.get(Path(input_file).name)
+        if entry is None or entry.get('hash') != content_hash:
+            return False
+        return output_file is None or Path(output_file).exists()
+
+    def get(self, input_file: Path) -> Optional[Dict]:
+        """Return the manifest entry of an input file, if any."""
+        return self.entries.get(Path(input_file).name)
+
+    def update(self, input_file: Path, content_hash: str, **extra):
+        """Record that an input file was built from the given content."""
+        self.entries[Path(input_file).name] = dict(extra, hash=content_hash)
+
+    def prune(self, input_files: Iterable[Path]) -> List[str]:
+        """Drop entries of input files that no longer exist, returning their names."""
+        existing = {Path(f).name for f in input_files}
+        removed = [name for name in self.entries if name not in existing]
+        for name in removed:
+            del self.entries[name]
+        return removed
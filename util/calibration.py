@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Vectorized Reflectance Calibration
+
+Python counterparts of the calibration steps of DecodeCompolyticsRegularScanner
+and CalibrationReflectanceMultipoint, operating on whole batches instead of
+cell-by-cell loops:
+
+- two-point calibration: divide by the mean reference measurement and scale
+  by its true factor
+- multipoint calibration: fit y = b0 * x^2 + b1 * x + b2 for every
+  (LED, sensor) cell at once as one batched least-squares solve over the
+  stacked references plus the zero dark-current point, then apply it with
+  broadcasting to an (n_samples, n_leds, n_sensors) batch
+- precomputed factors: apply the `multi_calibration` quadratic stored in the
+  sensor JSON files to (n_samples, n_features) reflectance
+
+The mean reference matrices and fitted coefficients are kept in a
+CalibrationCache keyed by a content hash of the calibration map. Samples
+scanned against the same white/grey references are calibrated without
+averaging or fitting again, across batches and, with a cache directory,
+across processes and runs.
+
+Usage: python calibration.py <export.json> [batch_size]
+
+Requirements: pip install numpy
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+
+
+# Part of every cache key; bump when the averaging or fitting changes so disk entries are refit
+CALIBRATION_CACHE_VERSION = b"1"
+DEFAULT_CACHE_ENTRIES = 256
+
+
+def mean_reference(calibration_entry: Dict) -> np.ndarray:
+    """Average the stacked measurements (depth, n_leds, n_sensors) of one reference."""
+    return np.asarray(calibration_entry['sensor_values'], dtype=np.float64).mean(axis=0)
+
+
+def fit_multipoint_coefficients(calibration_map: Dict[str, Dict]) -> np.ndarray:
+    """Fit the quadratic calibration of every cell, returning b with shape (n_leds, n_sensors, 3).
+
+    `calibration_map` maps each true value to {'sensor_values': stacked
+    measurements, 'true_factor': factor}, as produced by the streaming decoder.
+    Cells whose design matrix is rank deficient get NaN coefficients, where
+    lm() would report aliased (NA) coefficients.
+    """
+    if len(calibration_map) < 2:
+        raise ValueError("At least two calibration points are required")
+    references = [mean_reference(entry) for entry in calibration_map.values()]
+    num_orient, num_feat = references[0].shape
+
+    # (n_points, n_leds, n_sensors) with the zero dark-current point appended
+    xdata = np.stack(references + [np.zeros((num_orient, num_feat))])
+    ydata = np.stack([np.broadcast_to(np.asarray(entry['true_factor'], dtype=np.float64), (num_feat,))
+                      for entry in calibration_map.values()] + [np.zeros(num_feat)])
+    ydata = np.broadcast_to(ydata[:, None, :], xdata.shape)
+
+    # One (n_points x 3) design matrix per cell: columns x^2, x, 1
+    x = np.moveaxis(xdata, 0, -1).reshape(-1, xdata.shape[0])
+    y = np.moveaxis(ydata, 0, -1).reshape(-1, xdata.shape[0])
+    design = np.stack([x ** 2, x, np.ones_like(x)], axis=-1)
+    coefficients = (np.linalg.pinv(design) @ y[..., None])[..., 0]
+    deficient = np.linalg.matrix_rank(design) < 3
+    coefficients[deficient] = np.nan
+    return coefficients.reshape(num_orient, num_feat, 3)
+
+
+def apply_quadratic(coefficients: np.ndarray, sensor_values: np.ndarray) -> np.ndarray:
+    """Apply b0 * x^2 + b1 * x + b2 with coefficients broadcast over leading sample axes."""
+    b0 = coefficients[..., 0]
+    b1 = coefficients[..., 1]
+    b2 = coefficients[..., 2]
+    return (b0 * sensor_values + b1) * sensor_values + b2
+
+
+def apply_two_point(sensor_values: np.ndarray, reference: np.ndarray, true_factor: np.ndarray) -> np.ndarray:
+    """Divide by the mean reference and scale by its true factor."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        calibrated = sensor_values / reference
+    # Division by zero becomes 0; missing inputs stay missing as NA does in R
+    calibrated[~np.isfinite(calibrated) & ~np.isnan(sensor_values) & ~np.isnan(reference)] = 0
+    return calibrated * true_factor
+
+
+def two_point_calibration(sensor_values: np.ndarray, calibration_map: Dict[str, Dict]) -> np.ndarray:
+    """Calibrate a batch against exactly one reference measurement."""
+    if len(calibration_map) != 1:
+        raise ValueError("Two point calibration requires exactly one calibration measurement")
+    entry = next(iter(calibration_map.values()))
+    return apply_two_point(sensor_values, mean_reference(entry), np.asarray(entry['true_factor'], dtype=np.float64))
+
+
+def calibration_hash(calibration_map: Dict[str, Dict]) -> str:
+    """Content hash of a calibration map: keys, measurement arrays and true factors, in map order."""
+    digest = hashlib.sha1(CALIBRATION_CACHE_VERSION)
+    for key, entry in calibration_map.items():
+        values = np.ascontiguousarray(entry['sensor_values'], dtype=np.float64)
+        true_factor = np.ascontiguousarray(entry['true_factor'], dtype=np.float64)
+        digest.update(f"{key}|{values.shape}|{true_factor.shape}|".encode('utf-8'))
+        digest.update(values.tobytes())
+        digest.update(true_factor.tobytes())
+    return digest.hexdigest()
+
+
+class CalibrationCoefficients:
+    """What calibrating against one reference set needs, computed once per calibration map."""
+
+    def __init__(self, references: np.ndarray, true_factor: Optional[np.ndarray] = None,
+                 coefficients: Optional[np.ndarray] = None):
+        # Mean reference matrices (n_points, n_leds, n_sensors)
+        self.references = references
+        # Two-point calibration: true factor of the single reference
+        self.true_factor = true_factor
+        # Multipoint calibration: fitted b with shape (n_leds, n_sensors, 3)
+        self.coefficients = coefficients
+
+    @classmethod
+    def fit(cls, calibration_map: Dict[str, Dict]) -> 'CalibrationCoefficients':
+        references = np.stack([mean_reference(entry) for entry in calibration_map.values()])
+        if len(calibration_map) == 1:
+            entry = next(iter(calibration_map.values()))
+            return cls(references, true_factor=np.asarray(entry['true_factor'], dtype=np.float64))
+        return cls(references, coefficients=fit_multipoint_coefficients(calibration_map))
+
+    def apply(self, sensor_values: np.ndarray) -> np.ndarray:
+        if self.coefficients is not None:
+            return apply_quadratic(self.coefficients, sensor_values)
+        return apply_two_point(sensor_values, self.references[0], self.true_factor)
+
+    def save(self, path: Path):
+        """Write the arrays as .npz, atomically so concurrent workers never read a partial file."""
+        arrays = {'references': self.references}
+        if self.true_factor is not None:
+            arrays['true_factor'] = self.true_factor
+        if self.coefficients is not None:
+            arrays['coefficients'] = self.coefficients
+        handle, tmp_path = tempfile.mkstemp(suffix='.npz', dir=path.parent)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: Path) -> 'CalibrationCoefficients':
+        with np.load(path) as arrays:
+            return cls(arrays['references'], arrays['true_factor'] if 'true_factor' in arrays else None,
+                       arrays['coefficients'] if 'coefficients' in arrays else None)
+
+
+class CalibrationCache:
+    """LRU cache of CalibrationCoefficients keyed by calibration_hash(), optionally backed by a directory."""
+
+    def __init__(self, max_entries: int = DEFAULT_CACHE_ENTRIES, cache_dir: Optional[Path] = None):
+        self.max_entries = max_entries
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._entries: 'OrderedDict[str, CalibrationCoefficients]' = OrderedDict()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, calibration_map: Dict[str, Dict]) -> CalibrationCoefficients:
+        """Coefficients of a calibration map, fitting them only if neither memory nor disk has them."""
+        key = calibration_hash(calibration_map)
+        coefficients = self._entries.get(key)
+        if coefficients is not None:
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return coefficients
+        path = self.cache_dir / f"{key}.npz" if self.cache_dir is not None else None
+        if path is not None and path.exists():
+            try:
+                coefficients = CalibrationCoefficients.load(path)
+                self.stats['disk_hits'] += 1
+            except (OSError, ValueError, KeyError):
+                # Unreadable entry: fit again and overwrite it
+                coefficients = None
+        if coefficients is None:
+            coefficients = CalibrationCoefficients.fit(calibration_map)
+            self.stats['misses'] += 1
+            if path is not None:
+                coefficients.save(path)
+        if self.max_entries > 0:
+            self._entries[key] = coefficients
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return coefficients
+
+    def clear(self):
+        self._entries.clear()
+
+
+# Shared by calibrate()/calibrate_batch() when no cache is passed
+CALIBRATION_CACHE = CalibrationCache()
+
+
+def calibrate(sensor_values: np.ndarray, calibration_map: Optional[Dict[str, Dict]],
+              cache: Optional[CalibrationCache] = None) -> np.ndarray:
+    """Choose between two-point and multipoint calibration like the R decoder."""
+    if not calibration_map:
+        return sensor_values
+    cache = CALIBRATION_CACHE if cache is None else cache
+    return cache.get(calibration_map).apply(sensor_values)
+
+
+def calibrate_batch(batch, cache: Optional[CalibrationCache] = None) -> np.ndarray:
+    """Calibrate all samples of a SampleBatch, looking up each distinct reference set once."""
+    calibrated = batch.values.copy()
+    for position, calibration_map in enumerate(batch.calibrations):
+        rows = np.flatnonzero(batch.calibration_index == position)
+        calibrated[rows] = calibrate(batch.values[rows], calibration_map, cache)
+    return calibrated
+
+
+class CalibrationReflectanceMultipoint:
+    """Applies precomputed quadratic calibration factors to reflectance batches."""
+
+    def __init__(self, calibration_factors=None):
+        self.calibration_factors = None
+        if calibration_factors is not None:
+            self.calibration_factors = np.asarray(calibration_factors, dtype=np.float64)
+
+    @classmethod
+    def from_sensor_info(cls, device_sensor_info: Optional[Dict], external_sensor_info: Optional[Dict] = None):
+        """Load the `multi_calibration` factors of a sensor, device info taking precedence."""
+        for info in (device_sensor_info, external_sensor_info):
+            if info is not None and info.get('multi_calibration') is not None:
+                return cls(info['multi_calibration'])
+        raise ValueError("Calibration factors are not defined.")
+
+    def score(self, reflectance) -> np.ndarray:
+        """Calibrate an (n_samples, n_features) reflectance matrix."""
+        if self.calibration_factors is None:
+            raise ValueError("Calibration factors are not defined.")
+        reflectance = np.asarray(reflectance, dtype=np.float64)
+        factors = self.calibration_factors
+        # Stored as (depth, n_features, 3); like the R class only the first depth slice is used
+        if factors.ndim != 3 or factors.shape[1] != reflectance.shape[-1] or factors.shape[2] != 3:
+            raise ValueError(
+                f"Calibration data not of correct size for this sensor. Sensor bands: {reflectance.shape[-1]}, "
+                f"Expected calibration: (depth, {reflectance.shape[-1]}, 3), Got: {tuple(factors.shape)}")
+        return apply_quadratic(factors[0], reflectance)
+
+
+def main():
+    """Decode and calibrate an export, printing a summary per batch."""
+    if len(sys.argv) < 2:
+        print("Usage: python calibration.py <export.json> [batch_size]")
+        print("\nExample: python calibration.py ../example/data/Compolytics_R-Package_VI_Test_File.json")
+        print("\nRequirements:")
+        print("  pip install numpy")
+        sys.exit(1)
+    # Imported here so the calibration functions stay usable without the decoder
+    from scancorder_regular_decode import DEFAULT_BATCH_SIZE, RegularScannerStreamDecoder
+    batch_size = int(sys.argv[2]) if len(sys.argv) >= 3 else DEFAULT_BATCH_SIZE
+    decoder = RegularScannerStreamDecoder(batch_size=batch_size)
+    for batch in decoder.iter_batches(Path(sys.argv[1])):
+        calibrated = calibrate_batch(batch)
+        points = sorted({len(calibration_map) for calibration_map in batch.calibrations})
+        print(f"📦 Batch at sample {batch.sample_offset}: {len(batch)} samples, "
+              f"calibration points per set: {points or 'none'}, "
+              f"calibrated range [{np.nanmin(calibrated):.4g}, {np.nanmax(calibrated):.4g}]")
+    stats = CALIBRATION_CACHE.stats
+    print(f"\n📊 Calibration sets: {stats['misses']} fitted, {stats['hits']} reused from the cache")
+    print("✅ Calibration finished")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Catalogue-wide Common Subexpression Elimination
+
+Many spectral indices share subexpressions such as (R800 - R670) or OSAVI
+style denominators. This module merges the expression trees of all indices
+of a SpectralIndexEngine into one DAG whose leaves are the channels resolved
+by a BandPlan, so that every unique operation is evaluated once per batch:
+
+- band variables become the sensor channel they resolve to ("min-reflectance"
+  bands: their channel window, "weighted" bands: their channel weights), so
+  equal bands of different indices share one leaf
+- n-ary plus/times/minus/divide are unfolded into left-nested binary nodes,
+  which is exactly how evaluate_mathml() reduces them
+- the two operands of binary plus/times are ordered canonically (IEEE
+  addition and multiplication are commutative, so results are unchanged)
+- operations on constants only are folded when the DAG is built
+- indices that are NA on the grid by construction are not evaluated at all
+
+Intermediate results are released after their last use. The values of all
+"weighted" leaves come from one sparse product with the DAG's BandWeights.
+
+Usage: python catalogue_dag.py <path_to_xml_folder> <sensor_json> [n_samples]
+
+Requirements: pip install numpy
+"""
+
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from band_plan import BandPlan, BandPlanner, BandWeights
+from index_engine import SpectralIndexEngine, rgb2hue
+from instrumentation import NULL_INSTRUMENTATION, Instrumentation
+
+
+LEAF_KINDS = ('channel', 'window', 'weighted', 'const')
+
+# Binary operators whose operands may be swapped without changing the result
+COMMUTATIVE = {'add', 'mul'}
+
+NUMPY_OPERATIONS = {
+    'add': np.add,
+    'sub': np.subtract,
+    'mul': np.multiply,
+    'div': np.divide,
+    'pow': np.power,
+    'neg': np.negative,
+    'sqrt': np.sqrt,
+    'abs': np.abs,
+    'log': np.log,
+    'rgb2hue': rgb2hue,
+}
+
+# Reducing MathML operators and their binary operation
+REDUCE_OPERATIONS = {'plus': 'add', 'minus': 'sub', 'times': 'mul', 'divide': 'div'}
+UNARY_OPERATIONS = {'abs': 'abs', 'ln': 'log'}
+
+
+def tree_operations(node: Tuple) -> int:
+    """Number of operations of an expression tree as evaluated without sharing."""
+    if node[0] in ('ci', 'cn'):
+        return 0
+    own = max(len(node) - 2, 1) if node[0] in REDUCE_OPERATIONS else 1
+    if node[0] == 'root' and len(node) == 3:
+        own = 2
+    return own + sum(tree_operations(child) for child in node[1:])
+
+
+class CatalogueDAG:
+    """Merged, deduplicated expression DAG of a catalogue on one channel grid."""
+
+    def __init__(self, plan: BandPlan, nodes: List[Tuple], windows: List[np.ndarray],
+                 roots: Dict[str, int], leaves: Dict[str, List[int]], tree_size: int,
+                 weights: Optional[BandWeights] = None):
+        self.plan = plan
+        # (operation, operand, ...) in topological order; leaves are
+        # ('channel', c), ('window', w), ('weighted', k) and ('const', value)
+        self.nodes = nodes
+        # Channel windows of "min-reflectance" leaves
+        self.windows = windows
+        # Weight matrix whose column k gives the values of ('weighted', k) leaves
+        self.weights = BandWeights.from_columns(plan.n_channels, []) if weights is None else weights
+        # Root node and leaf nodes (in band order) of every computable index
+        self.roots = roots
+        self.leaves = leaves
+        self.tree_size = tree_size
+        self._last_use = self._compute_last_use()
+
+    @property
+    def n_operations(self) -> int:
+        """Number of unique operations evaluated per batch."""
+        return sum(1 for node in self.nodes if node[0] not in LEAF_KINDS)
+
+    def _compute_last_use(self) -> List[int]:
+        last_use = list(range(len(self.nodes)))
+        for position, node in enumerate(self.nodes):
+            if node[0] not in LEAF_KINDS:
+                for operand in node[1:]:
+                    last_use[operand] = position
+        for root in self.roots.values():
+            last_use[root] = len(self.nodes)
+        return last_use
+
+    def evaluate_nodes(self, reflectance: np.ndarray) -> Tuple[Dict[int, np.ndarray], Dict[int, np.ndarray]]:
+        """Evaluate every node once, returning root values and the selected channel of window leaves."""
+        values: List[Optional[np.ndarray]] = [None] * len(self.nodes)
+        selections = {}
+        n_nodes = len(self.nodes)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            weighted = self.weights.apply(reflectance) if self.weights.n_columns else None
+            for position, node in enumerate(self.nodes):
+                kind = node[0]
+                if kind == 'channel':
+                    values[position] = reflectance[:, node[1]]
+                elif kind == 'weighted':
+                    values[position] = weighted[:, node[1]]
+                elif kind == 'window':
+                    selected = self.plan.select_in_window(reflectance, self.windows[node[1]])
+                    selections[position] = selected
+                    leaf = reflectance[np.arange(reflectance.shape[0]), np.maximum(selected, 0)]
+                    leaf[selected < 0] = np.nan
+                    values[position] = leaf
+                elif kind == 'const':
+                    values[position] = node[1]
+                else:
+                    values[position] = NUMPY_OPERATIONS[kind](*(values[operand] for operand in node[1:]))
+                    # Release operands that are not needed any more
+                    for operand in node[1:]:
+                        if self._last_use[operand] == position and self.nodes[operand][0] != 'const':
+                            values[operand] = None
+            roots = {node: values[node] for node in set(self.roots.values()) if self._last_use[node] == n_nodes}
+        return roots, selections
+
+    def score(self, reflectance, index_names: Optional[Sequence[str]] = None,
+              drop_empty: bool = False,
+              instrumentation: Instrumentation = NULL_INSTRUMENTATION, dtype=np.float64) -> Dict[str, np.ndarray]:
+        """Score a batch like SpectralIndexEngine.score(), evaluating shared subexpressions once.
+
+        Shared nodes have no per-index cost, so an enabled `instrumentation`
+        gets one evaluation timer and, with per_index, NaN/Inf counts only.
+        The nodes are evaluated in `dtype`; to keep some indices in double
+        precision, build a second DAG on plan.subset() of them.
+        """
+        reflectance = np.asarray(reflectance, dtype=dtype)
+        if reflectance.ndim == 1:
+            reflectance = reflectance.reshape(1, -1)
+        if reflectance.shape[1] != self.plan.n_channels:
+            raise ValueError(f"Reflectance has {reflectance.shape[1]} channels, plan expects {self.plan.n_channels}")
+        n_samples = reflectance.shape[0]
+        with instrumentation.stage('evaluation', n_samples):
+            roots, selections = self.evaluate_nodes(reflectance)
+        leaf_nan = {}
+        if index_names is None:
+            index_names = self.plan.index_names
+        known = set(self.plan.index_names)
+        results = {}
+        for name in index_names:
+            if name not in known:
+                continue
+            root = self.roots.get(name)
+            if root is None:
+                if not drop_empty:
+                    results[name] = np.full(n_samples, np.nan)
+                continue
+            result = np.broadcast_to(np.asarray(roots[root], dtype=np.float64), (n_samples,)).copy()
+            # NA if any band value is missing, as in calculate_index()
+            invalid = np.zeros(n_samples, dtype=bool)
+            leaves = self.leaves[name]
+            for leaf in set(leaves):
+                if leaf not in leaf_nan:
+                    leaf_nan[leaf] = self._leaf_missing(leaf, reflectance, selections)
+                invalid |= leaf_nan[leaf]
+            # "min-reflectance" bands that select the same channel as another band of the index
+            for a in range(len(leaves)):
+                for b in range(a + 1, len(leaves)):
+                    if leaves[a] in selections or leaves[b] in selections:
+                        invalid |= self._channel(leaves[a], selections, n_samples) == \
+                                   self._channel(leaves[b], selections, n_samples)
+            result[invalid] = np.nan
+            if instrumentation.per_index:
+                instrumentation.record_index(name, result)
+            if drop_empty and np.isnan(result).all():
+                continue
+            results[name] = result
+        return results
+
+    def _leaf_missing(self, leaf: int, reflectance: np.ndarray, selections: Dict[int, np.ndarray]) -> np.ndarray:
+        kind, operand = self.nodes[leaf]
+        if kind == 'channel':
+            return np.isnan(reflectance[:, operand])
+        if kind == 'weighted':
+            return np.isnan(reflectance[:, self.weights.column(operand)[0]]).any(axis=1)
+        return selections[leaf] < 0
+
+    def _channel(self, leaf: int, selections: Dict[int, np.ndarray], n_samples: int) -> np.ndarray:
+        if leaf in selections:
+            return selections[leaf]
+        if self.nodes[leaf][0] == 'weighted':
+            # Never equal to a selected channel
+            return np.full(n_samples, -2 - self.nodes[leaf][1])
+        return np.full(n_samples, self.nodes[leaf][1])
+
+
+class CatalogueDAGBuilder:
+    """Hash-conses the expression trees of all computable indices into one node list."""
+
+    def __init__(self, plan: BandPlan):
+        self.plan = plan
+        self.nodes: List[Tuple] = []
+        self.windows: List[np.ndarray] = []
+        self.weight_columns: List[Tuple[np.ndarray, np.ndarray]] = []
+        self._node_ids: Dict[Tuple, int] = {}
+        self._window_ids: Dict[bytes, int] = {}
+        self._weight_ids: Dict[bytes, int] = {}
+
+    def _node(self, node: Tuple) -> int:
+        kind = node[0]
+        if kind not in LEAF_KINDS:
+            if kind in COMMUTATIVE and node[1] > node[2]:
+                node = (kind, node[2], node[1])
+            operands = [self.nodes[operand] for operand in node[1:]]
+            if all(operand[0] == 'const' for operand in operands):
+                with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                    value = NUMPY_OPERATIONS[kind](*(np.float64(operand[1]) for operand in operands))
+                node = ('const', float(np.asarray(value)))
+        if kind == 'const' or node[0] == 'const':
+            # Keyed by bit pattern so that NaN constants and -0.0 stay distinct but shareable
+            key = ('const', np.float64(node[1]).tobytes())
+        else:
+            key = node
+        node_id = self._node_ids.get(key)
+        if node_id is None:
+            node_id = self._node_ids[key] = len(self.nodes)
+            self.nodes.append(node)
+        return node_id
+
+    def leaf(self, column: int) -> int:
+        """Leaf node for a gathered plan column."""
+        position = np.searchsorted(self.plan.weighted_bands, column)
+        if position < len(self.plan.weighted_bands) and self.plan.weighted_bands[position] == column:
+            channels, weights = self.plan.band_weights.column(int(position))
+            key = channels.tobytes() + weights.tobytes()
+            if key not in self._weight_ids:
+                self._weight_ids[key] = len(self.weight_columns)
+                self.weight_columns.append((channels, weights))
+            return self._node(('weighted', self._weight_ids[key]))
+        position = np.searchsorted(self.plan.dynamic_bands, column)
+        if position < len(self.plan.dynamic_bands) and self.plan.dynamic_bands[position] == column:
+            window = self.plan.dynamic_windows[position]
+            key = window.tobytes()
+            if key not in self._window_ids:
+                self._window_ids[key] = len(self.windows)
+                self.windows.append(window)
+            return self._node(('window', self._window_ids[key]))
+        return self._node(('channel', int(self.plan.gather[column])))
+
+    def add(self, node: Tuple, leaves: Dict[str, int]) -> int:
+        """Add an expression tree whose variables map to the given leaf nodes."""
+        kind = node[0]
+        if kind == 'ci':
+            return leaves[node[1]]
+        if kind == 'cn':
+            return self._node(('const', node[1]))
+        operands = [self.add(child, leaves) for child in node[1:]]
+        if kind in REDUCE_OPERATIONS:
+            if kind == 'minus' and len(operands) == 1:
+                return self._node(('neg', operands[0]))
+            current = operands[0]
+            for operand in operands[1:]:
+                current = self._node((REDUCE_OPERATIONS[kind], current, operand))
+            return current
+        if kind == 'power':
+            return self._node(('pow', operands[0], operands[1]))
+        if kind == 'root':
+            if len(operands) == 1:
+                return self._node(('sqrt', operands[0]))
+            exponent = self._node(('div', self._node(('const', 1.0)), operands[1]))
+            return self._node(('pow', operands[0], exponent))
+        if kind in UNARY_OPERATIONS:
+            return self._node((UNARY_OPERATIONS[kind], operands[0]))
+        if kind == 'rgb2hue':
+            return self._node(('rgb2hue',) + tuple(operands))
+        raise ValueError(f"Unsupported MathML operator: {kind}")
+
+
+def build_catalogue_dag(engine: SpectralIndexEngine, plan: BandPlan) -> CatalogueDAG:
+    """Merge all indices of an engine that are computable on the plan's grid into one DAG."""
+    builder = CatalogueDAGBuilder(plan)
+    roots = {}
+    leaves = {}
+    tree_size = 0
+    for name, invalid in zip(plan.index_names, plan.static_invalid):
+        if invalid:
+            continue
+        index = engine.indices[name]
+        columns = plan.index_columns[name]
+        band_leaves = [builder.leaf(int(column)) for column in columns]
+        roots[name] = builder.add(index.expression.tree, dict(zip(index.band_names, band_leaves)))
+        leaves[name] = band_leaves
+        tree_size += tree_operations(index.expression.tree)
+    return CatalogueDAG(plan, builder.nodes, builder.windows, roots, leaves, tree_size,
+                        BandWeights.from_columns(plan.n_channels, builder.weight_columns))
+
+
+def main():
+    """Build the catalogue DAG for a sensor and compare it with per-index scoring."""
+    if len(sys.argv) < 3:
+        print("Usage: python catalogue_dag.py <path_to_xml_folder> <sensor_json> [n_samples]")
+        print("\nExample: python catalogue_dag.py ../inst/extdata/indices/ "
+              "../inst/extdata/sensors/20250905_B6448_S8330_VI25_FW2_AE_AC.json 100000")
+        print("\nRequirements:")
+        print("  pip install numpy")
+        sys.exit(1)
+    engine = SpectralIndexEngine()
+    errors = engine.load_folder(Path(sys.argv[1]))
+    for file_name, error in errors.items():
+        print(f"❌ Error compiling {file_name}: {error}")
+    with open(sys.argv[2], 'r', encoding='utf-8') as f:
+        sensor_info = json.load(f)
+    plan = BandPlanner(engine.indices.values()).plan_for_sensor(sensor_info)
+    dag = build_catalogue_dag(engine, plan)
+    print(f"📊 Computable indices: {len(dag.roots)} of {len(plan.index_names)}")
+    print(f"🔗 Operations: {dag.tree_size} in separate trees, {dag.n_operations} unique in the DAG")
+
+    n_samples = int(sys.argv[3]) if len(sys.argv) >= 4 else 100000
+    reflectance = np.random.default_rng(0).uniform(0.01, 1.0, (n_samples, plan.n_channels))
+    start = time.perf_counter()
+    expected = engine.score(reflectance, plan, drop_empty=True)
+    separate = time.perf_counter() - start
+    start = time.perf_counter()
+    merged = dag.score(reflectance, drop_empty=True)
+    shared = time.perf_counter() - start
+    identical = expected.keys() == merged.keys() and all(
+        np.array_equal(expected[name], merged[name], equal_nan=True) for name in expected)
+    print(f"⏱️ {n_samples:,} samples: per index {separate * 1000:.1f} ms, DAG {shared * 1000:.1f} ms")
+    print("✅ Results identical" if identical else "❌ Results differ")
+
+
+if __name__ == "__main__":
+    main()
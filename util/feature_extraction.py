@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Vectorized Channel Mask Feature Extraction
+
+The R helpers extract_feature_wavelengths(), extract_feature_fwhm() and
+process_sensor_values_with_splitting() walk the LED x sensor matrix of every
+scan with nested loops. Since the channel mask and the wavelengths are fixed
+per sensor head, this module compiles them once into a FeaturePlan and then
+extracts the features of a whole (n_samples, n_leds, n_sensors) batch with a
+single gather (flattened mode) or a single masked segment mean (averaging
+modes):
+
+- flattened (no averaging): every mask > 0 entry in LED-major order, with the
+  wavelength and FWHM of its LED
+- binary (averaging, mask values 0/1): mean over the active sensors of each
+  LED, at the LED wavelength
+- mixed (averaging, mask values > 1): one binary feature per LED with mask == 1
+  entries plus one feature per split entry at the sensor wavelength, sorted
+  by wavelength
+
+Means ignore missing values like mean(na.rm = TRUE).
+
+Usage: python feature_extraction.py <export.json> [--average]
+
+Requirements: pip install numpy
+"""
+
+import sys
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from scancorder_helpers import ScanCorderHelpers
+
+
+MODE_FLATTENED = 'flattened'
+MODE_BINARY = 'binary'
+MODE_MIXED = 'mixed'
+
+
+class FeaturePlan:
+    """Precomputed feature layout of one channel mask and wavelength set."""
+
+    def __init__(self, mode: str, shape: Tuple[int, int], wavelengths: Optional[np.ndarray],
+                 fwhm: Optional[np.ndarray], gather: Optional[np.ndarray] = None,
+                 weights: Optional[np.ndarray] = None, empty: Optional[np.ndarray] = None,
+                 led_indices: Optional[np.ndarray] = None, sensor_indices: Optional[np.ndarray] = None):
+        self.mode = mode
+        # (n_leds, n_sensors) the plan was compiled for
+        self.shape = shape
+        self.wavelengths = wavelengths
+        self.fwhm = fwhm
+        # Flattened mode: positions in the flattened LED x sensor matrix
+        self.gather = gather
+        # Averaging modes: (n_leds * n_sensors, n_features) 0/1 membership matrix
+        self.weights = weights
+        # Features without any active sensor (0 in the R helper)
+        self.empty = empty
+        # LED / sensor (-1: binary feature) of every feature
+        self.led_indices = led_indices
+        self.sensor_indices = sensor_indices
+
+    @property
+    def n_features(self) -> int:
+        return len(self.gather) if self.gather is not None else self.weights.shape[1]
+
+    def apply(self, sensor_values) -> np.ndarray:
+        """Extract (n_samples, n_features) from (n_samples, n_leds, n_sensors) sensor values."""
+        values = np.asarray(sensor_values, dtype=np.float64)
+        if values.ndim == 2:
+            values = values[None]
+        if values.shape[1:] != self.shape:
+            raise ValueError(f"Sensor values of shape {values.shape[1:]} do not match the channel mask {self.shape}")
+        flat = values.reshape(values.shape[0], -1)
+        if self.gather is not None:
+            return flat[:, self.gather]
+        valid = ~np.isnan(flat)
+        totals = np.where(valid, flat, 0.0) @ self.weights
+        counts = valid.astype(np.float64) @ self.weights
+        with np.errstate(divide='ignore', invalid='ignore'):
+            features = totals / counts
+        features[:, self.empty] = 0.0
+        return features
+
+
+class FeatureExtractor:
+    """Compiles and caches FeaturePlans per channel mask and wavelength set."""
+
+    def __init__(self):
+        self.helpers = ScanCorderHelpers()
+        self._cache: Dict[Tuple, FeaturePlan] = {}
+
+    def _vector(self, value) -> Optional[np.ndarray]:
+        return None if value is None else self.helpers.convert_json_to_vector(value)
+
+    def compile_for_sensor(self, device_sensor_info: Optional[Dict], external_sensor_info: Optional[Dict],
+                           shape: Tuple[int, int], average_sensor_values: bool = False,
+                           channel_mask=None) -> FeaturePlan:
+        """Compile the plan for a sensor head, reading fields like the R helpers (device info first)."""
+        def field(*names):
+            for name in names:
+                value = self.helpers.get_field_base(device_sensor_info, external_sensor_info, name)
+                if value is not None:
+                    return value
+            return None
+
+        if channel_mask is None:
+            channel_mask = field('channel_mask')
+        if channel_mask is None:
+            # Default mask of extract_channel_mask(): every sensor active for every LED
+            led_wl = field('led_wl')
+            channel_mask = np.ones((len(led_wl) if led_wl is not None else shape[1], shape[1]))
+        channel_mask = self.helpers.convert_json_to_matrix(channel_mask)
+        if channel_mask.shape[1] != shape[1]:
+            raise ValueError(f"Channel mask number of sensors ({channel_mask.shape[1]}) does not match "
+                             f"sensor values number of sensors ({shape[1]})")
+        return self.compile(channel_mask,
+                            led_wavelengths=self._vector(field('led_wl_real', 'led_wl')),
+                            sensor_wavelengths=self._vector(field('sensor_wl')),
+                            led_fwhm=self._vector(field('led_fwhm_real', 'led_fwhm_nom')),
+                            sensor_fwhm=self._vector(field('sensor_fwhm_nom')),
+                            average_sensor_values=average_sensor_values)
+
+    def compile(self, channel_mask, led_wavelengths: Optional[np.ndarray] = None,
+                sensor_wavelengths: Optional[np.ndarray] = None, led_fwhm: Optional[np.ndarray] = None,
+                sensor_fwhm: Optional[np.ndarray] = None, average_sensor_values: bool = False) -> FeaturePlan:
+        """Return the (cached) FeaturePlan for a channel mask and its wavelength/FWHM vectors."""
+        mask = np.asarray(channel_mask, dtype=np.float64)
+        vectors = [led_wavelengths, sensor_wavelengths, led_fwhm, sensor_fwhm]
+        vectors = [None if v is None else np.asarray(v, dtype=np.float64).ravel() for v in vectors]
+        key = (mask.shape, mask.tobytes(), bool(average_sensor_values)) + \
+            tuple(None if v is None else v.tobytes() for v in vectors)
+        plan = self._cache.get(key)
+        if plan is None:
+            plan = self._cache[key] = self._build(mask, *vectors, average_sensor_values)
+        return plan
+
+    def _build(self, mask: np.ndarray, led_wavelengths: Optional[np.ndarray], sensor_wavelengths: Optional[np.ndarray],
+               led_fwhm: Optional[np.ndarray], sensor_fwhm: Optional[np.ndarray],
+               average_sensor_values: bool) -> FeaturePlan:
+        n_leds, n_sensors = mask.shape
+
+        def pick(vector: Optional[np.ndarray], positions: np.ndarray) -> Optional[np.ndarray]:
+            # Out-of-range positions are NA like R vector indexing
+            if vector is None:
+                return None
+            result = np.full(len(positions), np.nan)
+            inside = positions < len(vector)
+            result[inside] = vector[positions[inside]]
+            return result
+
+        if not average_sensor_values:
+            # mask > 0 entries in LED-major order, each at its LED wavelength
+            led_indices, sensor_indices = np.nonzero(mask > 0)
+            return FeaturePlan(MODE_FLATTENED, mask.shape, pick(led_wavelengths, led_indices),
+                               pick(led_fwhm, led_indices),
+                               gather=np.ravel_multi_index((led_indices, sensor_indices), mask.shape),
+                               led_indices=led_indices, sensor_indices=sensor_indices)
+
+        if not (mask > 1).any():
+            # One feature per LED wavelength: mean over the LED's active sensors
+            n_features = n_leds if led_wavelengths is None else len(led_wavelengths)
+            if n_features > n_leds:
+                raise ValueError(f"{n_features} LED wavelengths but only {n_leds} channel mask rows")
+            weights = np.zeros((n_leds * n_sensors, n_features))
+            weights[np.arange(n_features * n_sensors), np.repeat(np.arange(n_features), n_sensors)] = \
+                (mask[:n_features] > 0).ravel()
+            return FeaturePlan(MODE_BINARY, mask.shape, led_wavelengths, led_fwhm, weights=weights,
+                               empty=weights.sum(axis=0) == 0, led_indices=np.arange(n_features),
+                               sensor_indices=np.full(n_features, -1))
+
+        if sensor_wavelengths is None:
+            raise ValueError("Channel mask splitting requires sensor wavelengths")
+        led_indices = []
+        sensor_indices = []
+        for led in range(n_leds):
+            if (mask[led] == 1).any():
+                led_indices.append(led)
+                sensor_indices.append(-1)
+            for sensor in np.flatnonzero(mask[led] > 1):
+                led_indices.append(led)
+                sensor_indices.append(int(sensor))
+        led_indices = np.asarray(led_indices, dtype=np.intp)
+        sensor_indices = np.asarray(sensor_indices, dtype=np.intp)
+        binary = sensor_indices < 0
+        wavelengths = np.where(binary, pick(led_wavelengths, led_indices) if led_wavelengths is not None else np.nan,
+                               pick(sensor_wavelengths, np.maximum(sensor_indices, 0)))
+        fwhm = None
+        if led_fwhm is not None or sensor_fwhm is not None:
+            led_part = pick(led_fwhm, led_indices) if led_fwhm is not None else np.full(len(led_indices), np.nan)
+            sensor_part = pick(sensor_fwhm, np.maximum(sensor_indices, 0)) if sensor_fwhm is not None \
+                else np.full(len(led_indices), np.nan)
+            fwhm = np.where(binary, led_part, sensor_part)
+        # order() is stable and puts NA last, as does a stable argsort
+        order = np.argsort(wavelengths, kind='stable')
+        led_indices = led_indices[order]
+        sensor_indices = sensor_indices[order]
+        weights = np.zeros((n_leds * n_sensors, len(order)))
+        for feature, (led, sensor) in enumerate(zip(led_indices, sensor_indices)):
+            if sensor < 0:
+                weights[led * n_sensors + np.flatnonzero(mask[led] == 1), feature] = 1.0
+            else:
+                weights[led * n_sensors + sensor, feature] = 1.0
+        return FeaturePlan(MODE_MIXED, mask.shape, wavelengths[order], None if fwhm is None else fwhm[order],
+                           weights=weights, empty=np.zeros(len(order), dtype=bool),
+                           led_indices=led_indices, sensor_indices=sensor_indices)
+
+
+def main():
+    """Decode and calibrate an export, then extract its features batch by batch."""
+    if len(sys.argv) < 2:
+        print("Usage: python feature_extraction.py <export.json> [--average]")
+        print("\nExample: python feature_extraction.py ../example/data/Compolytics_R-Package_VI_Test_File.json --average")
+        print("\nRequirements:")
+        print("  pip install numpy")
+        sys.exit(1)
+    from calibration import calibrate_batch
+    from scancorder_regular_decode import RegularScannerStreamDecoder
+    from sensor_registry import get_registry
+    average = '--average' in sys.argv[2:]
+    extractor = FeatureExtractor()
+    registry = get_registry()
+    for batch in RegularScannerStreamDecoder().iter_batches(Path(sys.argv[1])):
+        external = registry.find_sensor_metadata(batch.sensor_name) if batch.sensor_name else None
+        plan = extractor.compile_for_sensor(batch.device_sensor_info, external, batch.values.shape[1:], average)
+        features = plan.apply(calibrate_batch(batch))
+        wavelengths = '-' if plan.wavelengths is None else ', '.join(f"{w:g}" for w in plan.wavelengths)
+        print(f"📦 Batch at sample {batch.sample_offset}: {plan.mode} mode, features {features.shape}")
+        print(f"   wavelengths: {wavelengths}")
+    print("\n✅ Feature extraction finished")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,23 +5,45 @@ XML Spectral Index to PNG Image Generator
 This script reads XML files containing spectral index definitions and generates
 PNG images showing the mathematical formula and variable descriptions.
 
-Usage: python generate_indices_images.py <path_to_xml_folder>
+Images can be rendered by a pool of worker processes (--workers) and, with
+--incremental, only XML files whose content changed since the previous run
+(according to the manifest stored in the images directory) are re-rendered.
+
+Usage: python generate_indices_images.py <path_to_xml_folder> [--workers N] [--incremental]
 
 Requirements: pip install sympy matplotlib
 """
 
+import argparse
 import os
 import sys
 import xml.etree.ElementTree as ET
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
+from build_manifest import BuildManifest
 from mathml_converter import MathMLConverter
 
+# Bump whenever the image layout changes so incremental builds re-render everything
+RENDERER_VERSION = "1"
+MANIFEST_NAME = ".images_manifest.json"
+
 class SpectralIndexProcessor:
     """Processes spectral index XML files and generates PNG images."""
     def __init__(self):
         self.mathml_converter = MathMLConverter()
+        self._figure = None
+
+    def _get_figure(self):
+        """Create the drawing figure once and reuse it for every image."""
+        if self._figure is None:
+            # matplotlib is only imported once an image is actually drawn
+            import matplotlib.pyplot as plt
+            plt.rcParams['figure.dpi'] = 300
+            plt.rcParams['savefig.dpi'] = 300
+            plt.rcParams['text.usetex'] = False
+            self._figure = plt.figure(figsize=(14, 10))
+        return self._figure
 
     def parse_xml_file(self, xml_file_path: Path) -> Dict:
         """Parse XML file and extract relevant information."""
@@ -89,10 +111,11 @@ class SpectralIndexProcessor:
         return None
 
     def create_formula_image(self, xml_data: Dict, output_path: Path, error_message: str = None):
-        plt.rcParams['figure.dpi'] = 300
-        plt.rcParams['savefig.dpi'] = 300
-        plt.rcParams['text.usetex'] = False
-        fig, ax = plt.subplots(figsize=(14, 10))
+        fig = self._get_figure()
+        # Cleared first: a formula that failed inside savefig leaves its artists on the shared figure
+        fig.clf()
+        from matplotlib.patches import Circle, Rectangle
+        ax = fig.add_subplot()
         ax.set_xlim(0, 10)
         ax.set_ylim(0, 8)
         ax.axis('off')
@@ -101,10 +124,10 @@ class SpectralIndexProcessor:
             error_lines = self._wrap_text(error_message, 60)
             error_text = '\n'.join(error_lines)
             ax.text(5, 4, error_text, ha='center', va='center', fontsize=14, color='black', bbox=dict(boxstyle="round,pad=1.0", facecolor="mistyrose", alpha=0.9, edgecolor='red', linewidth=2))
-            border = plt.Rectangle((0.1, 0.1), 9.8, 7.8, linewidth=3, edgecolor='red', facecolor='none', alpha=0.7)
+            border = Rectangle((0.1, 0.1), 9.8, 7.8, linewidth=3, edgecolor='red', facecolor='none', alpha=0.7)
             ax.add_patch(border)
-            plt.savefig(output_path, dpi=300, bbox_inches='tight', facecolor='white', edgecolor='none', pad_inches=0.3)
-            plt.close()
+            fig.savefig(output_path, dpi=300, bbox_inches='tight', facecolor='white', edgecolor='none', pad_inches=0.3)
+            fig.clf()
             print(f"✗ Error image generated: {output_path.name}")
             return
         title = f"{xml_data['name']} Index"
@@ -128,14 +151,14 @@ class SpectralIndexProcessor:
             variables_text = '\n'.join(xml_data['bands_info'])
             full_variables_text = f"{variables_title}\n{variables_text}"
             ax.text(5, 2.2, full_variables_text, ha='center', va='center', fontsize=11, bbox=dict(boxstyle="round,pad=0.6", facecolor="lightblue", alpha=0.8, edgecolor='blue', linewidth=1))
-        border = plt.Rectangle((0.1, 0.1), 9.8, 7.8, linewidth=3, edgecolor='navy', facecolor='none', alpha=0.7)
+        border = Rectangle((0.1, 0.1), 9.8, 7.8, linewidth=3, edgecolor='navy', facecolor='none', alpha=0.7)
         ax.add_patch(border)
         corner_size = 0.3
         for x, y in [(0.1, 0.1), (9.9, 0.1), (0.1, 7.9), (9.9, 7.9)]:
-            corner = plt.Circle((x, y), corner_size/2, color='navy', alpha=0.3)
+            corner = Circle((x, y), corner_size/2, color='navy', alpha=0.3)
             ax.add_patch(corner)
-        plt.savefig(output_path, dpi=300, bbox_inches='tight', facecolor='white', edgecolor='none', pad_inches=0.3)
-        plt.close()
+        fig.savefig(output_path, dpi=300, bbox_inches='tight', facecolor='white', edgecolor='none', pad_inches=0.3)
+        fig.clf()
         print(f"✓ Generated: {output_path.name}")
 
     def _wrap_text(self, text: str, width: int) -> List[str]:
@@ -156,14 +179,46 @@ class SpectralIndexProcessor:
             lines.append(' '.join(current_line))
         return lines
 
+_worker_processor = None
+
+def _init_worker():
+    """Create one processor (and figure) per worker process."""
+    global _worker_processor
+    _worker_processor = SpectralIndexProcessor()
+
+def render_xml_file(xml_file: Path, output_path: Path, processor: Optional[SpectralIndexProcessor] = None) -> Tuple[Path, Optional[str]]:
+    """Render one XML file to PNG, returning the file and the error message if it failed."""
+    if processor is None:
+        processor = _worker_processor
+    print(f"\n🔄 Processing: {xml_file.name}")
+    try:
+        xml_data = processor.parse_xml_file(xml_file)
+        processor.create_formula_image(xml_data, output_path)
+        return xml_file, None
+    except Exception as e:
+        print(f"❌ Error processing {xml_file.name}: {e}")
+        processor.create_formula_image({}, output_path, error_message=str(e))
+        return xml_file, str(e)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Generate PNG images for spectral index XML files.")
+    parser.add_argument("xml_folder", help="path to the folder containing the index XML files")
+    parser.add_argument("--output-dir", default="images", help="folder for the generated images (default: images)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, 0 uses all CPU cores (default: 1)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only re-render XML files that changed since the previous run")
+    return parser.parse_args()
+
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python generate_indices_images.py <path_to_xml_folder>")
-        print("\nExample: python generate_indices_images.py ./spectral_indices/")
+    if len(sys.argv) < 2:
+        print("Usage: python generate_indices_images.py <path_to_xml_folder> [--workers N] [--incremental]")
+        print("\nExample: python generate_indices_images.py ./spectral_indices/ --workers 8 --incremental")
         print("\nRequirements:")
         print("  pip install sympy matplotlib")
         sys.exit(1)
-    xml_folder_path = sys.argv[1]
+    args = parse_arguments()
+    xml_folder_path = args.xml_folder
     xml_path = Path(xml_folder_path)
     try:
         import sympy
@@ -178,30 +233,49 @@ def main():
     if not xml_path.is_dir():
         print(f"❌ Error: '{xml_folder_path}' is not a directory")
         sys.exit(1)
-    images_dir = Path("images")
+    images_dir = Path(args.output_dir)
     images_dir.mkdir(exist_ok=True)
     print(f"📁 Created/using images directory: {images_dir.absolute()}")
-    xml_files = list(xml_path.glob("*.xml"))
+    xml_files = sorted(xml_path.glob("*.xml"))
     if not xml_files:
         print(f"❌ No XML files found in '{xml_folder_path}'")
         sys.exit(1)
     print(f"📄 Found {len(xml_files)} XML files")
-    processor = SpectralIndexProcessor()
+    manifest = BuildManifest(images_dir / MANIFEST_NAME, RENDERER_VERSION)
+    if args.incremental:
+        manifest.load()
+    for removed in manifest.prune(xml_files):
+        stale_image = images_dir / f"{Path(removed).stem}.png"
+        if stale_image.exists():
+            stale_image.unlink()
+        print(f"🗑️ Removed image of deleted file: {removed}")
+    hashes = {xml_file: manifest.content_hash(xml_file) for xml_file in xml_files}
+    pending = [xml_file for xml_file in xml_files
+               if not (args.incremental and manifest.is_current(xml_file, hashes[xml_file], images_dir / f"{xml_file.stem}.png"))]
+    skipped_count = len(xml_files) - len(pending)
+    if skipped_count:
+        print(f"⏭️ Skipping {skipped_count} unchanged files")
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    jobs = [(xml_file, images_dir / f"{xml_file.stem}.png") for xml_file in pending]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            results = list(executor.map(render_xml_file, *zip(*jobs)))
+    else:
+        processor = SpectralIndexProcessor()
+        results = [render_xml_file(xml_file, output_path, processor) for xml_file, output_path in jobs]
     success_count = 0
     error_count = 0
-    for xml_file in xml_files:
-        print(f"\n🔄 Processing: {xml_file.name}")
-        output_path = images_dir / f"{xml_file.stem}.png"
-        try:
-            xml_data = processor.parse_xml_file(xml_file)
-            processor.create_formula_image(xml_data, output_path)
+    for xml_file, error in results:
+        if error is None:
+            manifest.update(xml_file, hashes[xml_file], output=f"{xml_file.stem}.png")
             success_count += 1
-        except Exception as e:
-            print(f"❌ Error processing {xml_file.name}: {e}")
-            processor.create_formula_image({}, output_path, error_message=str(e))
+        else:
             error_count += 1
+    manifest.save()
     print(f"\n{'='*60}")
     print(f"✅ Successfully processed: {success_count} files")
+    if skipped_count:
+        print(f"⏭️ Unchanged: {skipped_count} files")
     if error_count > 0:
         print(f"❌ Errors: {error_count} files")
     print(f"📁 Images saved to: {images_dir.absolute()}")
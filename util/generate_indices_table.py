@@ -7,18 +7,28 @@ an Excel table with columns for VIs Name, Abbreviation Algorithm, Alternative na
 Wavelengths used, Algorithm formula, and additional metadata fields (Application Group, 
 Application Molecular Target, Application Subtarget, Species, Reference, Additional Information).
 
-Usage: python generate_indices_table.py <path_to_xml_folder> [output_file.xlsx]
+XML files can be parsed by a pool of worker processes (--workers) and, with
+--incremental, rows of XML files that did not change since the previous run
+are taken from the manifest stored next to the output file.
+
+Usage: python generate_indices_table.py <path_to_xml_folder> [output_file.xlsx] [--workers N] [--incremental]
 
 Requirements: pip install sympy pandas openpyxl
 """
 
+import argparse
+import os
 import sys
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict
-import pandas as pd
+from typing import Dict, Optional, Tuple
+from build_manifest import BuildManifest
 from mathml_converter import MathMLConverter
 
+# Bump whenever the row layout changes so incremental builds re-parse everything
+RENDERER_VERSION = "1"
+
 
 class SpectralIndexTableGenerator:
     """Generates Excel table from spectral index XML files."""
@@ -181,72 +191,99 @@ class SpectralIndexTableGenerator:
         
         return None
     
-    def generate_excel_table(self, xml_folder_path: Path, output_file: Path = None):
+    def build_table_row(self, xml_file: Path) -> Tuple[Dict, Optional[str]]:
+        """Build the table row of one XML file, returning the row and the error message if it failed."""
+        try:
+            print(f"🔄 Processing: {xml_file.name}")
+            xml_data = self.parse_xml_file(xml_file)
+            return {
+                'VIs Name': xml_data['vis_name'],
+                'Abbreviation Algorithm': xml_data['abbreviation'],
+                'Alternative Names': xml_data['alternative_names'],
+                'Wavelengths Used': xml_data['wavelengths'],
+                'Algorithm': xml_data['algorithm'],
+                'Application Group': xml_data['application_group'],
+                'Application Molecular Target': xml_data['application_molecular_target'],
+                'Application Subtarget': xml_data['application_subtarget'],
+                'Species': xml_data['species'],
+                'Reference': xml_data['reference'],
+                'Additional Information': xml_data['additional_information']
+            }, None
+        except Exception as e:
+            print(f"❌ Error processing {xml_file.name}: {e}")
+            # Add error entry to maintain complete records
+            return {
+                'VIs Name': f"Error: {xml_file.stem}",
+                'Abbreviation Algorithm': xml_file.stem.upper(),
+                'Alternative Names': "",
+                'Wavelengths Used': "",
+                'Algorithm': f"Error: {str(e)}",
+                'Application Group': "",
+                'Application Molecular Target': "",
+                'Application Subtarget': "",
+                'Species': "",
+                'Reference': "",
+                'Additional Information': ""
+            }, str(e)
+
+    def generate_excel_table(self, xml_folder_path: Path, output_file: Path = None,
+                             workers: int = 1, incremental: bool = False):
         """Generate Excel table from all XML files in the folder."""
         if output_file is None:
             output_file = Path("spectral_indices_table.xlsx")
         
         # Find all XML files
-        xml_files = list(xml_folder_path.glob("*.xml"))
+        xml_files = sorted(xml_folder_path.glob("*.xml"))
         if not xml_files:
             raise ValueError(f"No XML files found in '{xml_folder_path}'")
         
         print(f"📄 Found {len(xml_files)} XML files")
-        
-        # Process all files
+
+        # Reuse rows of unchanged files from the previous run
+        manifest = BuildManifest(output_file.parent / f".{output_file.stem}.manifest.json", RENDERER_VERSION)
+        if incremental:
+            manifest.load()
+        manifest.prune(xml_files)
+        hashes = {xml_file: manifest.content_hash(xml_file) for xml_file in xml_files}
+        rows = {}
+        for xml_file in xml_files:
+            if incremental and manifest.is_current(xml_file, hashes[xml_file]):
+                rows[xml_file] = (manifest.get(xml_file)['row'], None)
+        skipped_count = len(rows)
+        if skipped_count:
+            print(f"⏭️ Reusing {skipped_count} unchanged rows")
+
+        # Process all changed files
+        pending = [xml_file for xml_file in xml_files if xml_file not in rows]
+        workers = workers if workers > 0 else (os.cpu_count() or 1)
+        if workers > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                rows.update(zip(pending, executor.map(_build_table_row, pending)))
+        else:
+            rows.update((xml_file, self.build_table_row(xml_file)) for xml_file in pending)
+
         table_data = []
         success_count = 0
         error_count = 0
-        
         for xml_file in xml_files:
-            try:
-                print(f"🔄 Processing: {xml_file.name}")
-                xml_data = self.parse_xml_file(xml_file)
-                table_data.append({
-                    'VIs Name': xml_data['vis_name'],
-                    'Abbreviation Algorithm': xml_data['abbreviation'],
-                    'Alternative Names': xml_data['alternative_names'],
-                    'Wavelengths Used': xml_data['wavelengths'],
-                    'Algorithm': xml_data['algorithm'],
-                    'Application Group': xml_data['application_group'],
-                    'Application Molecular Target': xml_data['application_molecular_target'],
-                    'Application Subtarget': xml_data['application_subtarget'],
-                    'Species': xml_data['species'],
-                    'Reference': xml_data['reference'],
-                    'Additional Information': xml_data['additional_information']
-                })
+            row, error = rows[xml_file]
+            table_data.append(row)
+            if error is None:
+                manifest.update(xml_file, hashes[xml_file], row=row)
                 success_count += 1
-            except Exception as e:
-                print(f"❌ Error processing {xml_file.name}: {e}")
+            else:
                 error_count += 1
-                # Add error entry to maintain complete records
-                table_data.append({
-                    'VIs Name': f"Error: {xml_file.stem}",
-                    'Abbreviation Algorithm': xml_file.stem.upper(),
-                    'Alternative Names': "",
-                    'Wavelengths Used': "",
-                    'Algorithm': f"Error: {str(e)}",
-                    'Application Group': "",
-                    'Application Molecular Target': "",
-                    'Application Subtarget': "",
-                    'Species': "",
-                    'Reference': "",
-                    'Additional Information': ""
-                })
+        manifest.save()
         
-        # Create DataFrame and sort by Abbreviation Algorithm
+        # Create DataFrame and sort by Abbreviation Algorithm (pandas is only needed here)
+        import pandas as pd
         df = pd.DataFrame(table_data)
         df = df.sort_values('Abbreviation Algorithm')
         
-        # Save to Excel
-        df.to_excel(output_file, index=False, engine='openpyxl')
-
-        # Set worksheet name and larger column widths using openpyxl
-        try:
-            from openpyxl import load_workbook
-            wb = load_workbook(output_file)
-            ws = wb.active
-            ws.title = 'Spectral Indices'
+        # Save to Excel, setting sheet name and column widths before the workbook is written
+        with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
+            df.to_excel(writer, index=False, sheet_name='Spectral Indices')
+            ws = writer.sheets['Spectral Indices']
             # Define custom widths for each column (adjust as needed)
             col_widths = {
                 'A': 56,  # VIs Name
@@ -263,13 +300,12 @@ class SpectralIndexTableGenerator:
             }
             for col, width in col_widths.items():
                 ws.column_dimensions[col].width = width
-            wb.save(output_file)
-        except Exception as e:
-            print(f"⚠️ Could not set column widths or sheet name: {e}")
 
         # Summary
         print(f"\n{'='*60}")
         print(f"✅ Successfully processed: {success_count} files")
+        if skipped_count:
+            print(f"⏭️ Unchanged: {skipped_count} files")
         if error_count > 0:
             print(f"❌ Errors: {error_count} files")
         print(f"📊 Excel table saved to: {output_file.absolute()}")
@@ -279,22 +315,39 @@ class SpectralIndexTableGenerator:
         return df
 
 
+def _build_table_row(xml_file: Path) -> Tuple[Dict, Optional[str]]:
+    """Worker process entry point for building one table row."""
+    return SpectralIndexTableGenerator().build_table_row(xml_file)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Generate an Excel table of spectral index XML files.")
+    parser.add_argument("xml_folder", help="path to the folder containing the index XML files")
+    parser.add_argument("output_file", nargs="?", default=None, help="Excel output file (default: spectral_indices_table.xlsx)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, 0 uses all CPU cores (default: 1)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only re-parse XML files that changed since the previous run")
+    return parser.parse_args()
+
+
 def main():
     """Main function to generate Excel table from XML files."""
     if len(sys.argv) < 2:
-        print("Usage: python generate_indices_table.py <path_to_xml_folder> [output_file.xlsx]")
+        print("Usage: python generate_indices_table.py <path_to_xml_folder> [output_file.xlsx] [--workers N] [--incremental]")
         print("\nExample: python generate_indices_table.py ../inst/extdata/indices/")
         print("\nRequirements:")
         print("  pip install sympy pandas openpyxl")
         sys.exit(1)
     
-    xml_folder_path = sys.argv[1]
+    args = parse_arguments()
+    xml_folder_path = args.xml_folder
     xml_path = Path(xml_folder_path)
     
     # Optional output file
     output_file = None
-    if len(sys.argv) >= 3:
-        output_file = Path(sys.argv[2])
+    if args.output_file is not None:
+        output_file = Path(args.output_file)
     
     # Check dependencies
     try:
@@ -318,7 +371,7 @@ def main():
     # Generate table
     generator = SpectralIndexTableGenerator()
     try:
-        df = generator.generate_excel_table(xml_path, output_file)
+        df = generator.generate_excel_table(xml_path, output_file, workers=args.workers, incremental=args.incremental)
         print(f"\n📈 Preview of generated table:")
         print(df.head().to_string())
     except Exception as e:
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Tiled Index Rasters for Multispectral Image Cubes
+
+Scores (rows, cols, bands) reflectance cubes pixel by pixel with the index
+catalogue and writes one raster per selected index. The cube is read through
+a memory map in tiles of --tile x --tile pixels, so memory stays bounded by
+the tile size times the number of workers whatever the image size. Tiles are
+scored on a pool of worker processes that write straight into memory-mapped
+output rasters. All pixels share the cube's wavelength grid, so bands are
+resolved once per cube: every worker builds the BandPlan and the DAG of the
+selected indices on its first tile and reuses them for all others.
+
+Input formats:
+
+- ENVI: a .hdr header (samples, lines, bands, data type, interleave
+  bsq/bil/bip, byte order, header offset, wavelength, fwhm and optionally
+  wavelength units, reflectance scale factor, data ignore value) next to the
+  raw data file (the header name without extension, or with .raw, .img,
+  .dat, .bsq, .bil or .bip)
+- .npy: a (rows, cols, bands) array, with the grid from a .hdr sidecar of the
+  same name or from --sensor
+- --sensor takes wavelengths, FWHM and valid_vi from the sensor registry for
+  either format, like reflectance lists
+
+Output: <output_dir>/<index>.npy, or with --format envi <index>.img plus an
+ENVI header; float32 unless --dtype float64. Characters other than letters,
+digits, '.', '_' and '-' in index names become '_' in file names.
+
+Usage: python image_cube.py <cube.hdr | cube.npy> <output_dir> [--indices NDVI,ARI] [--sensor S8330]
+           [--tile 256] [--workers N] [--format npy|envi]
+
+Requirements: pip install numpy
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from index_catalogue import default_artifact_path, load_catalogue
+from reflectance_list_reader import reflectance_list_grid
+from score_exports import DEFAULT_XML_FOLDER, ExportScorer
+from sensor_registry import DEFAULT_SENSORS_DIRECTORY, get_registry
+
+
+DEFAULT_TILE_SIZE = 256
+ENVI_DATA_TYPES = {1: 'u1', 2: 'i2', 3: 'i4', 4: 'f4', 5: 'f8', 12: 'u2', 13: 'u4', 14: 'i8', 15: 'u8'}
+ENVI_DATA_SUFFIXES = ('', '.raw', '.img', '.dat', '.bsq', '.bil', '.bip')
+# Wavelength units converted to nm
+WAVELENGTH_SCALES = {'nanometers': 1.0, 'nm': 1.0, 'micrometers': 1000.0, 'um': 1000.0, 'µm': 1000.0}
+
+
+def read_envi_header(header_file: Path) -> Dict[str, object]:
+    """Parse an ENVI header into lower-case keys; {a, b, c} values become lists of strings."""
+    with open(header_file, 'r', encoding='utf-8', errors='replace') as f:
+        text = f.read()
+    if not text.lstrip().startswith('ENVI'):
+        raise ValueError(f"{header_file} is not an ENVI header")
+    header = {}
+    for match in re.finditer(r'^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)', text, re.MULTILINE):
+        key = match.group(1).strip().lower()
+        value = match.group(2).strip()
+        if value.startswith('{'):
+            header[key] = [item.strip() for item in value[1:-1].split(',') if item.strip()]
+        else:
+            header[key] = value
+    return header
+
+
+def write_envi_header(header_file: Path, rows: int, cols: int, bands: int, dtype: np.dtype,
+                      interleave: str = 'bsq', wavelengths: Optional[Sequence[float]] = None,
+                      fwhm: Optional[Sequence[float]] = None, band_names: Optional[Sequence[str]] = None):
+    dtype = np.dtype(dtype)
+    codes = {np.dtype(code): number for number, code in ENVI_DATA_TYPES.items()}
+    lines = ['ENVI', f'samples = {cols}', f'lines = {rows}', f'bands = {bands}', 'header offset = 0',
+             'file type = ENVI Standard', f'data type = {codes[dtype.newbyteorder("=")]}',
+             f'interleave = {interleave}', f'byte order = {1 if dtype.byteorder == ">" else 0}']
+    if wavelengths is not None:
+        lines += ['wavelength units = Nanometers', f"wavelength = {{{', '.join(f'{w:g}' for w in wavelengths)}}}"]
+    if fwhm is not None:
+        lines.append(f"fwhm = {{{', '.join(f'{w:g}' for w in fwhm)}}}")
+    if band_names is not None:
+        lines.append(f"band names = {{{', '.join(band_names)}}}")
+    with open(header_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def _header_grid(header: Dict) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+    scale = WAVELENGTH_SCALES.get(str(header.get('wavelength units', 'nanometers')).lower(), 1.0)
+    grid = []
+    for key in ('wavelength', 'fwhm'):
+        values = header.get(key)
+        grid.append(None if values is None else np.asarray([float(v) for v in values]) * scale)
+    return grid[0], grid[1]
+
+
+class ImageCube:
+    """Memory-mapped image cube read as (n_pixels, bands) float64 tiles."""
+
+    def __init__(self, data: np.ndarray, interleave: str, wavelengths: Optional[np.ndarray],
+                 fwhm: Optional[np.ndarray], scale_factor: Optional[float] = None,
+                 ignore_value: Optional[float] = None):
+        if interleave not in ('bsq', 'bil', 'bip'):
+            raise ValueError(f"Unsupported interleave: {interleave}")
+        # bsq: (bands, rows, cols), bil: (rows, bands, cols), bip: (rows, cols, bands)
+        self.data = data
+        self.interleave = interleave
+        self.wavelengths = wavelengths
+        self.fwhm = fwhm
+        self.scale_factor = scale_factor
+        self.ignore_value = ignore_value
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        """(rows, cols, bands)"""
+        if self.interleave == 'bsq':
+            bands, rows, cols = self.data.shape
+        elif self.interleave == 'bil':
+            rows, bands, cols = self.data.shape
+        else:
+            rows, cols, bands = self.data.shape
+        return rows, cols, bands
+
+    def tile(self, row_start: int, row_stop: int, col_start: int, col_stop: int) -> np.ndarray:
+        """Reflectance of the pixels of a tile, row by row, as (n_pixels, bands) float64."""
+        if self.interleave == 'bip':
+            block = self.data[row_start:row_stop, col_start:col_stop, :]
+        elif self.interleave == 'bil':
+            block = self.data[row_start:row_stop, :, col_start:col_stop].transpose(0, 2, 1)
+        else:
+            block = self.data[:, row_start:row_stop, col_start:col_stop].transpose(1, 2, 0)
+        # Only this copy of the tile is held in memory
+        pixels = np.array(block, dtype=np.float64).reshape(-1, block.shape[-1])
+        if self.ignore_value is not None:
+            pixels[pixels == self.ignore_value] = np.nan
+        if self.scale_factor:
+            pixels /= self.scale_factor
+        return pixels
+
+
+def open_image_cube(cube_file: Path) -> ImageCube:
+    """Memory-map an ENVI cube (header or data file) or a (rows, cols, bands) .npy array."""
+    cube_file = Path(cube_file)
+    if cube_file.suffix.lower() == '.npy':
+        data = np.load(cube_file, mmap_mode='r')
+        if data.ndim != 3:
+            raise ValueError(f"Expected a (rows, cols, bands) array, got shape {data.shape}")
+        header_file = cube_file.with_suffix('.hdr')
+        header = read_envi_header(header_file) if header_file.exists() else {}
+        wavelengths, fwhm = _header_grid(header)
+        return ImageCube(data, 'bip', wavelengths, fwhm, _optional_float(header, 'reflectance scale factor'),
+                         _optional_float(header, 'data ignore value'))
+
+    header_file = cube_file if cube_file.suffix.lower() == '.hdr' else cube_file.with_suffix('.hdr')
+    if not header_file.exists():
+        raise ValueError(f"No ENVI header found for {cube_file}")
+    header = read_envi_header(header_file)
+    data_file = cube_file if cube_file != header_file else None
+    if data_file is None:
+        candidates = [header_file.with_suffix(suffix) for suffix in ENVI_DATA_SUFFIXES]
+        data_file = next((path for path in candidates if path.is_file()), None)
+        if data_file is None:
+            raise ValueError(f"No data file found next to {header_file}")
+    try:
+        rows, cols, bands = int(header['lines']), int(header['samples']), int(header['bands'])
+        data_type = ENVI_DATA_TYPES[int(header['data type'])]
+    except KeyError as e:
+        raise ValueError(f"ENVI header {header_file} lacks or has an unsupported {e}")
+    dtype = np.dtype(('>' if str(header.get('byte order', '0')) == '1' else '<') + data_type)
+    interleave = str(header.get('interleave', 'bsq')).lower()
+    shapes = {'bsq': (bands, rows, cols), 'bil': (rows, bands, cols), 'bip': (rows, cols, bands)}
+    if interleave not in shapes:
+        raise ValueError(f"Unsupported interleave: {interleave}")
+    data = np.memmap(data_file, dtype=dtype, mode='r', offset=int(header.get('header offset', 0)),
+                     shape=shapes[interleave])
+    wavelengths, fwhm = _header_grid(header)
+    return ImageCube(data, interleave, wavelengths, fwhm, _optional_float(header, 'reflectance scale factor'),
+                     _optional_float(header, 'data ignore value'))
+
+
+def _optional_float(header: Dict, key: str) -> Optional[float]:
+    return float(header[key]) if header.get(key) not in (None, '') else None
+
+
+def cube_grid(cube: ImageCube, sensor_info: Optional[Dict]) -> Tuple[np.ndarray, np.ndarray, Optional[List[str]]]:
+    """Wavelengths, FWHM and valid_vi of a cube: from the sensor if given, else from its header."""
+    bands = cube.shape[2]
+    if sensor_info is not None:
+        header_wavelengths = cube.wavelengths if cube.wavelengths is not None else np.full(bands, np.nan)
+        wavelengths, fwhm = reflectance_list_grid(sensor_info, header_wavelengths)
+        valid_vi = sensor_info.get('valid_vi')
+    else:
+        if cube.wavelengths is None:
+            raise ValueError("The cube has no wavelength header; give the sensor serial (--sensor)")
+        wavelengths, fwhm, valid_vi = cube.wavelengths, cube.fwhm, None
+        if fwhm is None:
+            print("⚠️ FWHM not found in the header. Assuming FWHM = 1nm")
+            fwhm = np.ones(len(wavelengths))
+    if len(wavelengths) != bands:
+        raise ValueError(f"The cube has {bands} bands, but the grid has {len(wavelengths)} wavelengths")
+    return wavelengths, fwhm, valid_vi
+
+
+def raster_name(index_name: str) -> str:
+    return re.sub(r'[^A-Za-z0-9._-]', '_', index_name)
+
+
+def create_rasters(output_dir: Path, index_names: Sequence[str], rows: int, cols: int, dtype: np.dtype,
+                   output_format: str = 'npy') -> Dict[str, Path]:
+    """Create the (rows, cols) output raster files, returning the file of every index."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    files = {}
+    for name in index_names:
+        if output_format == 'envi':
+            path = output_dir / f"{raster_name(name)}.img"
+            # Sized file without writing its pages
+            with open(path, 'wb') as f:
+                f.truncate(rows * cols * np.dtype(dtype).itemsize)
+            write_envi_header(path.with_suffix('.hdr'), rows, cols, 1, np.dtype(dtype).newbyteorder('<'),
+                              band_names=[name])
+        else:
+            path = output_dir / f"{raster_name(name)}.npy"
+            # Writes the .npy header; the data pages are filled by the workers
+            np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(rows, cols)).flush()
+        files[name] = path
+    return files
+
+
+def open_raster(path: Path, rows: int, cols: int, dtype: np.dtype) -> np.ndarray:
+    """Writable memory map of an output raster created by create_rasters()."""
+    if path.suffix == '.npy':
+        return np.load(path, mmap_mode='r+')
+    return np.memmap(path, dtype=np.dtype(dtype).newbyteorder('<'), mode='r+', shape=(rows, cols))
+
+
+def plan_tiles(rows: int, cols: int, tile_size: int) -> List[Tuple[int, int, int, int]]:
+    return [(row, min(row + tile_size, rows), col, min(col + tile_size, cols))
+            for row in range(0, rows, tile_size) for col in range(0, cols, tile_size)]
+
+
+class TileScorer:
+    """Scores tiles of one cube into the output rasters (one instance per worker process)."""
+
+    def __init__(self, cube_file: Path, sensor: Optional[str], options: Dict, index_names: Sequence[str],
+                 raster_files: Dict[str, Path], dtype: str):
+        self.scorer = ExportScorer(**options)
+        self.cube = open_image_cube(cube_file)
+        sensor_info = self.scorer.registry.find_sensor_metadata(sensor) if sensor else None
+        self.wavelengths, self.fwhm, _ = cube_grid(self.cube, sensor_info)
+        self.index_names = list(index_names)
+        rows, cols, _ = self.cube.shape
+        self.rasters = {name: open_raster(path, rows, cols, np.dtype(dtype)) for name, path in raster_files.items()}
+
+    def score_tile(self, tile: Tuple[int, int, int, int]) -> int:
+        row_start, row_stop, col_start, col_stop = tile
+        pixels = self.cube.tile(row_start, row_stop, col_start, col_stop)
+        # The index list restricts the DAG to the selected indices; the plan is cached per grid
+        results = self.scorer.score_reflectance(pixels, self.wavelengths, self.fwhm, self.index_names)
+        shape = (row_stop - row_start, col_stop - col_start)
+        for name, raster in self.rasters.items():
+            values = results.get(name)
+            raster[row_start:row_stop, col_start:col_stop] = np.nan if values is None else values.reshape(shape)
+        return pixels.shape[0]
+
+    def flush(self):
+        for raster in self.rasters.values():
+            raster.flush()
+
+
+_worker_tiles: Optional[TileScorer] = None
+
+
+def _init_worker(*args):
+    global _worker_tiles
+    _worker_tiles = TileScorer(*args)
+
+
+def _score_tile(tile: Tuple[int, int, int, int]) -> int:
+    # No flush per tile: the mapped pages live in the shared page cache, sync_rasters() writes them once
+    return _worker_tiles.score_tile(tile)
+
+
+def sync_rasters(raster_files: Dict[str, Path]):
+    """Write the rasters' dirty pages to disk once every worker has finished."""
+    for path in raster_files.values():
+        fd = os.open(path, os.O_RDWR)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def select_indices(scorer: ExportScorer, wavelengths: np.ndarray, fwhm: np.ndarray,
+                   valid_vi: Optional[Sequence[str]], requested: Optional[Sequence[str]]) -> List[str]:
+    """Requested (default: all) indices that are computable on the grid and listed in valid_vi."""
+    computable = scorer.planner.plan(wavelengths, fwhm).computable_indices()
+    if valid_vi:
+        listed = set(valid_vi)
+        computable = [name for name in computable if name in listed]
+    if requested is None:
+        return computable
+    available = set(computable)
+    for name in requested:
+        if name not in available:
+            print(f"⚠️ {name}: not computable on this cube's grid, skipped")
+    return [name for name in requested if name in available]
+
+
+def score_image_cube(cube_file: Path, output_dir: Path, options: Dict, sensor: Optional[str] = None,
+                     requested: Optional[Sequence[str]] = None, tile_size: int = DEFAULT_TILE_SIZE,
+                     workers: int = 1, output_format: str = 'npy', dtype: str = 'float32') -> Dict[str, Path]:
+    """Score every pixel of a cube and write one raster per selected index."""
+    scorer = ExportScorer(**options)
+    cube = open_image_cube(cube_file)
+    rows, cols, bands = cube.shape
+    sensor_info = scorer.registry.find_sensor_metadata(sensor) if sensor else None
+    if sensor and sensor_info is None:
+        raise ValueError(f"Sensor {sensor} not found in the sensor registry")
+    wavelengths, fwhm, valid_vi = cube_grid(cube, sensor_info)
+    index_names = select_indices(scorer, wavelengths, fwhm, valid_vi, requested)
+    if not index_names:
+        raise ValueError("None of the selected indices is computable on this cube")
+    print(f"📄 Cube {rows} x {cols} pixels, {bands} bands ({cube.interleave}), {len(index_names)} indices")
+    raster_files = create_rasters(output_dir, index_names, rows, cols, np.dtype(dtype), output_format)
+    tiles = plan_tiles(rows, cols, tile_size)
+    init_args = (cube_file, sensor, options, index_names, raster_files, dtype)
+    start = time.perf_counter()
+    n_pixels = 0
+    if workers > 1 and len(tiles) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=init_args) as executor:
+            for done in executor.map(_score_tile, tiles):
+                n_pixels += done
+        sync_rasters(raster_files)
+    else:
+        _init_worker(*init_args)
+        for tile in tiles:
+            n_pixels += _worker_tiles.score_tile(tile)
+        _worker_tiles.flush()
+    elapsed = time.perf_counter() - start
+    print(f"✅ Scored {n_pixels:,} pixels in {len(tiles)} tiles in {elapsed:.2f} s "
+          f"({n_pixels / elapsed if elapsed > 0 else 0:,.0f} pixels/s)")
+    return raster_files
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Compute index rasters of a multispectral image cube.")
+    parser.add_argument('cube', type=Path, help="ENVI header/data file or (rows, cols, bands) .npy file")
+    parser.add_argument('output_dir', type=Path, help="Folder for the index rasters")
+    parser.add_argument('--indices', help="Comma-separated index names (default: all computable)")
+    parser.add_argument('--sensor', help="Sensor serial providing wavelengths, FWHM and valid_vi (e.g. S8330)")
+    parser.add_argument('--tile', type=int, default=DEFAULT_TILE_SIZE,
+                        help=f"Tile edge in pixels (default: {DEFAULT_TILE_SIZE})")
+    parser.add_argument('--workers', type=int, default=0, help="Number of worker processes (default: all cores)")
+    parser.add_argument('--format', choices=('npy', 'envi'), default='npy', help="Raster format (default: npy)")
+    parser.add_argument('--dtype', choices=('float32', 'float64'), default='float32',
+                        help="Raster data type (default: float32)")
+    parser.add_argument('--xml-folder', type=Path, default=DEFAULT_XML_FOLDER, help="Folder with index XML files")
+    parser.add_argument('--catalogue', type=Path,
+                        help="Compiled index catalogue, rebuilt when missing or stale (default: in the user cache directory)")
+    parser.add_argument('--sensors', type=Path, default=DEFAULT_SENSORS_DIRECTORY, help="Folder with sensor JSON files")
+    args = parser.parse_args()
+    if args.catalogue is None:
+        args.catalogue = default_artifact_path(args.xml_folder)
+    return args
+
+
+def main():
+    """Score an image cube into index rasters."""
+    if len(sys.argv) < 3:
+        print("Usage: python image_cube.py <cube.hdr | cube.npy> <output_dir> [--indices NDVI,ARI] [--sensor S8330]")
+        print("           [--tile 256] [--workers N] [--format npy|envi]")
+        print("\nExample: python image_cube.py field.hdr rasters/ --indices NDVI,PRI --workers 8")
+        print("\nRequirements:")
+        print("  pip install numpy")
+        sys.exit(1)
+    args = parse_arguments()
+    # Compile the catalogue and the registry index once before the workers start
+    load_catalogue(args.xml_folder, args.catalogue).close()
+    registry_index = args.catalogue.with_name('sensor_registry_index.json')
+    get_registry(args.sensors, registry_index)
+    options = {
+        'catalogue_path': args.catalogue,
+        'xml_folder': args.xml_folder,
+        'sensors_directory': args.sensors,
+        'registry_index': registry_index,
+    }
+    requested = [name.strip() for name in args.indices.split(',') if name.strip()] if args.indices else None
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    try:
+        raster_files = score_image_cube(args.cube, args.output_dir, options, args.sensor, requested, args.tile,
+                                        workers, args.format, args.dtype)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    print(f"📊 {len(raster_files)} rasters saved to: {args.output_dir.absolute()}")
+
+
+if __name__ == "__main__":
+    main()
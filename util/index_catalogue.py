@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Compiled Spectral Index Catalogue
+
+This module compiles all spectral index XML files of a folder into a single
+binary artifact, so that scoring tools load one file instead of parsing every
+XML definition on start-up. Each record holds the index name, alternative
+names, bands with their selection strategy, the formula flattened to postfix
+bytecode and the metadata of the Excel table (SpectralIndexTableGenerator).
+
+Artifact layout (little endian):
+    8 bytes   magic b"SCIDXCAT"
+    4 bytes   format version (uint32)
+    8 bytes   header length (uint64)
+    n bytes   UTF-8 JSON header (records, array offsets, source hash)
+    padding   to 8 byte alignment
+    arrays    band_min/band_max/constants (float64), code (int32, n x 3)
+
+The loader memory-maps the file and validates it against the XML folder
+before use: first by the names, sizes and modification times of the XML
+files, and only when those differ by the content hash. Without an explicit
+path the artifact lives in a per-folder directory of the user cache
+($XDG_CACHE_HOME or ~/.cache, see default_artifact_path()).
+
+Usage: python index_catalogue.py <path_to_xml_folder> [output_file.scic]
+
+Requirements: pip install numpy (compiling additionally needs sympy pandas)
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from index_engine import CompiledIndex, SpectralIndexEngine
+
+
+MAGIC = b"SCIDXCAT"
+FORMAT_VERSION = 1
+DEFAULT_ARTIFACT_NAME = "indices_catalogue.scic"
+CACHE_DIRECTORY = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'scancorder.indices'
+
+# Bytecode opcodes; every instruction is (opcode, operand, number of arguments)
+OP_LOAD_VAR = 0
+OP_LOAD_CONST = 1
+OPERATORS = ['plus', 'minus', 'times', 'divide', 'power', 'root', 'abs', 'ln', 'rgb2hue']
+OPCODES = {name: 2 + i for i, name in enumerate(OPERATORS)}
+
+SELECT_STRATEGIES = ['min-distance', 'min-reflectance', 'weighted']
+
+
+def source_hash(xml_folder_path: Path) -> str:
+    """Hash over the names and contents of all XML files of a folder."""
+    digest = hashlib.sha256()
+    for xml_file in sorted(Path(xml_folder_path).glob("*.xml")):
+        digest.update(xml_file.name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(xml_file.read_bytes())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def source_signature(xml_folder_path: Path) -> List[List]:
+    """(name, size, mtime_ns) of every XML file of a folder; cheap to compare, no file is read."""
+    signature = []
+    for entry in sorted(os.scandir(xml_folder_path), key=lambda e: e.name):
+        if entry.name.endswith('.xml') and entry.is_file():
+            stat = entry.stat()
+            signature.append([entry.name, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def default_artifact_path(xml_folder_path: Path) -> Path:
+    """Artifact location in the user cache directory, one subdirectory per XML folder."""
+    folder_key = hashlib.sha1(str(Path(xml_folder_path).resolve()).encode('utf-8')).hexdigest()[:16]
+    return CACHE_DIRECTORY / folder_key / DEFAULT_ARTIFACT_NAME
+
+
+def tree_to_bytecode(node: Tuple, variables: List[str], constants: List[float]) -> List[Tuple[int, int, int]]:
+    """Flatten an expression tree to postfix instructions, appending to `constants`."""
+    code = []
+
+    def emit(current):
+        kind = current[0]
+        if kind == 'ci':
+            code.append((OP_LOAD_VAR, variables.index(current[1]), 0))
+        elif kind == 'cn':
+            constants.append(current[1])
+            code.append((OP_LOAD_CONST, len(constants) - 1, 0))
+        else:
+            for child in current[1:]:
+                emit(child)
+            code.append((OPCODES[kind], 0, len(current) - 1))
+
+    emit(node)
+    return code
+
+
+def bytecode_to_tree(code: np.ndarray, variables: List[str], constants: np.ndarray) -> Tuple:
+    """Rebuild an expression tree from postfix instructions."""
+    stack = []
+    for opcode, operand, n_args in code:
+        if opcode == OP_LOAD_VAR:
+            stack.append(('ci', variables[operand]))
+        elif opcode == OP_LOAD_CONST:
+            stack.append(('cn', float(constants[operand])))
+        else:
+            args = tuple(stack[len(stack) - n_args:])
+            del stack[len(stack) - n_args:]
+            stack.append((OPERATORS[opcode - 2],) + args)
+    if len(stack) != 1:
+        raise ValueError("Corrupt expression bytecode")
+    return stack[0]
+
+
+class CatalogueCompiler:
+    """Compiles a folder of index XML files into one catalogue artifact."""
+
+    def __init__(self):
+        self.engine = SpectralIndexEngine()
+
+    def compile_folder(self, xml_folder_path: Path, output_file: Path) -> Dict[str, Exception]:
+        """Compile all XML files and write the artifact, returning the files that failed."""
+        # The table generator pulls in sympy and pandas; only needed when compiling
+        from generate_indices_table import SpectralIndexTableGenerator
+        table_generator = SpectralIndexTableGenerator()
+
+        xml_files = sorted(Path(xml_folder_path).glob("*.xml"))
+        if not xml_files:
+            raise ValueError(f"No XML files found in '{xml_folder_path}'")
+        # Stamped before any XML is read: a file edited during the compile no longer matches the artifact
+        signature = source_signature(xml_folder_path)
+        xml_hash = source_hash(xml_folder_path)
+
+        records = []
+        band_min = []
+        band_max = []
+        constants = []
+        code = []
+        errors = {}
+        for xml_file in xml_files:
+            try:
+                index = self.engine.compile_xml_file(xml_file)
+                metadata = table_generator.parse_xml_file(xml_file)
+            except Exception as e:
+                errors[xml_file.name] = e
+                continue
+            root = ET.parse(xml_file).getroot()
+            alternatives = [element.text.strip() for element in root.findall('AlternativeName') if element.text]
+            instructions = tree_to_bytecode(index.expression.tree, index.band_names, constants)
+            records.append({
+                'name': index.name,
+                'file': xml_file.name,
+                'alternative_names': alternatives,
+                'bands': [band['name'] for band in index.bands],
+                'select': [SELECT_STRATEGIES.index(band['select']) for band in index.bands],
+                'band_offset': len(band_min),
+                'code_offset': len(code),
+                'code_length': len(instructions),
+                'metadata': metadata,
+            })
+            band_min.extend(band['min'] for band in index.bands)
+            band_max.extend(band['max'] for band in index.bands)
+            code.extend(instructions)
+
+        arrays = {
+            'band_min': np.asarray(band_min, dtype='<f8'),
+            'band_max': np.asarray(band_max, dtype='<f8'),
+            'constants': np.asarray(constants, dtype='<f8'),
+            'code': np.asarray(code, dtype='<i4').reshape(-1, 3),
+        }
+        self.write_artifact(Path(output_file), records, arrays, xml_hash, signature)
+        return errors
+
+    @staticmethod
+    def write_artifact(output_file: Path, records: List[Dict], arrays: Dict[str, np.ndarray], xml_hash: str,
+                       signature: List[List]):
+        """Write an artifact atomically; concurrent writers each replace it with a complete file."""
+        layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            layout[name] = {'offset': offset, 'shape': list(array.shape), 'dtype': array.dtype.str}
+            offset += array.nbytes
+            offset += -offset % 8
+        header = json.dumps({
+            'source_hash': xml_hash,
+            'source_signature': signature,
+            'select_strategies': SELECT_STRATEGIES,
+            'operators': OPERATORS,
+            'records': records,
+            'arrays': layout,
+        }).encode('utf-8')
+        prefix = MAGIC + struct.pack('<IQ', FORMAT_VERSION, len(header)) + header
+        prefix += b'\0' * (-len(prefix) % 8)
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=output_file.name + '.', dir=output_file.parent)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(prefix)
+                for name, array in arrays.items():
+                    f.seek(len(prefix) + layout[name]['offset'])
+                    f.write(array.tobytes())
+            try:
+                os.replace(tmp_path, output_file)
+            except OSError:
+                # The artifact is open in another process (Windows): a concurrent compile won the race
+                if not output_file.exists():
+                    raise
+                os.unlink(tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+
+class IndexCatalogue:
+    """Read-only, memory-mapped view of a compiled catalogue artifact."""
+
+    def __init__(self, artifact_path: Path):
+        self.artifact_path = Path(artifact_path)
+        with open(self.artifact_path, 'rb') as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not an index catalogue: {self.artifact_path}")
+        version, header_length = struct.unpack_from('<IQ', self._buffer, len(MAGIC))
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported catalogue format version {version}")
+        header_start = len(MAGIC) + 12
+        header = json.loads(bytes(self._buffer[header_start:header_start + header_length]).decode('utf-8'))
+        data_start = header_start + header_length
+        data_start += -data_start % 8
+        self.source_hash = header['source_hash']
+        self.source_signature = header.get('source_signature')
+        self.records = header['records']
+        self._arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            count = int(np.prod(spec['shape']))
+            self._arrays[name] = np.frombuffer(self._buffer, dtype=dtype, count=count,
+                                               offset=data_start + spec['offset']).reshape(spec['shape'])
+
+    @property
+    def band_min(self) -> np.ndarray:
+        return self._arrays['band_min']
+
+    @property
+    def band_max(self) -> np.ndarray:
+        return self._arrays['band_max']
+
+    @property
+    def constants(self) -> np.ndarray:
+        return self._arrays['constants']
+
+    @property
+    def code(self) -> np.ndarray:
+        return self._arrays['code']
+
+    def index_names(self) -> List[str]:
+        return [record['name'] for record in self.records]
+
+    def is_current(self, xml_folder_path: Path) -> bool:
+        """True if the artifact was compiled from the current content of the XML folder.
+
+        Unchanged file names, sizes and modification times are enough; the
+        XML files are only read and hashed when those differ (e.g. after a
+        checkout that touched but did not change them). A match by content
+        re-stamps the artifact with the new signature, so later loads skip
+        hashing again.
+        """
+        signature = source_signature(xml_folder_path)
+        if self.source_signature is not None and self.source_signature == signature:
+            return True
+        if self.source_hash != source_hash(xml_folder_path):
+            return False
+        arrays = {name: array.copy() for name, array in self._arrays.items()}
+        try:
+            CatalogueCompiler.write_artifact(self.artifact_path, self.records, arrays, self.source_hash, signature)
+        except OSError:
+            # Only saves hashing on the next load
+            pass
+        self.source_signature = signature
+        return True
+
+    def definition_hash(self, record: Dict) -> str:
+        """Hash over what determines the values of an index: its bands and its formula.
+
+        Metadata such as descriptions or references does not change the hash.
+        """
+        code = self.code[record['code_offset']:record['code_offset'] + record['code_length']]
+        definition = [self.bands(record), bytecode_to_tree(code, record['bands'], self.constants)]
+        return hashlib.sha256(json.dumps(definition).encode('utf-8')).hexdigest()
+
+    def definition_hashes(self) -> Dict[str, str]:
+        return {record['name']: self.definition_hash(record) for record in self.records}
+
+    def bands(self, record: Dict) -> List[Dict]:
+        """Band definitions of a record in the format of SpectralIndexEngine.parse_bands()."""
+        offset = record['band_offset']
+        return [{
+            'name': name,
+            'min': float(self.band_min[offset + i]),
+            'max': float(self.band_max[offset + i]),
+            'select': SELECT_STRATEGIES[select],
+        } for i, (name, select) in enumerate(zip(record['bands'], record['select']))]
+
+    def engine(self) -> SpectralIndexEngine:
+        """Build a SpectralIndexEngine from the catalogue without touching any XML file."""
+        engine = SpectralIndexEngine()
+        for record in self.records:
+            code = self.code[record['code_offset']:record['code_offset'] + record['code_length']]
+            tree = bytecode_to_tree(code, record['bands'], self.constants)
+            expression = engine.compiler.compile_tree(tree, record['bands'])
+            engine.indices[record['name']] = CompiledIndex(record['name'], self.bands(record), expression)
+        return engine
+
+    def close(self):
+        self._arrays = {}
+        self._buffer.close()
+
+
+def load_catalogue(xml_folder_path: Path, artifact_path: Optional[Path] = None) -> IndexCatalogue:
+    """Load the catalogue artifact, recompiling it if it is missing or outdated.
+
+    Without `artifact_path` the artifact is kept at default_artifact_path().
+    """
+    artifact_path = default_artifact_path(xml_folder_path) if artifact_path is None else Path(artifact_path)
+    if artifact_path.exists():
+        try:
+            catalogue = IndexCatalogue(artifact_path)
+            if catalogue.is_current(xml_folder_path):
+                return catalogue
+            catalogue.close()
+        except (ValueError, struct.error, OSError):
+            # Truncated or unreadable artifact: compile it again
+            pass
+    CatalogueCompiler().compile_folder(xml_folder_path, artifact_path)
+    return IndexCatalogue(artifact_path)
+
+
+def main():
+    """Compile the index catalogue artifact for an XML folder."""
+    if len(sys.argv) < 2:
+        print("Usage: python index_catalogue.py <path_to_xml_folder> [output_file.scic]")
+        print("\nExample: python index_catalogue.py ../inst/extdata/indices/ indices_catalogue.scic")
+        print("\nWithout an output file the catalogue is written to the user cache directory.")
+        print("\nRequirements:")
+        print("  pip install numpy sympy pandas")
+        sys.exit(1)
+    xml_path = Path(sys.argv[1])
+    if not xml_path.is_dir():
+        print(f"❌ Error: '{xml_path}' is not a directory")
+        sys.exit(1)
+    output_file = Path(sys.argv[2]) if len(sys.argv) >= 3 else default_artifact_path(xml_path)
+    try:
+        errors = CatalogueCompiler().compile_folder(xml_path, output_file)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    for file_name, error in errors.items():
+        print(f"❌ Error compiling {file_name}: {error}")
+    catalogue = IndexCatalogue(output_file)
+    print(f"\n{'='*60}")
+    print(f"✅ Compiled: {len(catalogue.records)} indices")
+    if errors:
+        print(f"❌ Errors: {len(errors)} files")
+    print(f"📦 Catalogue saved to: {output_file.absolute()} ({output_file.stat().st_size} bytes)")
+    print(f"{'='*60}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Static Sensor x Index Compatibility
+
+Decides before any reflectance is scored which spectral indices can be
+computed on a sensor's channel grid at all. The report is read from the
+BandPlan of the grid (band_plan.py), the same static NA mask the scoring
+path prunes with: an index is not computable if one of its bands has no
+matching channel, or if two of its bands resolve to the same channel or,
+for "weighted" bands, the same channel weights (calculate_index() returns
+NA in all these cases).
+
+For a directory of sensor JSON files the module builds the full
+sensors x indices compatibility matrix and compares it with the hand
+maintained valid_vi lists.
+
+Usage: python index_compatibility.py <path_to_xml_folder> [sensors_directory] [--csv matrix.csv]
+
+Requirements: pip install numpy
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from band_plan import BandPlan, BandPlanner
+from index_engine import CompiledIndex, SpectralIndexEngine
+
+
+STATUS_COMPUTABLE = 'computable'
+STATUS_MISSING_BAND = 'missing band'
+STATUS_DUPLICATE_CHANNEL = 'duplicate channel'
+
+
+class CompatibilityReport:
+    """Per-index computability on one channel grid."""
+
+    def __init__(self, status: Dict[str, str], details: Dict[str, str]):
+        self.status = status
+        self.details = details
+
+    def computable(self) -> List[str]:
+        return [name for name, status in self.status.items() if status == STATUS_COMPUTABLE]
+
+    def not_computable(self) -> List[str]:
+        return [name for name, status in self.status.items() if status != STATUS_COMPUTABLE]
+
+
+def plan_report(plan: BandPlan) -> CompatibilityReport:
+    """Classify the indices of a BandPlan from its static NA mask, exactly as scoring prunes them."""
+    weighted = {int(column): k for k, column in enumerate(plan.weighted_bands)}
+    dynamic = {int(column) for column in plan.dynamic_bands}
+    status = {}
+    details = {}
+    for name, invalid in zip(plan.index_names, plan.static_invalid):
+        if not invalid:
+            status[name] = STATUS_COMPUTABLE
+            continue
+        columns = plan.index_columns[name]
+        missing = [plan.band_keys[column][1] for column in columns if plan.missing[column]]
+        if missing:
+            status[name] = STATUS_MISSING_BAND
+            details[name] = ', '.join(missing)
+            continue
+        # Bands resolving to the same channel (or the same channel weights)
+        groups: Dict = {}
+        for column in columns:
+            column = int(column)
+            if column in dynamic:
+                continue
+            if column in weighted:
+                channels, weights = plan.band_weights.column(weighted[column])
+                key = (tuple(channels.tolist()), weights.tobytes())
+                label = f"{plan.wavelengths[channels[0]]:g}-{plan.wavelengths[channels[-1]]:g} weighted"
+            else:
+                key = int(plan.gather[column])
+                label = f"{plan.wavelengths[key]:g}"
+            groups.setdefault(key, (label, []))[1].append(plan.band_keys[column][1])
+        status[name] = STATUS_DUPLICATE_CHANNEL
+        details[name] = ', '.join(f"{'/'.join(bands)} ({label})" for label, bands in groups.values() if len(bands) > 1)
+    return CompatibilityReport(status, details)
+
+
+def check_indices(indices: Sequence[CompiledIndex], wavelengths, fwhm=None) -> CompatibilityReport:
+    """Classify every index as computable, missing a band or collapsing bands onto one channel."""
+    return plan_report(BandPlanner(indices).plan(wavelengths, fwhm))
+
+
+class CompatibilityMatrix:
+    """Sensors x indices computability matrix for a directory of sensor JSON files."""
+
+    def __init__(self, sensor_names: List[str], index_names: List[str], matrix: np.ndarray,
+                 valid_vi: Dict[str, Optional[List[str]]]):
+        self.sensor_names = sensor_names
+        self.index_names = index_names
+        # (n_sensors, n_indices) boolean
+        self.matrix = matrix
+        self.valid_vi = valid_vi
+
+    @classmethod
+    def build(cls, indices: Sequence[CompiledIndex], sensors_directory: Path) -> 'CompatibilityMatrix':
+        indices = list(indices)
+        planner = BandPlanner(indices)
+        sensor_names = []
+        rows = []
+        valid_vi = {}
+        for sensor_file in sorted(Path(sensors_directory).glob('*.json')):
+            with open(sensor_file, 'r', encoding='utf-8') as f:
+                sensor_info = json.load(f)
+            report = plan_report(planner.plan_for_sensor(sensor_info))
+            sensor_names.append(sensor_file.stem)
+            rows.append([report.status[index.name] == STATUS_COMPUTABLE for index in indices])
+            listed = sensor_info.get('valid_vi')
+            valid_vi[sensor_file.stem] = None if listed is None else [str(name) for name in listed]
+        matrix = np.asarray(rows, dtype=bool).reshape(len(sensor_names), len(indices))
+        return cls(sensor_names, [index.name for index in indices], matrix, valid_vi)
+
+    def computable(self, sensor_name: str) -> List[str]:
+        row = self.matrix[self.sensor_names.index(sensor_name)]
+        return [name for name, ok in zip(self.index_names, row) if ok]
+
+    def validate_valid_vi(self, sensor_name: str) -> Optional[Dict[str, List[str]]]:
+        """Differences between the valid_vi list of a sensor and its computed row (None without list)."""
+        listed = self.valid_vi.get(sensor_name)
+        if listed is None:
+            return None
+        computable = set(self.computable(sensor_name))
+        known = set(self.index_names)
+        return {
+            'listed_not_computable': sorted(name for name in listed if name in known and name not in computable),
+            'computable_not_listed': sorted(computable - set(listed)),
+            'listed_unknown': sorted(name for name in listed if name not in known),
+        }
+
+    def write_csv(self, output_file: Path, sep: str = ';'):
+        """Write the matrix as a sensors x indices table of 0/1."""
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write(sep.join(['sensor'] + self.index_names) + '\n')
+            for name, row in zip(self.sensor_names, self.matrix):
+                f.write(sep.join([name] + [str(int(ok)) for ok in row]) + '\n')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Check which spectral indices each sensor can compute.")
+    parser.add_argument('xml_folder', type=Path, help="Folder with index XML files")
+    parser.add_argument('sensors_directory', type=Path, nargs='?',
+                        default=Path(__file__).resolve().parent.parent / 'inst' / 'extdata' / 'sensors',
+                        help="Folder with sensor JSON files (default: inst/extdata/sensors)")
+    parser.add_argument('--csv', type=Path, help="Write the compatibility matrix to this CSV file")
+    return parser.parse_args()
+
+
+def main():
+    """Build the compatibility matrix and validate the valid_vi lists."""
+    if len(sys.argv) < 2:
+        print("Usage: python index_compatibility.py <path_to_xml_folder> [sensors_directory] [--csv matrix.csv]")
+        print("\nExample: python index_compatibility.py ../inst/extdata/indices/ ../inst/extdata/sensors/")
+        print("\nRequirements:")
+        print("  pip install numpy")
+        sys.exit(1)
+    args = parse_arguments()
+    engine = SpectralIndexEngine()
+    errors = engine.load_folder(args.xml_folder)
+    for file_name, error in errors.items():
+        print(f"❌ Error compiling {file_name}: {error}")
+    matrix = CompatibilityMatrix.build(engine.indices.values(), args.sensors_directory)
+    for sensor_name, row in zip(matrix.sensor_names, matrix.matrix):
+        print(f"📊 {sensor_name}: {row.sum()} of {len(matrix.index_names)} indices computable")
+        differences = matrix.validate_valid_vi(sensor_name)
+        if differences is None:
+            print("   no valid_vi list")
+            continue
+        if not any(differences.values()):
+            print("   ✅ valid_vi matches")
+        for key, names in differences.items():
+            if names:
+                print(f"   ⚠️ {key.replace('_', ' ')} ({len(names)}): {', '.join(names)}")
+    if args.csv:
+        matrix.write_csv(args.csv)
+        print(f"\n📄 Matrix saved to: {args.csv.absolute()}")
+
+
+if __name__ == "__main__":
+    main()
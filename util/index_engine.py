@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+Vectorized Spectral Index Engine
+
+This module compiles the MathML formula of every spectral index XML file once
+into a NumPy callable and evaluates it on a whole (n_samples, n_bands)
+reflectance matrix in a single call. The supported operators and their
+semantics follow the R evaluate_mathml() function (plus, minus, times, divide,
+power, root, abs, ln and the rgb2hue csymbol). Only NumPy is needed; SymPy
+and matplotlib are never imported on the scoring path.
+
+Usage: python index_engine.py <path_to_xml_folder>
+
+Requirements: pip install numpy
+"""
+
+import sys
+import time
+import xml.etree.ElementTree as ET
+from functools import reduce
+from pathlib import Path
+from typing import Callable, Collection, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from instrumentation import NULL_INSTRUMENTATION, Instrumentation
+from mathml_core import MATHML_NAMESPACE, local_name
+
+
+# Operators with a fixed number of arguments, as enforced by evaluate_mathml()
+OPERATOR_ARITY = {
+    'power': (2,),
+    'root': (1, 2),
+    'abs': (1,),
+    'ln': (1,),
+    'rgb2hue': (3,),
+}
+
+
+def rgb2hue(r, g, b) -> np.ndarray:
+    """Vectorized HSV hue in degrees, matching grDevices::rgb2hsv() as used by rgb2hue()."""
+    r = np.asarray(r, dtype=np.float64)
+    g = np.asarray(g, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    r, g, b = np.broadcast_arrays(r, g, b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        max_val = np.maximum(np.maximum(r, g), b)
+        min_val = np.minimum(np.minimum(r, g), b)
+        delta = max_val - min_val
+        # Same tie-breaking as the R implementation: blue wins only when strictly
+        # largest, red only when strictly larger than green.
+        b_max = b > np.maximum(r, g)
+        r_max = ~b_max & (r > g)
+        hue = np.where(r_max, (g - b) / delta,
+                       np.where(b_max, 4.0 + (r - g) / delta, 2.0 + (b - r) / delta))
+        hue = hue / 6.0
+        hue = np.where(hue < 0, hue + 1.0, hue)
+        hue = np.where((max_val == 0) | (delta == 0), 0.0, hue)
+    # rgb2hsv() rejects negative values, which ends up as NA in calculate_index()
+    hue = np.where((r < 0) | (g < 0) | (b < 0), np.nan, hue)
+    hue = np.where(np.isnan(r) | np.isnan(g) | np.isnan(b), np.nan, hue)
+    return hue * 360.0
+
+
+class MathMLCompiler:
+    """Compiles MathML elements to vectorized NumPy callables."""
+
+    def __init__(self):
+        self.namespace = {'mathml': MATHML_NAMESPACE}
+
+    def parse(self, mathml_element) -> Tuple:
+        """Convert a MathML element into a nested tuple expression tree.
+
+        Leaves are ('ci', name) and ('cn', value); every <apply> becomes
+        (operator, operand, ...), with csymbols using their text as operator.
+        """
+        if mathml_element is None:
+            raise ValueError("No MathML expression found")
+        node = self._parse_node(mathml_element)
+        if node is None:
+            raise ValueError("Empty MathML expression")
+        return node
+
+    def _parse_node(self, elem) -> Optional[Tuple]:
+        tag = local_name(elem.tag)
+        children = list(elem)
+
+        if tag == 'ci':
+            text = elem.text.strip() if elem.text else ''
+            if not text:
+                raise ValueError("Empty <ci> element encountered")
+            return ('ci', text)
+
+        if tag == 'cn':
+            text = elem.text.strip() if elem.text else ''
+            try:
+                return ('cn', float(text))
+            except ValueError:
+                raise ValueError(f"Invalid numeric constant in <cn>: '{text}'")
+
+        if tag == 'apply':
+            if len(children) < 2:
+                raise ValueError("<apply> element without operands")
+            operator = local_name(children[0].tag)
+            if operator == 'csymbol':
+                operator = children[0].text.strip() if children[0].text else ''
+            if operator not in ('plus', 'minus', 'times', 'divide') and operator not in OPERATOR_ARITY:
+                raise ValueError(f"Unsupported MathML operator: {operator}")
+            operands = tuple(self._parse_node(child) for child in children[1:])
+            arity = OPERATOR_ARITY.get(operator)
+            if arity is not None and len(operands) not in arity:
+                raise ValueError(f"The {operator} operator expects {' or '.join(map(str, arity))} argument(s)")
+            return (operator,) + operands
+
+        # <math>, <MathML> and other wrappers: descend into the first child
+        if children:
+            return self._parse_node(children[0])
+        raise ValueError(f"Encountered an unknown MathML element: {tag}")
+
+    def variables(self, node: Tuple) -> List[str]:
+        """Return the variable names of an expression tree in order of first use."""
+        names = []
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current[0] == 'ci':
+                if current[1] not in names:
+                    names.append(current[1])
+            elif current[0] != 'cn':
+                stack.extend(reversed(current[1:]))
+        return names
+
+    def compile(self, mathml_element, variables: Optional[Sequence[str]] = None) -> 'CompiledExpression':
+        """Compile a MathML element into a CompiledExpression.
+
+        The columns of the matrix passed to the compiled expression follow
+        `variables` (defaults to the order of first use in the formula).
+        """
+        return self.compile_tree(self.parse(mathml_element), variables)
+
+    def compile_tree(self, node: Tuple, variables: Optional[Sequence[str]] = None) -> 'CompiledExpression':
+        """Compile an already parsed expression tree into a CompiledExpression."""
+        if variables is None:
+            variables = self.variables(node)
+        columns = {name: i for i, name in enumerate(variables)}
+        missing = [name for name in self.variables(node) if name not in columns]
+        if missing:
+            raise ValueError(f"Variable '{missing[0]}' not found in reflectance values.")
+        return CompiledExpression(node, list(variables), self._build(node, columns))
+
+    def _build(self, node: Tuple, columns: Dict[str, int]) -> Callable:
+        """Recursively turn an expression tree into nested closures over a 2D array."""
+        kind = node[0]
+        if kind == 'ci':
+            col = columns[node[1]]
+            return lambda X: X[:, col]
+        if kind == 'cn':
+            value = node[1]
+            return lambda X: value
+
+        args = [self._build(child, columns) for child in node[1:]]
+        if kind == 'plus':
+            return lambda X: reduce(np.add, [f(X) for f in args])
+        if kind == 'times':
+            return lambda X: reduce(np.multiply, [f(X) for f in args])
+        if kind == 'minus':
+            if len(args) == 1:
+                f0 = args[0]
+                return lambda X: np.negative(f0(X))
+            return lambda X: reduce(np.subtract, [f(X) for f in args])
+        if kind == 'divide':
+            return lambda X: reduce(np.divide, [f(X) for f in args])
+        if kind == 'power':
+            f0, f1 = args
+            return lambda X: np.power(f0(X), f1(X))
+        if kind == 'root':
+            if len(args) == 1:
+                f0 = args[0]
+                return lambda X: np.sqrt(f0(X))
+            f0, f1 = args
+            return lambda X: np.power(f0(X), np.divide(1.0, f1(X)))
+        if kind == 'abs':
+            f0 = args[0]
+            return lambda X: np.abs(f0(X))
+        if kind == 'ln':
+            f0 = args[0]
+            return lambda X: np.log(f0(X))
+        if kind == 'rgb2hue':
+            f0, f1, f2 = args
+            return lambda X: rgb2hue(f0(X), f1(X), f2(X))
+        raise ValueError(f"Unsupported MathML operator: {kind}")
+
+
+class CompiledExpression:
+    """A MathML formula compiled once and evaluated on whole sample matrices."""
+
+    def __init__(self, tree: Tuple, variables: List[str], function: Callable):
+        self.tree = tree
+        self.variables = variables
+        self._function = function
+
+    def __call__(self, band_values, dtype=np.float64) -> np.ndarray:
+        """Evaluate on an (n_samples, n_variables) matrix, columns ordered as `variables`.
+
+        The arithmetic runs in `dtype` (float64 or float32); results are float64.
+        """
+        X = np.asarray(band_values, dtype=dtype)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.shape[1] != len(self.variables):
+            raise ValueError(f"Expected {len(self.variables)} band columns, got {X.shape[1]}")
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            result = self._function(X)
+        return np.broadcast_to(np.asarray(result, dtype=np.float64), (X.shape[0],)).copy()
+
+    def evaluate(self, values: Dict[str, np.ndarray]) -> np.ndarray:
+        """Evaluate from a mapping of variable name to per-sample values."""
+        columns = [np.atleast_1d(np.asarray(values[name], dtype=np.float64)) for name in self.variables]
+        return self(np.column_stack(columns))
+
+
+class CompiledIndex:
+    """A spectral index definition with its band ranges and compiled formula."""
+
+    def __init__(self, name: str, bands: List[Dict], expression: CompiledExpression, source: Optional[Path] = None):
+        self.name = name
+        self.bands = bands
+        self.expression = expression
+        self.source = source
+
+    @property
+    def band_names(self) -> List[str]:
+        return [band['name'] for band in self.bands]
+
+    def evaluate(self, band_values, dtype=np.float64) -> np.ndarray:
+        """Evaluate the index on an (n_samples, n_bands) matrix ordered like `bands`."""
+        return self.expression(band_values, dtype)
+
+
+class SpectralIndexEngine:
+    """Loads spectral index XML files and evaluates them on reflectance matrices."""
+
+    def __init__(self):
+        self.compiler = MathMLCompiler()
+        self.indices: Dict[str, CompiledIndex] = {}
+
+    def parse_bands(self, wavelengths_element) -> List[Dict]:
+        """Extract band ranges and their selection strategy from a <Wavelengths> element."""
+        bands = []
+        if wavelengths_element is None:
+            return bands
+        for band in wavelengths_element.findall('Band'):
+            select = band.get('select') or 'min-distance'
+            bands.append({
+                'name': band.get('name', ''),
+                'min': float(band.get('min', 'nan')),
+                'max': float(band.get('max', 'nan')),
+                'select': select,
+            })
+        return bands
+
+    def _find_mathml_element(self, root):
+        """Find the <math> element below <MathML>, handling namespaces."""
+        mathml = root.find(f'MathML/{{{MATHML_NAMESPACE}}}math')
+        if mathml is None:
+            mathml = root.find('MathML/math')
+        if mathml is None:
+            mathml = root.find('MathML')
+        return mathml
+
+    def compile_xml_file(self, xml_file_path: Path) -> CompiledIndex:
+        """Parse an index XML file and compile its formula."""
+        try:
+            root = ET.parse(xml_file_path).getroot()
+        except ET.ParseError as e:
+            raise ValueError(f"Error parsing XML: {e}")
+        name_element = root.find('.//Name')
+        if name_element is None or not name_element.text:
+            raise ValueError("No <Name> element found in XML.")
+        bands = self.parse_bands(root.find('Wavelengths'))
+        mathml_element = self._find_mathml_element(root)
+        if mathml_element is None:
+            raise ValueError("No MathML expression found in XML.")
+        expression = self.compiler.compile(mathml_element, [band['name'] for band in bands])
+        return CompiledIndex(name_element.text.strip(), bands, expression, Path(xml_file_path))
+
+    def load_folder(self, xml_folder_path: Path) -> Dict[str, Exception]:
+        """Compile every XML file in a folder, returning the files that failed."""
+        xml_files = sorted(Path(xml_folder_path).glob("*.xml"))
+        if not xml_files:
+            raise ValueError(f"No XML files found in '{xml_folder_path}'")
+        errors = {}
+        for xml_file in xml_files:
+            try:
+                index = self.compile_xml_file(xml_file)
+                self.indices[index.name] = index
+            except Exception as e:
+                errors[xml_file.name] = e
+        return errors
+
+    def evaluate(self, index_name: str, band_values) -> np.ndarray:
+        """Evaluate a loaded index on an (n_samples, n_bands) matrix ordered like its bands."""
+        if index_name not in self.indices:
+            raise KeyError(f"Unknown index: {index_name}")
+        return self.indices[index_name].evaluate(band_values)
+
+    def score(self, reflectance, plan, index_names: Optional[Sequence[str]] = None,
+              drop_empty: bool = False,
+              instrumentation: Instrumentation = NULL_INSTRUMENTATION,
+              dtype=np.float64, float64_indices: Optional[Collection[str]] = None) -> Dict[str, np.ndarray]:
+        """Score a batch of reflectance vectors for all (or selected) indices.
+
+        `plan` is a BandPlan built for the indices of this engine (see
+        band_plan.py). Like calculate_indices_table(), an index is NA for a
+        sample when a band is missing or two bands resolve to the same channel;
+        with `drop_empty` indices that are NA for every sample are left out.
+        An enabled `instrumentation` receives the band selection and
+        evaluation timers and, with per_index, the time, NaN/Inf counts and
+        errors of every index.
+
+        With dtype=np.float32, band values are gathered and evaluated in
+        single precision, except for the `float64_indices` (see
+        precision_validation.py), which are gathered and evaluated in double
+        precision. Results are float64 either way.
+        """
+        # Indices that are NA on this grid by construction are skipped before gathering
+        n_samples = np.shape(reflectance)[0] if np.ndim(reflectance) == 2 else 1
+        if index_names is None:
+            index_names = plan.index_names
+        active = plan.pruned()
+        passes = [(active, index_names, dtype)]
+        if np.dtype(dtype) != np.float64 and float64_indices and \
+                any(name in float64_indices for name in active.index_names):
+            single = [name for name in active.index_names if name not in float64_indices]
+            double = [name for name in active.index_names if name in float64_indices]
+            passes = [(active.subset(single), [name for name in index_names if name not in float64_indices], dtype),
+                      (active.subset(double), [name for name in index_names if name in float64_indices], np.float64)]
+        results = {}
+        for subplan, names, pass_dtype in passes:
+            with instrumentation.stage('band_selection', n_samples):
+                values, selected = subplan.gather_values(reflectance, pass_dtype)
+                invalid = subplan.invalid_mask(values, selected)
+            with instrumentation.stage('evaluation', n_samples):
+                results.update(self._score_active(subplan, values, invalid, plan, names, drop_empty,
+                                                  instrumentation, pass_dtype))
+        if len(passes) == 1:
+            return results
+        return {name: results[name] for name in index_names if name in results}
+
+    def _score_active(self, active, values: np.ndarray, invalid: np.ndarray, plan,
+                      index_names: Optional[Sequence[str]], drop_empty: bool,
+                      instrumentation: Instrumentation, dtype=np.float64) -> Dict[str, np.ndarray]:
+        positions = {name: k for k, name in enumerate(active.index_names)}
+        known = set(plan.index_names)
+        results = {}
+        for name in index_names:
+            if name not in known:
+                continue
+            k = positions.get(name)
+            if k is None or invalid[:, k].all():
+                if drop_empty:
+                    continue
+                results[name] = np.full(values.shape[0], np.nan)
+                if instrumentation.per_index:
+                    instrumentation.record_index(name, results[name], 0.0)
+                continue
+            if instrumentation.per_index:
+                start = time.perf_counter()
+                try:
+                    result = self.indices[name].evaluate(values[:, active.index_columns[name]], dtype)
+                except Exception as e:
+                    instrumentation.record_error(name, e)
+                    raise
+                result[invalid[:, k]] = np.nan
+                instrumentation.record_index(name, result, time.perf_counter() - start)
+            else:
+                result = self.indices[name].evaluate(values[:, active.index_columns[name]], dtype)
+                result[invalid[:, k]] = np.nan
+            if drop_empty and np.isnan(result).all():
+                continue
+            results[name] = result
+        return results
+
+
+def main():
+    """Compile all index XML files in a folder and report the result."""
+    if len(sys.argv) != 2:
+        print("Usage: python index_engine.py <path_to_xml_folder>")
+        print("\nExample: python index_engine.py ../inst/extdata/indices/")
+        print("\nRequirements:")
+        print("  pip install numpy")
+        sys.exit(1)
+    xml_path = Path(sys.argv[1])
+    if not xml_path.is_dir():
+        print(f"❌ Error: '{xml_path}' is not a directory")
+        sys.exit(1)
+    engine = SpectralIndexEngine()
+    try:
+        errors = engine.load_folder(xml_path)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    for file_name, error in errors.items():
+        print(f"❌ Error compiling {file_name}: {error}")
+    print(f"\n{'='*60}")
+    print(f"✅ Compiled: {len(engine.indices)} indices")
+    if errors:
+        print(f"❌ Errors: {len(errors)} files")
+    print(f"{'='*60}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Analytic Index Sensitivities and First-Order Uncertainty
+
+Propagates per-channel reflectance uncertainty (for example the residual
+standard error of the calibration fit) into spectral index uncertainty
+without finite differences:
+
+- the formula of every index is turned into a SymPy expression of its bands
+  once, differentiated with respect to each band and compiled with
+  lambdify() into one vectorized NumPy kernel per index (common
+  subexpressions of the partial derivatives are shared)
+- a batch is gathered once through the BandPlan; index values come from the
+  regular compiled formulas (identical to SpectralIndexEngine.score()) and
+  the band gradients from the kernels
+- the gradients are mapped back to sensor channels ("min-reflectance" bands:
+  the channel selected per sample, "weighted" bands: their channel weights)
+  and the first-order standard deviation is
+  sqrt(sum_c (d index / d R_c)^2 * sigma_c^2), treating channel errors as
+  independent
+
+rgb2hue() is differentiated piecewise on the branch the R tie-breaking picks;
+where the hue is not differentiable (grey, negative or missing channels) its
+partial derivatives are NaN.
+
+Usage: python index_sensitivity.py <path_to_xml_folder> <sensor_json> [n_samples] [sigma]
+
+Requirements: pip install numpy sympy
+"""
+
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from band_plan import BandPlan, BandPlanner
+from index_engine import CompiledIndex, SpectralIndexEngine, rgb2hue
+
+
+HUE_PARTIAL_NAMES = ('rgb2hue_dr', 'rgb2hue_dg', 'rgb2hue_db')
+
+# Relative step of the central differences main() checks the kernels against
+FINITE_DIFFERENCE_STEP = 1e-6
+
+_hue_function = None
+
+
+def rgb2hue_gradient(r, g, b) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Partial derivatives of rgb2hue() in degrees per unit reflectance.
+
+    Uses the branch picked by the tie-breaking of rgb2hue(); NaN where the
+    hue is undefined or constant by definition (max == min, negative or
+    missing channels).
+    """
+    r = np.asarray(r, dtype=np.float64)
+    g = np.asarray(g, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    r, g, b = np.broadcast_arrays(r, g, b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = np.maximum(np.maximum(r, g), b) - np.minimum(np.minimum(r, g), b)
+        b_max = b > np.maximum(r, g)
+        r_max = ~b_max & (r > g)
+        g_max = ~b_max & ~r_max
+        r_min = (r <= g) & (r <= b)
+        g_min = ~r_min & (g <= b)
+        b_min = ~r_min & ~g_min
+        # 6 * hue = offset + numerator / delta on every branch
+        numerator = np.where(r_max, g - b, np.where(b_max, r - g, b - r))
+        partials = []
+        for d_numerator, is_max, is_min in (
+                (np.where(b_max, 1.0, np.where(g_max, -1.0, 0.0)), r_max, r_min),
+                (np.where(r_max, 1.0, np.where(b_max, -1.0, 0.0)), g_max, g_min),
+                (np.where(g_max, 1.0, np.where(r_max, -1.0, 0.0)), b_max, b_min)):
+            d_delta = is_max.astype(np.float64) - is_min
+            partial = 60.0 * (d_numerator * delta - numerator * d_delta) / (delta * delta)
+            partial[(delta == 0) | (r < 0) | (g < 0) | (b < 0) | np.isnan(delta)] = np.nan
+            partials.append(partial)
+    return partials[0], partials[1], partials[2]
+
+
+def _sympy():
+    """Import SymPy on first use, like mathml_converter.py."""
+    import sympy
+    return sympy
+
+
+def _rgb2hue_function(sp):
+    """SymPy function for rgb2hue() whose derivatives are the rgb2hue_d* kernels."""
+    global _hue_function
+    if _hue_function is None:
+        partials = [sp.Function(name) for name in HUE_PARTIAL_NAMES]
+
+        class rgb2hue_function(sp.Function):
+            nargs = 3
+
+            def fdiff(self, argindex=1):
+                return partials[argindex - 1](*self.args)
+
+        rgb2hue_function.__name__ = 'rgb2hue'
+        _hue_function = rgb2hue_function
+    return _hue_function
+
+
+def _hue_partial(position: int) -> Callable:
+    return lambda r, g, b: rgb2hue_gradient(r, g, b)[position]
+
+
+# Names the lambdified kernels resolve before falling back to NumPy
+KERNEL_NAMESPACE = {'rgb2hue': rgb2hue}
+KERNEL_NAMESPACE.update({name: _hue_partial(position) for position, name in enumerate(HUE_PARTIAL_NAMES)})
+
+
+def tree_to_sympy(node: Tuple, symbols: Dict[str, object], sp):
+    """Build the SymPy expression of a MathMLCompiler tree, reducing n-ary operators like evaluate_mathml()."""
+    kind = node[0]
+    if kind == 'ci':
+        return symbols[node[1]]
+    if kind == 'cn':
+        return sp.Float(node[1])
+    operands = [tree_to_sympy(child, symbols, sp) for child in node[1:]]
+    if kind == 'plus':
+        return sp.Add(*operands)
+    if kind == 'times':
+        return sp.Mul(*operands)
+    if kind == 'minus':
+        if len(operands) == 1:
+            return -operands[0]
+        result = operands[0]
+        for operand in operands[1:]:
+            result = result - operand
+        return result
+    if kind == 'divide':
+        result = operands[0]
+        for operand in operands[1:]:
+            result = result / operand
+        return result
+    if kind == 'power':
+        return sp.Pow(operands[0], operands[1])
+    if kind == 'root':
+        if len(operands) == 1:
+            return sp.sqrt(operands[0])
+        return sp.Pow(operands[0], 1 / operands[1])
+    if kind == 'abs':
+        return sp.Abs(operands[0])
+    if kind == 'ln':
+        return sp.log(operands[0])
+    if kind == 'rgb2hue':
+        return _rgb2hue_function(sp)(*operands)
+    raise ValueError(f"Unsupported MathML operator: {kind}")
+
+
+class IndexGradient:
+    """Compiled partial derivatives of one index with respect to its bands."""
+
+    def __init__(self, name: str, band_names: List[str], partials: List, function: Callable):
+        self.name = name
+        self.band_names = band_names
+        # SymPy expression of every partial derivative, in band order
+        self.partials = partials
+        self._function = function
+
+    def __call__(self, band_values) -> np.ndarray:
+        """(n_samples, n_bands) gradient for an (n_samples, n_bands) matrix ordered like the bands."""
+        X = np.asarray(band_values, dtype=np.float64)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        gradient = np.empty(X.shape, dtype=np.float64)
+        if X.shape[1] == 0:
+            return gradient
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            partials = self._function(*np.ascontiguousarray(X.T))
+        for column, partial in enumerate(partials):
+            gradient[:, column] = partial
+        return gradient
+
+
+class SensitivityCompiler:
+    """Differentiates compiled indices with SymPy and lambdifies their gradients."""
+
+    def compile(self, index: CompiledIndex) -> IndexGradient:
+        sp = _sympy()
+        band_names = index.band_names
+        # Positional symbols, since band names need not be valid identifiers
+        symbols = [sp.Symbol(f"b{column}", real=True) for column in range(len(band_names))]
+        expression = tree_to_sympy(index.expression.tree, dict(zip(band_names, symbols)), sp)
+        partials = [sp.diff(expression, symbol) for symbol in symbols]
+        function = sp.lambdify(symbols, partials, modules=[KERNEL_NAMESPACE, 'numpy'], cse=True)
+        return IndexGradient(index.name, band_names, partials, function)
+
+    def compile_engine(self, engine: SpectralIndexEngine,
+                       index_names: Optional[Sequence[str]] = None) -> Tuple[Dict[str, IndexGradient], Dict[str, Exception]]:
+        """Compile the gradients of all (or selected) indices, returning the indices that failed."""
+        gradients = {}
+        errors = {}
+        for name in (engine.indices if index_names is None else index_names):
+            try:
+                gradients[name] = self.compile(engine.indices[name])
+            except Exception as e:
+                errors[name] = e
+        return gradients, errors
+
+
+class IndexUncertainty:
+    """Values, band gradients and first-order standard deviation of one index for a batch."""
+
+    def __init__(self, values: np.ndarray, gradients: np.ndarray, band_names: List[str], sd: np.ndarray):
+        self.values = values
+        # (n_samples, n_bands) partial derivatives, columns ordered like band_names
+        self.gradients = gradients
+        self.band_names = band_names
+        self.sd = sd
+
+
+class UncertaintyScorer:
+    """Scores indices together with their band gradients and propagated standard deviations."""
+
+    def __init__(self, engine: SpectralIndexEngine, gradients: Optional[Dict[str, IndexGradient]] = None):
+        self.engine = engine
+        if gradients is None:
+            gradients, errors = SensitivityCompiler().compile_engine(engine)
+            if errors:
+                name, error = next(iter(errors.items()))
+                raise ValueError(f"Cannot differentiate {name}: {error}")
+        self.gradients = gradients
+
+    def score(self, reflectance, plan: BandPlan, sigma, index_names: Optional[Sequence[str]] = None,
+              drop_empty: bool = False) -> Dict[str, IndexUncertainty]:
+        """Score a batch, propagating the channel standard deviations `sigma`.
+
+        `sigma` is a scalar, one value per channel or an (n_samples,
+        n_channels) matrix in reflectance units. Values, gradients and
+        standard deviations are NaN where the index is NA.
+        """
+        reflectance = np.asarray(reflectance, dtype=np.float64)
+        if reflectance.ndim == 1:
+            reflectance = reflectance.reshape(1, -1)
+        n_samples = reflectance.shape[0]
+        if index_names is None:
+            index_names = plan.index_names
+        active = plan.pruned()
+        values, selected = active.gather_values(reflectance)
+        invalid = active.invalid_mask(values, selected)
+        variance = np.broadcast_to(np.square(np.asarray(sigma, dtype=np.float64)), (n_samples, plan.n_channels))
+        weighted = {int(column): k for k, column in enumerate(active.weighted_bands)}
+        dynamic = {int(column) for column in active.dynamic_bands}
+        positions = {name: k for k, name in enumerate(active.index_names)}
+        known = set(plan.index_names)
+        results = {}
+        for name in index_names:
+            if name not in known:
+                continue
+            index = self.engine.indices[name]
+            k = positions.get(name)
+            if k is None or invalid[:, k].all():
+                if not drop_empty:
+                    empty = np.full(n_samples, np.nan)
+                    results[name] = IndexUncertainty(empty, np.full((n_samples, len(index.bands)), np.nan),
+                                                     index.band_names, empty.copy())
+                continue
+            columns = active.index_columns[name]
+            band_values = values[:, columns]
+            result = index.evaluate(band_values)
+            gradient = self.gradients[name](band_values)
+            with np.errstate(invalid='ignore', over='ignore'):
+                sd = np.sqrt(self._variance(active, columns, gradient, selected, variance, weighted, dynamic))
+            rows = invalid[:, k]
+            result[rows] = np.nan
+            gradient[rows] = np.nan
+            sd[rows] = np.nan
+            results[name] = IndexUncertainty(result, gradient, index.band_names, sd)
+        return results
+
+    def _variance(self, plan: BandPlan, columns: np.ndarray, gradient: np.ndarray, selected: np.ndarray,
+                  variance: np.ndarray, weighted: Dict[int, int], dynamic: set) -> np.ndarray:
+        rows = np.arange(gradient.shape[0])
+        if not any(int(column) in weighted for column in columns):
+            # Single-channel bands of a valid sample never share a channel
+            total = np.zeros(gradient.shape[0])
+            for band, column in enumerate(columns):
+                if column in dynamic:
+                    channel_variance = variance[rows, np.maximum(selected[:, column], 0)]
+                else:
+                    channel_variance = variance[:, max(plan.gather[column], 0)]
+                total += np.square(gradient[:, band]) * channel_variance
+            return total
+        # Weighted bands may overlap other bands, so sum the channel Jacobian first
+        jacobian = np.zeros((gradient.shape[0], plan.n_channels))
+        for band, column in enumerate(columns):
+            k = weighted.get(int(column))
+            if k is None:
+                jacobian[rows, np.maximum(selected[:, column], 0)] += gradient[:, band]
+            else:
+                channels, weights = plan.band_weights.column(k)
+                jacobian[:, channels] += gradient[:, band:band + 1] * weights
+        return (np.square(jacobian) * variance).sum(axis=1)
+
+
+def finite_difference_gradient(index: CompiledIndex, band_values: np.ndarray,
+                               relative_step: float = FINITE_DIFFERENCE_STEP) -> np.ndarray:
+    """Central-difference gradient of an index, for checking the compiled kernels."""
+    gradient = np.empty(band_values.shape, dtype=np.float64)
+    for column in range(band_values.shape[1]):
+        step = relative_step * np.maximum(np.abs(band_values[:, column]), 1.0)
+        upper = band_values.copy()
+        lower = band_values.copy()
+        upper[:, column] += step
+        lower[:, column] -= step
+        with np.errstate(invalid='ignore', over='ignore'):
+            gradient[:, column] = (index.evaluate(upper) - index.evaluate(lower)) / (2 * step)
+    return gradient
+
+
+def main():
+    """Compile the gradients of a catalogue and compare them with finite differences."""
+    if len(sys.argv) < 3:
+        print("Usage: python index_sensitivity.py <path_to_xml_folder> <sensor_json> [n_samples] [sigma]")
+        print("\nExample: python index_sensitivity.py ../inst/extdata/indices/ "
+              "../inst/extdata/sensors/20250905_B6448_S8330_VI25_FW2_AE_AC.json 100000 0.01")
+        print("\nRequirements:")
+        print("  pip install numpy sympy")
+        sys.exit(1)
+    engine = SpectralIndexEngine()
+    errors = engine.load_folder(Path(sys.argv[1]))
+    for file_name, error in errors.items():
+        print(f"❌ Error compiling {file_name}: {error}")
+    with open(sys.argv[2], 'r', encoding='utf-8') as f:
+        sensor_info = json.load(f)
+    plan = BandPlanner(engine.indices.values()).plan_for_sensor(sensor_info)
+
+    start = time.perf_counter()
+    gradients, failed = SensitivityCompiler().compile_engine(engine)
+    print(f"📄 Differentiated {len(gradients)} indices in {time.perf_counter() - start:.2f} s")
+    for name, error in failed.items():
+        print(f"❌ Error differentiating {name}: {error}")
+    if failed:
+        sys.exit(1)
+
+    n_samples = int(sys.argv[3]) if len(sys.argv) >= 4 else 100000
+    sigma = float(sys.argv[4]) if len(sys.argv) >= 5 else 0.01
+    reflectance = np.random.default_rng(0).uniform(0.01, 1.0, (n_samples, plan.n_channels))
+    scorer = UncertaintyScorer(engine, gradients)
+    start = time.perf_counter()
+    results = scorer.score(reflectance, plan, sigma, drop_empty=True)
+    analytic = time.perf_counter() - start
+    expected = engine.score(reflectance, plan, drop_empty=True)
+    identical = expected.keys() == results.keys() and all(
+        np.array_equal(expected[name], results[name].values, equal_nan=True) for name in expected)
+
+    active = plan.pruned()
+    values, _ = active.gather_values(reflectance)
+    start = time.perf_counter()
+    mismatched = []
+    for name, result in results.items():
+        band_values = values[:, active.index_columns[name]]
+        numeric = finite_difference_gradient(engine.indices[name], band_values)
+        # Near-singular denominators: only compare where a ten times larger step agrees
+        coarse = finite_difference_gradient(engine.indices[name], band_values, 10 * FINITE_DIFFERENCE_STEP)
+        with np.errstate(invalid='ignore'):
+            converged = np.abs(numeric - coarse) <= 1e-3 * np.maximum(np.abs(numeric), 1e-3)
+        compared = converged & np.isfinite(result.gradients)
+        if not np.allclose(result.gradients[compared], numeric[compared], rtol=1e-4, atol=1e-6):
+            mismatched.append(name)
+    numeric_time = time.perf_counter() - start
+    print(f"⏱️ {n_samples:,} samples, {len(results)} indices: values, gradients and SD {analytic * 1000:.1f} ms, "
+          f"finite-difference gradients (two step sizes) {numeric_time * 1000:.1f} ms")
+    median_sd = {name: np.nanmedian(result.sd) for name, result in results.items() if not np.isnan(result.sd).all()}
+    if median_sd:
+        widest = max(median_sd, key=median_sd.get)
+        print(f"📊 Median SD at sigma {sigma:g}: largest for {widest} ({median_sd[widest]:.4g})")
+    print("✅ Values identical to the engine" if identical else "❌ Values differ from the engine")
+    if mismatched:
+        print(f"⚠️ Gradients differ from finite differences for {len(mismatched)} indices: "
+              f"{', '.join(mismatched[:10])}")
+    else:
+        print("✅ Gradients match finite differences")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Pipeline Instrumentation
+
+Opt-in measurements for the Python scoring pipeline:
+
+- wall and CPU time per stage (decode, calibration, feature extraction,
+  band selection, scoring, output, ...)
+- evaluation time, NaN and Inf counts and errors per index
+- peak resident memory of the process (sampled when a stage ends)
+- an optional cProfile dump of the instrumented run
+
+Everything ends up in a JSON-serializable report; a callback can receive
+every finished stage as it happens. A disabled Instrumentation (the default
+NULL_INSTRUMENTATION) hands out one shared no-op context manager, so the
+cost in the hot path is a single attribute check.
+
+Requirements: none (standard library only)
+"""
+
+import cProfile
+import io
+import json
+import pstats
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional, Sequence
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_memory_mb() -> Optional[float]:
+    """Peak resident set size of this process in MB (None where unavailable)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class _NullStage:
+    """Shared do-nothing context manager used while instrumentation is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """Times one execution of a stage."""
+
+    def __init__(self, instrumentation: 'Instrumentation', name: str, items: int):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.add_stage(self.name, time.perf_counter() - self._wall,
+                                       time.process_time() - self._cpu, self.items)
+        return False
+
+
+class Instrumentation:
+    """Collects stage timers and per-index statistics of a scoring run."""
+
+    def __init__(self, enabled: bool = True, per_index: bool = True, profile: bool = False,
+                 callback: Optional[Callable[[Dict], None]] = None):
+        self.enabled = enabled
+        self.per_index = enabled and per_index
+        self.callback = callback
+        self.stages: Dict[str, Dict] = {}
+        self.indices: Dict[str, Dict] = {}
+        self.peak_memory_mb = None
+        self._profiler = cProfile.Profile() if enabled and profile else None
+        self._started = time.perf_counter()
+
+    def stage(self, name: str, items: int = 0):
+        """Context manager timing one stage execution over `items` samples."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, items)
+
+    def add_stage(self, name: str, wall: float, cpu: float, items: int = 0):
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = self.stages[name] = {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'items': 0}
+        entry['calls'] += 1
+        entry['wall_seconds'] += wall
+        entry['cpu_seconds'] += cpu
+        entry['items'] += items
+        self.peak_memory_mb = peak_memory_mb()
+        if self.callback is not None:
+            self.callback({'stage': name, 'wall_seconds': wall, 'cpu_seconds': cpu, 'items': items,
+                           'peak_memory_mb': self.peak_memory_mb})
+
+    def iterate(self, name: str, iterable):
+        """Iterate `iterable`, timing the production of every item as one call of stage `name`."""
+        if not self.enabled:
+            return iterable
+        return self._timed_iteration(name, iterable)
+
+    def _timed_iteration(self, name: str, iterable):
+        iterator = iter(iterable)
+        while True:
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add_stage(name, time.perf_counter() - wall, time.process_time() - cpu,
+                           len(item) if hasattr(item, '__len__') else 1)
+            yield item
+
+    def _index_entry(self, name: str) -> Dict:
+        entry = self.indices.get(name)
+        if entry is None:
+            entry = self.indices[name] = {'seconds': 0.0, 'values': 0, 'nan': 0, 'inf': 0, 'errors': 0,
+                                          'last_error': None}
+        return entry
+
+    def record_index(self, name: str, result, seconds: Optional[float] = None):
+        """Add the evaluation time and NaN/Inf counts of one index result."""
+        entry = self._index_entry(name)
+        if seconds is not None:
+            entry['seconds'] += seconds
+        entry['values'] += int(result.size)
+        # NaN and Inf counts come from one isnan/isinf pass each
+        from numpy import isinf, isnan
+        entry['nan'] += int(isnan(result).sum())
+        entry['inf'] += int(isinf(result).sum())
+
+    def record_error(self, name: str, error: Exception):
+        """Count an evaluation error of an index instead of only printing it."""
+        entry = self._index_entry(name)
+        entry['errors'] += 1
+        entry['last_error'] = f"{type(error).__name__}: {error}"
+
+    def start_profile(self):
+        if self._profiler is not None:
+            self._profiler.enable()
+
+    def stop_profile(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+
+    def dump_profile(self, output_file: Path):
+        """Write the collected cProfile statistics (readable with pstats or snakeviz)."""
+        if self._profiler is not None:
+            self._profiler.dump_stats(str(output_file))
+
+    def profile_summary(self, limit: int = 20) -> Optional[str]:
+        if self._profiler is None:
+            return None
+        stream = io.StringIO()
+        pstats.Stats(self._profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+    def merge(self, report: Dict):
+        """Add the stages and index statistics of another report (e.g. from a worker process)."""
+        for name, stage in report.get('stages', {}).items():
+            entry = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'items': 0})
+            for key in ('calls', 'wall_seconds', 'cpu_seconds', 'items'):
+                entry[key] += stage[key]
+        for name, index in report.get('indices', {}).items():
+            entry = self._index_entry(name)
+            for key in ('seconds', 'values', 'nan', 'inf', 'errors'):
+                entry[key] += index[key]
+            entry['last_error'] = index['last_error'] or entry['last_error']
+        peaks = [value for value in (self.peak_memory_mb, report.get('peak_memory_mb')) if value is not None]
+        self.peak_memory_mb = max(peaks) if peaks else None
+
+    def report(self) -> Dict:
+        """Structured report of everything measured so far."""
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage, items_per_second=stage['items'] / stage['wall_seconds']
+                                if stage['items'] and stage['wall_seconds'] > 0 else None)
+        return {
+            'elapsed_seconds': time.perf_counter() - self._started,
+            'peak_memory_mb': self.peak_memory_mb if self.peak_memory_mb is not None else peak_memory_mb(),
+            'stages': stages,
+            'indices': self.indices,
+        }
+
+    def write_json(self, output_file: Path):
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+
+def merge_profiles(profile_files: Sequence[Path], output_file: Path) -> bool:
+    """Combine cProfile dumps (e.g. one per worker task) into one file."""
+    profile_files = [str(path) for path in profile_files if Path(path).exists()]
+    if not profile_files:
+        return False
+    stats = pstats.Stats(profile_files[0])
+    for path in profile_files[1:]:
+        stats.add(path)
+    stats.dump_stats(str(output_file))
+    return True
+
+
+NULL_INSTRUMENTATION = Instrumentation(enabled=False)
@@ -6,13 +6,22 @@ This script reads XML files containing MathML formulas and generates PNG images
 showing the mathematical formula with variable descriptions.
 Uses SymPy for robust MathML to LaTeX conversion.
 
+The MathML itself is parsed by the dependency-free mathml_core.py; SymPy is
+imported on the first LaTeX or SymPy string conversion, so importing this
+module stays cheap.
+
 Usage: python mathml_converter.py <path_to_xml_folder>
 
 Requirements: pip install sympy matplotlib
 """
 
-import sympy as sp
-from sympy import symbols, latex, sqrt, Integer, Float, Symbol, Abs, Function, Mul, Add, Pow, Rational
+from mathml_core import parse_formula
+
+
+def _sympy():
+    """Import SymPy on first use (about a second on a cold start)."""
+    import sympy
+    return sympy
 
 
 class MathMLConverter:
@@ -26,10 +35,12 @@ class MathMLConverter:
         """Convert MathML element to LaTeX string using SymPy."""
         if mathml_element is None:
             return ""
+        # Resolved outside the try, so a missing SymPy is an ImportError and not an empty formula
+        sp = _sympy()
         try:
             expr = self._convert_to_sympy(mathml_element)
             if expr is not None:
-                latex_str = latex(expr)
+                latex_str = sp.latex(expr)
                 latex_str = self._fix_variable_names(latex_str)
                 return latex_str
             else:
@@ -42,6 +53,7 @@ class MathMLConverter:
         """Convert MathML element to SymPy expression string."""
         if mathml_element is None:
             return ""
+        _sympy()
         
         try:
             # Convert MathML to SymPy expression
@@ -59,95 +71,64 @@ class MathMLConverter:
     
     def _convert_to_sympy(self, elem):
         """Recursively convert MathML elements to SymPy expressions, without simplification."""
-        if elem is None:
-            return None
+        return self._tree_to_sympy(parse_formula(elem), _sympy())
 
-        tag = elem.tag.split('}')[-1] if '}' in elem.tag else elem.tag
-        
-        if tag == 'math':
-            children = list(elem)
-            if children:
-                return self._convert_to_sympy(children[0])
+    def _tree_to_sympy(self, node, sp):
+        """Build the SymPy expression of a mathml_core tree."""
+        if node is None:
             return None
-        
-        elif tag == 'apply':
-            children = list(elem)
-            if len(children) < 2:
-                return None
-            operation = children[0].tag.split('}')[-1] if '}' in children[0].tag else children[0].tag
-            operands = children[1:]
-            sympy_operands = []
-            for operand in operands:
-                converted = self._convert_to_sympy(operand)
-                if converted is not None:
-                    sympy_operands.append(converted)
-            if not sympy_operands:
-                return None
-            if operation == 'divide' and len(sympy_operands) == 2:
-                return Mul(sympy_operands[0], Pow(sympy_operands[1], -1, evaluate=False), evaluate=False)
-            elif operation == 'times':
-                return Mul(*sympy_operands, evaluate=False)
-            elif operation == 'plus':
-                return Add(*sympy_operands, evaluate=False)
-            elif operation == 'minus':
-                if len(sympy_operands) == 1:
-                    return Mul(-1, sympy_operands[0], evaluate=False)
-                else:
-                    first = sympy_operands[0]
-                    rest = [Mul(-1, op, evaluate=False) for op in sympy_operands[1:]]
-                    return Add(first, *rest, evaluate=False)
-            elif operation == 'power' and len(sympy_operands) == 2:
-                return Pow(sympy_operands[0], sympy_operands[1], evaluate=False)
-            elif operation == 'root':
-                if len(sympy_operands) == 1:
-                    return Pow(sympy_operands[0], Rational(1, 2), evaluate=False)
-                elif len(sympy_operands) == 2:
-                    return Pow(sympy_operands[0], Pow(sympy_operands[1], -1, evaluate=False), evaluate=False)
-            elif operation == "abs":
-                return Abs(sympy_operands[0], evaluate=False)
-            elif operation == 'ln':
-                return sp.log(sympy_operands[0], evaluate=False)
-            elif operation == "csymbol":
-                csymbol_elem = children[0]
-                csymbol_value = csymbol_elem.text.strip() if csymbol_elem.text else ''
-                CustomFunc = Function(csymbol_value)
-                return CustomFunc(*sympy_operands, evaluate=False)
-        elif tag == 'ci':
-            text = elem.text.strip() if elem.text else ''
-            if not text:
-                return None
+        kind = node[0]
+        if kind == 'ci':
+            text = node[1]
             if text not in self.variables:
                 try:
-                    self.variables[text] = Symbol(text)
+                    self.variables[text] = sp.Symbol(text)
                 except:
                     safe_name = text.replace(':', '_colon_').replace('-', '_dash_')
-                    self.variables[text] = Symbol(safe_name)
+                    self.variables[text] = sp.Symbol(safe_name)
             return self.variables[text]
-        elif tag == 'cn':
-            text = elem.text.strip() if elem.text else '0'
+        elif kind == 'mi':
+            return sp.Symbol(node[1])
+        elif kind == 'cn':
+            text = node[1]
             try:
                 if '.' in text:
-                    return Float(text)
+                    return sp.Float(text)
                 else:
-                    return Integer(text)
+                    return sp.Integer(text)
             except:
-                return Float(0)
-        elif tag == 'mi':
-            text = elem.text.strip() if elem.text else ''
-            if text:
-                return Symbol(text)
-        elif tag == 'mn':
-            text = elem.text.strip() if elem.text else '0'
-            try:
-                if '.' in text:
-                    return Float(text)
-                else:
-                    return Integer(text)
-            except:
-                return Float(0)
-        children = list(elem)
-        if len(children) == 1:
-            return self._convert_to_sympy(children[0])
+                return sp.Float(0)
+
+        Mul, Add, Pow = sp.Mul, sp.Add, sp.Pow
+        operands = node[2:] if kind == 'csymbol' else node[1:]
+        sympy_operands = [self._tree_to_sympy(operand, sp) for operand in operands]
+        if kind == 'divide' and len(sympy_operands) == 2:
+            return Mul(sympy_operands[0], Pow(sympy_operands[1], -1, evaluate=False), evaluate=False)
+        elif kind == 'times':
+            return Mul(*sympy_operands, evaluate=False)
+        elif kind == 'plus':
+            return Add(*sympy_operands, evaluate=False)
+        elif kind == 'minus':
+            if len(sympy_operands) == 1:
+                return Mul(-1, sympy_operands[0], evaluate=False)
+            else:
+                first = sympy_operands[0]
+                rest = [Mul(-1, op, evaluate=False) for op in sympy_operands[1:]]
+                return Add(first, *rest, evaluate=False)
+        elif kind == 'power' and len(sympy_operands) == 2:
+            return Pow(sympy_operands[0], sympy_operands[1], evaluate=False)
+        elif kind == 'root':
+            if len(sympy_operands) == 1:
+                return Pow(sympy_operands[0], sp.Rational(1, 2), evaluate=False)
+            elif len(sympy_operands) == 2:
+                return Pow(sympy_operands[0], Pow(sympy_operands[1], -1, evaluate=False), evaluate=False)
+        elif kind == "abs":
+            return sp.Abs(sympy_operands[0], evaluate=False)
+        elif kind == 'ln':
+            return sp.log(sympy_operands[0], evaluate=False)
+        elif kind == "csymbol":
+            CustomFunc = sp.Function(node[1])
+            return CustomFunc(*sympy_operands, evaluate=False)
         return None
     
     def _fix_variable_names(self, latex_str: str) -> str:
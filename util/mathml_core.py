@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+MathML Formula Core
+
+Dependency-free part of the MathML handling: parsing the <math> element of an
+index XML into a nested tuple tree. Nothing here imports SymPy, matplotlib or
+NumPy, so short-lived workers and request handlers can parse formulas without
+paying for the heavy imports:
+
+- index_engine.py compiles formulas to NumPy for evaluation (numpy only)
+- mathml_converter.py turns the tree into SymPy/LaTeX, importing SymPy only
+  when such output is requested
+
+Tree nodes:
+
+    ('ci', name)                 band variable
+    ('mi', name)                 presentation identifier
+    ('cn', text)                 number, as written in the XML
+    (operator, operand, ...)     <apply>, e.g. ('divide', a, b)
+    ('csymbol', name, operand, ...)
+
+Usage: python mathml_core.py <path_to_xml_folder>
+
+Requirements: none (standard library only)
+"""
+
+import sys
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+
+MATHML_NAMESPACE = 'http://www.w3.org/1998/Math/MathML'
+
+
+def local_name(tag: str) -> str:
+    """Strip the namespace from an XML tag."""
+    return tag.split('}')[-1] if '}' in tag else tag
+
+
+def parse_formula(elem) -> Optional[Tuple]:
+    """Parse a MathML element into a tuple tree, leniently as MathMLConverter always did.
+
+    Elements that cannot be converted are dropped (operands) or give None
+    (the whole expression); unlike MathMLCompiler.parse() no operator or
+    arity is validated here.
+    """
+    if elem is None:
+        return None
+    tag = local_name(elem.tag)
+    children = list(elem)
+
+    if tag == 'math':
+        return parse_formula(children[0]) if children else None
+
+    if tag == 'apply':
+        if len(children) < 2:
+            return None
+        operands = tuple(node for node in (parse_formula(child) for child in children[1:]) if node is not None)
+        if not operands:
+            return None
+        operator = local_name(children[0].tag)
+        if operator == 'csymbol':
+            name = children[0].text.strip() if children[0].text else ''
+            return ('csymbol', name) + operands
+        return (operator,) + operands
+
+    if tag in ('ci', 'mi'):
+        text = elem.text.strip() if elem.text else ''
+        return (tag, text) if text else None
+
+    if tag in ('cn', 'mn'):
+        return ('cn', elem.text.strip() if elem.text else '0')
+
+    if len(children) == 1:
+        return parse_formula(children[0])
+    return None
+
+
+def formula_variables(node: Optional[Tuple]) -> List[str]:
+    """The <ci> names of a tree in order of first use."""
+    names = []
+    stack = [node] if node is not None else []
+    while stack:
+        current = stack.pop()
+        if current[0] == 'ci':
+            if current[1] not in names:
+                names.append(current[1])
+        elif current[0] not in ('mi', 'cn'):
+            operands = current[2:] if current[0] == 'csymbol' else current[1:]
+            stack.extend(reversed(operands))
+    return names
+
+
+def main():
+    """Parse every index XML of a folder and report the time taken."""
+    if len(sys.argv) != 2:
+        print("Usage: python mathml_core.py <path_to_xml_folder>")
+        print("\nExample: python mathml_core.py ../inst/extdata/indices")
+        print("\nRequirements: none (standard library only)")
+        sys.exit(1)
+    xml_files = sorted(Path(sys.argv[1]).glob("*.xml"))
+    start = time.perf_counter()
+    parsed = 0
+    for xml_file in xml_files:
+        mathml = ET.parse(xml_file).getroot().find('MathML')
+        if parse_formula(mathml) is not None:
+            parsed += 1
+        else:
+            print(f"⚠️ No formula in {xml_file.name}")
+    elapsed = time.perf_counter() - start
+    print(f"✅ Parsed {parsed} of {len(xml_files)} formulas in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Float32 Precision Validation
+
+Scores the inputs behind the shipped expected index tables in double and in
+single precision (score_exports.py --float32), reports per index the maximum
+absolute and relative deviation between both, and flags the indices whose
+single precision result is not within tolerance:
+
+    |float32 - float64| > atol + rtol * |float64|
+
+or that turn NaN/Inf in only one of the precisions. Differences of nearly
+equal reflectances, ratios with a denominator near zero, ln and power are the
+usual suspects.
+
+Indices are kept in double precision with a safety margin: when their worst
+deviation exceeds 1/--margin of the tolerance, or on any NaN/Inf mismatch.
+The worst deviation of an index depends on the drawn samples and on the
+float32 math of the CPU, so indices close to the tolerance would otherwise
+flip between runs. They are written to float32_overrides.json together with
+the tolerances, margin, seed and inputs that selected them; the float32 mode
+reads it to keep them in double precision.
+
+Besides the recorded samples, every input is expanded to --synthetic samples
+with 5% multiplicative noise drawn from --seed, so rare near-singular cases
+are covered too. The float64 results are also compared with the expected
+tables themselves.
+
+Usage: python precision_validation.py [--rtol 1e-4] [--atol 1e-6] [--margin 10] [--synthetic 5000] [--seed 0]
+           [--report report.json] [--write-overrides [float32_overrides.json]]
+
+Requirements: pip install numpy
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+DEFAULT_OVERRIDES_FILE = Path(__file__).resolve().parent / 'float32_overrides.json'
+DEFAULT_RTOL = 1e-4
+DEFAULT_ATOL = 1e-6
+DEFAULT_SYNTHETIC_SAMPLES = 5000
+DEFAULT_MARGIN = 10.0
+DEFAULT_SEED = 0
+
+# (expected table, input file, sensor serial of a reflectance list)
+VALIDATION_CASES = [
+    ('tests/testthat/data/test-calculate-indices-list_expectedTable.csv',
+     'tests/testthat/data/2025-05-23_ColorChecker_B7696_S3956.json', None),
+    ('tests/testthat/data/test-calculate-indices-avail_expectedTable.csv',
+     'tests/testthat/data/20250121_003131_Agave_B8861_S4343.json', None),
+    ('example/data/Compolytics_R-Package_VI_Test_File_Indices.csv',
+     'example/data/Compolytics_R-Package_VI_Test_File.json', None),
+    ('example/data/Reflectance_List_S8330_ColorChecker_Indices.csv',
+     'example/data/Reflectance_List_S8330_ColorChecker.csv', '8330'),
+]
+
+# Operators whose conditioning is poor near parts of their domain
+SENSITIVE_OPERATORS = ('ln', 'power', 'root', 'rgb2hue')
+
+
+def load_float64_indices(overrides_file: Optional[Path] = None) -> Set[str]:
+    """Indices kept in double precision in float32 mode (empty if the file does not exist)."""
+    overrides_file = Path(DEFAULT_OVERRIDES_FILE if overrides_file is None else overrides_file)
+    if not overrides_file.exists():
+        return set()
+    with open(overrides_file, 'r', encoding='utf-8') as f:
+        return set(json.load(f).get('float64_indices', []))
+
+
+def r_column_name(name: str) -> str:
+    """Column name as R's make.names() (check.names) turns it into, e.g. SR[800,550] -> SR.800.550."""
+    name = re.sub(r'[^A-Za-z0-9._]', '.', name)
+    return name if re.match(r'[A-Za-z.]', name) and not re.match(r'\.[0-9]', name) else 'X' + name
+
+
+def tree_operators(node: Tuple) -> Set[str]:
+    if node[0] in ('ci', 'cn'):
+        return set()
+    operators = {node[0]}
+    for child in node[1:]:
+        operators |= tree_operators(child)
+    return operators
+
+
+class DeviationStats:
+    """Running per-index deviation statistics."""
+
+    def __init__(self):
+        self.values = 0
+        self.max_abs = 0.0
+        self.max_rel = 0.0
+        # Largest deviation as a fraction of the tolerance atol + rtol * |reference|
+        self.max_ratio = 0.0
+        self.violations = 0
+        self.nan_mismatch = 0
+
+    def add(self, reference: np.ndarray, other: np.ndarray, rtol: float, atol: float):
+        reference = np.asarray(reference, dtype=np.float64)
+        other = np.asarray(other, dtype=np.float64)
+        finite = np.isfinite(reference) & np.isfinite(other)
+        # NaN and Inf must agree exactly
+        self.nan_mismatch += int(np.sum(~finite & ~((np.isnan(reference) & np.isnan(other)) |
+                                                    (reference == other))))
+        self.values += int(finite.sum())
+        if finite.any():
+            difference = np.abs(other[finite] - reference[finite])
+            scale = np.abs(reference[finite])
+            self.max_abs = max(self.max_abs, float(difference.max()))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                relative = np.where(scale > 0, difference / scale, np.where(difference > 0, np.inf, 0.0))
+            self.max_rel = max(self.max_rel, float(relative.max()))
+            tolerance = atol + rtol * scale
+            self.max_ratio = max(self.max_ratio, float((difference / tolerance).max()))
+            self.violations += int(np.sum(difference > tolerance))
+
+    @property
+    def failed(self) -> bool:
+        return self.violations > 0 or self.nan_mismatch > 0
+
+    def exceeds(self, fraction: float) -> bool:
+        """Whether a deviation exceeded `fraction` of the tolerance or NaN/Inf differ."""
+        return self.max_ratio > fraction or self.nan_mismatch > 0
+
+    def as_dict(self) -> Dict:
+        return {'values': self.values, 'max_abs': self.max_abs, 'max_rel': self.max_rel,
+                'max_ratio': self.max_ratio, 'violations': self.violations, 'nan_mismatch': self.nan_mismatch}
+
+
+class PrecisionValidator:
+    """Scores the validation inputs in both precisions and collects deviations per index."""
+
+    def __init__(self, catalogue_path: Optional[Path], xml_folder: Optional[Path] = None, rtol: float = DEFAULT_RTOL,
+                 atol: float = DEFAULT_ATOL, synthetic_samples: int = DEFAULT_SYNTHETIC_SAMPLES, seed: int = DEFAULT_SEED,
+                 margin: float = DEFAULT_MARGIN):
+        from score_exports import DEFAULT_XML_FOLDER, ExportScorer
+        self.scorer = ExportScorer(catalogue_path, xml_folder or DEFAULT_XML_FOLDER)
+        self.rtol = rtol
+        self.atol = atol
+        self.synthetic_samples = synthetic_samples
+        self.seed = seed
+        self.margin = margin
+        self.rng = np.random.default_rng(seed)
+        self.float32: Dict[str, DeviationStats] = {}
+        self.expected: Dict[str, DeviationStats] = {}
+        self.cases: List[Dict] = []
+
+    def _inputs(self, input_file: Path, sensor: Optional[str]):
+        """(reflectance, wavelengths, fwhm, valid_vi) of every batch of an input file."""
+        if input_file.suffix.lower() == '.csv':
+            from reflectance_list_reader import ReflectanceListReader, reflectance_list_grid
+            reader = ReflectanceListReader(input_file)
+            sensor_info = self.scorer.registry.find_sensor_metadata(sensor) if sensor else None
+            wavelengths, fwhm = reflectance_list_grid(sensor_info, reader.wavelengths)
+            yield reader.read().values, wavelengths, fwhm, (sensor_info or {}).get('valid_vi')
+            return
+        for batch in self.scorer.decoder.iter_batches(input_file):
+            features, feature_plan, external = self.scorer.reflectance(batch)
+            yield features, feature_plan.wavelengths, feature_plan.fwhm, self.scorer.valid_vi(batch, external)
+
+    def _score(self, reflectance, wavelengths, fwhm, valid_vi, dtype) -> Dict[str, np.ndarray]:
+        self.scorer.dtype = np.dtype(dtype)
+        self.scorer.float64_indices = frozenset()
+        return self.scorer.score_reflectance(reflectance, wavelengths, fwhm, valid_vi)
+
+    def _compare_precisions(self, reflectance, wavelengths, fwhm, valid_vi) -> Dict[str, np.ndarray]:
+        double = self._score(reflectance, wavelengths, fwhm, valid_vi, np.float64)
+        single = self._score(reflectance, wavelengths, fwhm, valid_vi, np.float32)
+        for name, values in double.items():
+            self.float32.setdefault(name, DeviationStats()).add(values, single[name], self.rtol, self.atol)
+        return double
+
+    def run_case(self, expected_table: Path, input_file: Path, sensor: Optional[str] = None):
+        scores: Dict[str, List[np.ndarray]] = {}
+        n_samples = 0
+        for reflectance, wavelengths, fwhm, valid_vi in self._inputs(input_file, sensor):
+            for name, values in self._compare_precisions(reflectance, wavelengths, fwhm, valid_vi).items():
+                scores.setdefault(name, []).append(values)
+            n_samples += len(reflectance)
+            if self.synthetic_samples > 0 and len(reflectance):
+                rows = self.rng.integers(0, len(reflectance), self.synthetic_samples)
+                noise = self.rng.normal(1.0, 0.05, (self.synthetic_samples, reflectance.shape[1]))
+                self._compare_precisions(reflectance[rows] * noise, wavelengths, fwhm, valid_vi)
+        matched, differing = self._compare_expected(expected_table, scores, n_samples)
+        self.cases.append({'expected_table': str(expected_table), 'input': str(input_file), 'samples': n_samples,
+                           'matched_columns': matched, 'differing_columns': differing})
+
+    def _compare_expected(self, expected_table: Path, scores: Dict[str, List[np.ndarray]],
+                          n_samples: int) -> Tuple[int, List[str]]:
+        """Compare the float64 scores with the expected table, matching R column names.
+
+        Returns the number of compared columns and the indices outside tolerance.
+        """
+        with open(expected_table, 'r', encoding='utf-8', newline='') as f:
+            rows = list(csv.reader(f, delimiter=';'))
+        header = rows[0]
+        if len(rows) - 1 != n_samples:
+            print(f"⚠️ {expected_table.name}: {len(rows) - 1} rows, but {n_samples} samples scored")
+            return 0, []
+        by_r_name = {r_column_name(name): name for name in scores}
+        matched = 0
+        differing = []
+        for j, column in enumerate(header):
+            name = by_r_name.get(column)
+            if name is None:
+                continue
+            expected = np.asarray([np.nan if row[j] in ('NA', '') else float(row[j]) for row in rows[1:]])
+            stats = DeviationStats()
+            stats.add(expected, np.concatenate(scores[name]), self.rtol, self.atol)
+            if stats.failed:
+                differing.append(name)
+            self.expected.setdefault(name, DeviationStats()).add(expected, np.concatenate(scores[name]),
+                                                                 self.rtol, self.atol)
+            matched += 1
+        return matched, differing
+
+    def flagged(self) -> List[str]:
+        """Indices to keep in double precision: beyond 1/margin of the tolerance in float32."""
+        return sorted(name for name, stats in self.float32.items() if stats.exceeds(1 / self.margin))
+
+    def settings(self) -> Dict:
+        """Tolerances, margin and sample set of the selection, as recorded in the overrides file."""
+        return {'rtol': self.rtol, 'atol': self.atol, 'margin': self.margin, 'seed': self.seed,
+                'synthetic_samples': self.synthetic_samples,
+                'inputs': [os.path.relpath(case['input'], REPO_DIR) for case in self.cases],
+                'numpy': np.__version__}
+
+    def report(self) -> Dict:
+        indices = {}
+        for name in sorted(self.float32):
+            operators = tree_operators(self.scorer.engine.indices[name].expression.tree)
+            indices[name] = {
+                'float32': self.float32[name].as_dict(),
+                'expected': self.expected[name].as_dict() if name in self.expected else None,
+                'sensitive_operators': sorted(operators & set(SENSITIVE_OPERATORS)),
+                'float64_required': self.float32[name].exceeds(1 / self.margin),
+            }
+        return dict(self.settings(), cases=self.cases, float64_indices=self.flagged(), indices=indices)
+
+    def write_overrides(self, output_file: Path):
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(dict(self.settings(), float64_indices=self.flagged()), f, indent=2)
+            f.write('\n')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Validate float32 scoring against float64 and the expected tables.")
+    parser.add_argument('--rtol', type=float, default=DEFAULT_RTOL, help=f"Relative tolerance (default: {DEFAULT_RTOL})")
+    parser.add_argument('--atol', type=float, default=DEFAULT_ATOL, help=f"Absolute tolerance (default: {DEFAULT_ATOL})")
+    parser.add_argument('--margin', type=float, default=DEFAULT_MARGIN,
+                        help=f"Keep indices in float64 beyond 1/MARGIN of the tolerance (default: {DEFAULT_MARGIN:g})")
+    parser.add_argument('--synthetic', type=int, default=DEFAULT_SYNTHETIC_SAMPLES,
+                        help=f"Noisy samples added per input batch (default: {DEFAULT_SYNTHETIC_SAMPLES})")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+                        help=f"Seed of the synthetic samples (default: {DEFAULT_SEED})")
+    parser.add_argument('--catalogue', type=Path,
+                        help="Compiled index catalogue, rebuilt when missing or stale (default: in the user cache directory)")
+    parser.add_argument('--report', type=Path, help="Write the full report (JSON) to this file")
+    parser.add_argument('--write-overrides', type=Path, nargs='?', const=DEFAULT_OVERRIDES_FILE,
+                        help="Write the flagged indices for --float32 scoring (default: float32_overrides.json)")
+    parser.add_argument('--show', type=int, default=15, help="Number of worst indices to print")
+    return parser.parse_args()
+
+
+def main():
+    """Run all validation cases and report the deviations."""
+    args = parse_arguments()
+    validator = PrecisionValidator(args.catalogue, rtol=args.rtol, atol=args.atol, synthetic_samples=args.synthetic,
+                                   seed=args.seed, margin=args.margin)
+    for expected_table, input_file, sensor in VALIDATION_CASES:
+        expected_table = REPO_DIR / expected_table
+        input_file = REPO_DIR / input_file
+        if not expected_table.exists() or not input_file.exists():
+            print(f"⚠️ Skipping {expected_table.name}: file not found")
+            continue
+        validator.run_case(expected_table, input_file, sensor)
+        case = validator.cases[-1]
+        print(f"📄 {expected_table.name}: {case['samples']} samples, {case['matched_columns']} columns compared")
+        if case['differing_columns']:
+            # The expected table was written by an older catalogue or sensor file, or the port deviates
+            print(f"   ⚠️ float64 differs from the table for {len(case['differing_columns'])} columns: "
+                  f"{', '.join(case['differing_columns'][:8])}{' ...' if len(case['differing_columns']) > 8 else ''}")
+
+    report = validator.report()
+    print(f"\n{'Index':<20} {'float32 max abs':>16} {'max rel':>10} {'of tol':>8} {'NaN diff':>9} "
+          f"{'expected max abs':>17}")
+    worst = sorted(report['indices'].items(), key=lambda item: -item[1]['float32']['max_ratio'])
+    for name, entry in worst[:args.show]:
+        expected = entry['expected']
+        print(f"{name:<20} {entry['float32']['max_abs']:>16.3g} {entry['float32']['max_rel']:>10.3g} "
+              f"{entry['float32']['max_ratio']:>8.3g} "
+              f"{entry['float32']['nan_mismatch']:>9} {expected['max_abs'] if expected else float('nan'):>17.3g}")
+    print(f"\n{'='*60}")
+    print(f"📊 float32 within 1/{args.margin:g} of the tolerance: "
+          f"{len(report['indices']) - len(report['float64_indices'])} of {len(report['indices'])} indices")
+    if report['float64_indices']:
+        print(f"⚠️ Kept in float64 ({len(report['float64_indices'])}): {', '.join(report['float64_indices'])}")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"📄 Report saved to: {args.report.absolute()}")
+    if args.write_overrides:
+        validator.write_overrides(args.write_overrides)
+        print(f"📄 Overrides saved to: {args.write_overrides.absolute()}")
+    print(f"{'='*60}")
+
+
+if __name__ == "__main__":
+    main()
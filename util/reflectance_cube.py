@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+Memory-Mapped Reflectance Cubes
+
+Binary storage for decoded and calibrated reflectance, so that repeated
+scoring runs never parse the JSON exports or the 20-digit reflectance-list
+CSVs again. A cube holds one wavelength grid; its sample matrix is stored
+contiguously and handed to the index engine as a read-only view of the
+memory-mapped file.
+
+Cube layout (little endian):
+    8 bytes   magic b"SCREFCUB"
+    4 bytes   format version (uint32)
+    8 bytes   header length (uint64)
+    8 bytes   number of samples (uint64, written when the cube is closed)
+    n bytes   UTF-8 JSON header (dtype, wavelengths, fwhm, sensor serial, valid_vi, source)
+    padding   to 64 byte alignment
+    samples   n_samples x n_channels float32 or float64, row-major
+
+Metadata (LabelName, uuid, ...) goes to a columnar sidecar "<cube>.meta":
+    8 bytes   magic b"SCREFMET"
+    4 bytes   format version (uint32)
+    8 bytes   header length (uint64)
+    n bytes   UTF-8 JSON header (columns and their array offsets)
+    padding   to 8 byte alignment
+    arrays    int64/float64 columns, or int64 offsets + UTF-8 bytes + validity for strings
+
+Usage: python reflectance_cube.py <export.json | reflectance_list.csv | cube.srcube> [output.srcube]
+           [--sensor S8330] [--float32] [--no-average] [--no-multipoint]
+
+Requirements: pip install numpy
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from reflectance_list_reader import ReflectanceListReader, reflectance_list_grid
+
+
+CUBE_MAGIC = b"SCREFCUB"
+META_MAGIC = b"SCREFMET"
+FORMAT_VERSION = 1
+CUBE_SUFFIX = '.srcube'
+META_SUFFIX = '.meta'
+DATA_ALIGNMENT = 64
+DEFAULT_CUBE_BATCH_SIZE = 65536
+
+_PREFIX = struct.Struct('<IQQ')
+
+
+def meta_path(cube_path: Path) -> Path:
+    cube_path = Path(cube_path)
+    return cube_path.with_name(cube_path.name + META_SUFFIX)
+
+
+def _meta_value(value):
+    """Metadata values are numbers, strings or None; anything else is stored as JSON text."""
+    if isinstance(value, bool):
+        return str(value).upper()
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return json.dumps(value)
+
+
+class ReflectanceCubeWriter:
+    """Streams reflectance batches into a cube file and its metadata sidecar."""
+
+    def __init__(self, output_file: Path, wavelengths, fwhm=None, sensor_serial: Optional[str] = None,
+                 valid_vi: Optional[Sequence[str]] = None, dtype: str = 'float64', source: Optional[str] = None):
+        self.output_file = Path(output_file)
+        self.wavelengths = np.asarray(wavelengths, dtype=np.float64).ravel()
+        self.fwhm = None if fwhm is None else np.asarray(fwhm, dtype=np.float64).ravel()
+        if self.fwhm is not None and len(self.fwhm) != len(self.wavelengths):
+            raise ValueError(f"{len(self.fwhm)} FWHM values for {len(self.wavelengths)} wavelengths")
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        if self.dtype.kind != 'f' or self.dtype.itemsize not in (4, 8):
+            raise ValueError(f"Unsupported cube dtype: {dtype}")
+        self.n_samples = 0
+        self._meta: Dict[str, List] = {}
+        header = json.dumps({
+            'dtype': self.dtype.str,
+            'n_channels': len(self.wavelengths),
+            # None for NaN, so the header stays valid JSON
+            'wavelengths': [None if np.isnan(w) else float(w) for w in self.wavelengths],
+            'fwhm': None if self.fwhm is None else [None if np.isnan(w) else float(w) for w in self.fwhm],
+            'sensor_serial': sensor_serial,
+            'valid_vi': None if valid_vi is None else [str(name) for name in valid_vi],
+            'source': source,
+        }).encode('utf-8')
+        prefix = CUBE_MAGIC + _PREFIX.pack(FORMAT_VERSION, len(header), 0) + header
+        prefix += b'\0' * (-len(prefix) % DATA_ALIGNMENT)
+        # Own temp file per writer, so conversions to the same output do not write into each other's data
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=self.output_file.name + '.',
+                                            dir=self.output_file.parent)
+        self._tmp_file = Path(tmp_path)
+        self._file = os.fdopen(handle, 'wb')
+        self._file.write(prefix)
+
+    def write_batch(self, reflectance, meta: Optional[Dict[str, Sequence]] = None):
+        """Append (n_samples, n_channels) reflectance and the matching metadata columns."""
+        reflectance = np.asarray(reflectance)
+        if reflectance.ndim == 1:
+            reflectance = reflectance.reshape(1, -1)
+        if reflectance.shape[1] != len(self.wavelengths):
+            raise ValueError(f"Reflectance has {reflectance.shape[1]} channels, cube has {len(self.wavelengths)}")
+        n_rows = reflectance.shape[0]
+        meta = meta or {}
+        for name in set(self._meta) | set(meta):
+            # Columns appearing later are missing for the earlier samples
+            column = self._meta.setdefault(name, [None] * self.n_samples)
+            values = meta.get(name)
+            column.extend([None] * n_rows if values is None else [_meta_value(value) for value in values])
+        self._file.write(np.ascontiguousarray(reflectance, dtype=self.dtype).tobytes())
+        self.n_samples += n_rows
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.seek(len(CUBE_MAGIC) + 12)
+        self._file.write(struct.pack('<Q', self.n_samples))
+        self._file.close()
+        self._file = None
+        try:
+            _write_meta(meta_path(self.output_file), self._meta, self.n_samples)
+        except BaseException:
+            self._tmp_file.unlink(missing_ok=True)
+            raise
+        os.replace(self._tmp_file, self.output_file)
+
+    def discard(self):
+        """Drop the partially written cube."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._tmp_file.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+        return False
+
+
+def _write_meta(output_file: Path, columns: Dict[str, List], n_rows: int):
+    arrays = {}
+    specs = {}
+    for name, values in columns.items():
+        if values and all(isinstance(value, int) for value in values):
+            specs[name] = {'kind': 'int64'}
+            arrays[f'{name}/values'] = np.asarray(values, dtype='<i8')
+        elif all(value is None or isinstance(value, (int, float)) for value in values):
+            specs[name] = {'kind': 'float64'}
+            arrays[f'{name}/values'] = np.asarray([np.nan if v is None else v for v in values], dtype='<f8')
+        else:
+            encoded = [b'' if v is None else str(v).encode('utf-8') for v in values]
+            specs[name] = {'kind': 'string'}
+            arrays[f'{name}/offsets'] = np.concatenate([[0], np.cumsum([len(v) for v in encoded])]).astype('<i8')
+            arrays[f'{name}/data'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+            arrays[f'{name}/valid'] = np.asarray([v is not None for v in values], dtype=np.uint8)
+    layout = {}
+    offset = 0
+    for key, array in arrays.items():
+        layout[key] = {'offset': offset, 'shape': list(array.shape), 'dtype': array.dtype.str}
+        offset += array.nbytes
+        offset += -offset % 8
+    header = json.dumps({'n_rows': n_rows, 'columns': specs, 'arrays': layout}).encode('utf-8')
+    prefix = META_MAGIC + struct.pack('<IQ', FORMAT_VERSION, len(header)) + header
+    prefix += b'\0' * (-len(prefix) % 8)
+    handle, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=output_file.name + '.', dir=output_file.parent)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(prefix)
+            for key, array in arrays.items():
+                f.seek(len(prefix) + layout[key]['offset'])
+                f.write(array.tobytes())
+        os.replace(tmp_path, output_file)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _close_buffer(buffer: mmap.mmap):
+    try:
+        buffer.close()
+    except BufferError:
+        # Array views handed out are still alive; the mapping is released together with the last one
+        pass
+
+
+class CubeMetadata:
+    """Memory-mapped columnar metadata of a cube; columns are decoded on first access."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._buffer[:len(META_MAGIC)] != META_MAGIC:
+            raise ValueError(f"Not a reflectance cube metadata file: {self.path}")
+        version, header_length = struct.unpack_from('<IQ', self._buffer, len(META_MAGIC))
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported metadata format version {version}")
+        header_start = len(META_MAGIC) + 12
+        header = json.loads(bytes(self._buffer[header_start:header_start + header_length]).decode('utf-8'))
+        self._data_start = header_start + header_length + (-(header_start + header_length) % 8)
+        self.n_rows = header['n_rows']
+        self.columns = header['columns']
+        self._layout = header['arrays']
+        self._cache: Dict[str, object] = {}
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.columns)
+
+    def __len__(self) -> int:
+        return self.n_rows
+
+    def _array(self, key: str) -> np.ndarray:
+        spec = self._layout[key]
+        return np.frombuffer(self._buffer, dtype=np.dtype(spec['dtype']), count=int(np.prod(spec['shape'])),
+                             offset=self._data_start + spec['offset'])
+
+    def column(self, name: str):
+        """int64/float64 view for numeric columns, list of str/None for string columns."""
+        if name not in self._cache:
+            if self.columns[name]['kind'] in ('int64', 'float64'):
+                self._cache[name] = self._array(f'{name}/values')
+            else:
+                offsets = self._array(f'{name}/offsets')
+                data = bytes(self._array(f'{name}/data'))
+                valid = self._array(f'{name}/valid')
+                self._cache[name] = [data[offsets[i]:offsets[i + 1]].decode('utf-8') if valid[i] else None
+                                     for i in range(self.n_rows)]
+        return self._cache[name]
+
+    def rows(self, name: str, start: int, stop: int) -> List:
+        column = self.column(name)
+        return column[start:stop].tolist() if isinstance(column, np.ndarray) else column[start:stop]
+
+    def close(self):
+        self._cache = {}
+        _close_buffer(self._buffer)
+
+
+class ReflectanceCube:
+    """Read-only, memory-mapped reflectance cube."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._buffer[:len(CUBE_MAGIC)] != CUBE_MAGIC:
+            raise ValueError(f"Not a reflectance cube: {self.path}")
+        version, header_length, n_samples = _PREFIX.unpack_from(self._buffer, len(CUBE_MAGIC))
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported cube format version {version}")
+        header_start = len(CUBE_MAGIC) + _PREFIX.size
+        header = json.loads(bytes(self._buffer[header_start:header_start + header_length]).decode('utf-8'))
+        data_start = header_start + header_length
+        data_start += -data_start % DATA_ALIGNMENT
+        self.dtype = np.dtype(header['dtype'])
+        self.wavelengths = np.asarray([np.nan if w is None else w for w in header['wavelengths']], dtype=np.float64)
+        self.fwhm = None if header['fwhm'] is None else \
+            np.asarray([np.nan if w is None else w for w in header['fwhm']], dtype=np.float64)
+        self.sensor_serial = header['sensor_serial']
+        self.valid_vi = header['valid_vi']
+        self.source = header['source']
+        # Zero-copy (n_samples, n_channels) view of the file
+        self.reflectance = np.frombuffer(self._buffer, dtype=self.dtype, count=n_samples * header['n_channels'],
+                                         offset=data_start).reshape(n_samples, header['n_channels'])
+        self._meta = None
+
+    @property
+    def n_samples(self) -> int:
+        return self.reflectance.shape[0]
+
+    def __len__(self) -> int:
+        return self.n_samples
+
+    @property
+    def meta(self) -> Optional[CubeMetadata]:
+        """Metadata sidecar (None if it is missing)."""
+        if self._meta is None and meta_path(self.path).exists():
+            self._meta = CubeMetadata(meta_path(self.path))
+        return self._meta
+
+    def batches(self, batch_size: int = DEFAULT_CUBE_BATCH_SIZE, start: int = 0,
+                stop: Optional[int] = None) -> Iterator[Tuple[int, np.ndarray]]:
+        """Yield (first sample, view of up to batch_size samples) of the samples start..stop."""
+        stop = self.n_samples if stop is None else min(stop, self.n_samples)
+        for first in range(start, stop, batch_size):
+            yield first, self.reflectance[first:min(first + batch_size, stop)]
+
+    def close(self):
+        self.reflectance = None
+        if self._meta is not None:
+            self._meta.close()
+        _close_buffer(self._buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def open_reflectance_cube(path: Path) -> ReflectanceCube:
+    return ReflectanceCube(path)
+
+
+def convert_reflectance_list(csv_file: Path, output_file: Path, sensor_name: Optional[str] = None,
+                             dtype: str = 'float64', delimiter: str = ';', registry=None) -> int:
+    """Convert a reflectance-list CSV to a cube, returning the number of samples."""
+    from sensor_registry import get_registry
+    reader = ReflectanceListReader(csv_file, delimiter)
+    sensor_info = None
+    if sensor_name is not None:
+        sensor_info = (registry or get_registry()).find_sensor_metadata(sensor_name)
+    wavelengths, fwhm = reflectance_list_grid(sensor_info, reader.wavelengths)
+    if len(wavelengths) != len(reader.wavelengths):
+        raise ValueError(f"Number of wavelengths in CSV ({len(reader.wavelengths)}) does not match "
+                         f"sensor metadata ({len(wavelengths)})")
+    valid_vi = None if sensor_info is None else sensor_info.get('valid_vi')
+    with ReflectanceCubeWriter(output_file, wavelengths, fwhm, sensor_name, valid_vi, dtype,
+                               source=Path(csv_file).name) as writer:
+        for chunk in reader.iter_chunks():
+            writer.write_batch(chunk.values, {name: column.tolist() for name, column in chunk.meta.items()})
+    return writer.n_samples
+
+
+def convert_export(json_file: Path, output_file: Path, dtype: str = 'float64', average_sensor_values: bool = True,
+                   multipoint: bool = True, sensors_directory: Optional[Path] = None) -> int:
+    """Decode, calibrate and feature-extract a Regular ScanCorder export into a cube.
+
+    A cube holds one wavelength grid; exports mixing sensor heads with
+    different grids raise a ValueError.
+    """
+    from score_exports import ExportReflectance
+    pipeline = ExportReflectance(sensors_directory, average_sensor_values=average_sensor_values,
+                                 multipoint=multipoint)
+    writer = None
+    try:
+        for batch in pipeline.decoder.iter_batches(Path(json_file)):
+            features, feature_plan, external = pipeline.reflectance(batch)
+            if writer is None:
+                writer = ReflectanceCubeWriter(output_file, feature_plan.wavelengths, feature_plan.fwhm,
+                                               batch.sensor_name, pipeline.valid_vi(batch, external), dtype,
+                                               source=Path(json_file).name)
+            elif not np.array_equal(writer.wavelengths, feature_plan.wavelengths, equal_nan=True):
+                raise ValueError("Export mixes sensor heads with different wavelength grids")
+            meta = dict(batch.meta)
+            meta['sample'] = (batch.sample_index + 1).tolist()
+            writer.write_batch(features, meta)
+    except BaseException:
+        if writer is not None:
+            writer.discard()
+        raise
+    if writer is None:
+        raise ValueError(f"No samples found in {json_file}")
+    writer.close()
+    return writer.n_samples
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Convert exports and reflectance lists to reflectance cubes.")
+    parser.add_argument('input', type=Path, help="Export JSON, reflectance-list CSV or cube to inspect")
+    parser.add_argument('output', type=Path, nargs='?', help="Output cube (default: input name + .srcube)")
+    parser.add_argument('--sensor', help="Sensor serial of a reflectance list (e.g. S8330)")
+    parser.add_argument('--float32', action='store_true', help="Store samples as float32 instead of float64")
+    parser.add_argument('--no-average', action='store_true', help="Do not average sensor values per LED")
+    parser.add_argument('--no-multipoint', action='store_true', help="Skip the multi_calibration factors")
+    return parser.parse_args()
+
+
+def main():
+    """Convert one input file to a cube, or describe an existing cube."""
+    if len(sys.argv) < 2:
+        print("Usage: python reflectance_cube.py <export.json | reflectance_list.csv | cube.srcube> [output.srcube]")
+        print("           [--sensor S8330] [--float32] [--no-average] [--no-multipoint]")
+        print("\nExample: python reflectance_cube.py ../example/data/Reflectance_List_S8330_ColorChecker.csv --sensor S8330")
+        print("\nRequirements:")
+        print("  pip install numpy")
+        sys.exit(1)
+    args = parse_arguments()
+    if args.input.suffix == CUBE_SUFFIX:
+        with open_reflectance_cube(args.input) as cube:
+            print(f"📦 {cube.path.name}: {cube.n_samples} samples x {len(cube.wavelengths)} channels ({cube.dtype})")
+            print(f"   sensor: {cube.sensor_serial or '-'}, source: {cube.source or '-'}")
+            print(f"   wavelengths: {', '.join(f'{w:g}' for w in cube.wavelengths)}")
+            if cube.meta is not None:
+                print(f"   metadata: {', '.join(cube.meta.names) or '-'}")
+        return
+    output = args.output or args.input.with_suffix(CUBE_SUFFIX)
+    dtype = 'float32' if args.float32 else 'float64'
+    try:
+        if args.input.suffix.lower() == '.csv':
+            n_samples = convert_reflectance_list(args.input, output, args.sensor, dtype)
+        else:
+            n_samples = convert_export(args.input, output, dtype, not args.no_average, not args.no_multipoint)
+    except (OSError, ValueError) as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    print(f"✅ Converted {n_samples} samples")
+    print(f"📄 Cube saved to: {output.absolute()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Chunked Reflectance List Reader
+
+Python reader for the reflectance-list CSVs of DecodeReflectanceList
+(metadata columns such as LabelName;LabelNumber, then one numeric column per
+wavelength). Instead of building a data.frame and a list of row vectors, the
+file is read in fixed-size byte blocks cut at line ends; numpy's C tokenizer
+parses each block once into a structured array (float64 wavelength columns,
+str metadata columns), so memory stays bounded and no Python object is
+created per value. The metadata/wavelength column split is detected once
+from the header.
+
+Values "NA" and empty fields are read as NaN: they are respelled as NaN
+with plain string replacements before parsing, not by a converter called
+per field. Quoted fields may contain the delimiter but not line breaks.
+
+Usage: python reflectance_list_reader.py <reflectance_list.csv> [--block-size BYTES]
+
+Requirements: pip install numpy
+"""
+
+import io
+import itertools
+import sys
+import time
+import warnings
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+DEFAULT_BLOCK_SIZE = 16 * 2 ** 20
+# NaN spellings of NA and empty fields, read as NaN by numpy and mapped back in metadata columns
+MISSING_NA = '+nan'
+MISSING_EMPTY = '-nan'
+
+
+def _is_number(text: str) -> bool:
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+
+def reflectance_list_grid(sensor_info: Optional[Dict], csv_wavelengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Wavelengths and FWHM of a reflectance list, chosen like DecodeReflectanceList$load_sensor_metadata()."""
+    if sensor_info is None:
+        print("⚠️ Sensor metadata not found. Using wavelengths from CSV columns and assuming FWHM = 1nm")
+        return csv_wavelengths, np.ones(len(csv_wavelengths))
+    wavelengths = sensor_info.get('channel_wl_real') or sensor_info.get('channel_wl_nom')
+    if wavelengths is None:
+        print("⚠️ Cannot load center wavelength from sensor metadata. Using CSV column headers.")
+        wavelengths = csv_wavelengths
+    wavelengths = np.asarray([np.nan if w is None else w for w in np.ravel(wavelengths)], dtype=np.float64)
+    fwhm = sensor_info.get('channel_fwhm_real') or sensor_info.get('channel_fwhm_nom')
+    if fwhm is None:
+        print("⚠️ FWHM not found in sensor metadata. Assuming FWHM = 1nm")
+        fwhm = np.ones(len(wavelengths))
+    fwhm = np.asarray([np.nan if w is None else w for w in np.ravel(fwhm)], dtype=np.float64)
+    return wavelengths, fwhm
+
+
+class ReflectanceChunk:
+    """Reflectance and metadata of consecutive rows of a reflectance list."""
+
+    def __init__(self, values: np.ndarray, meta: Dict[str, np.ndarray], sample_offset: int):
+        # (n_rows, n_wavelengths) float64
+        self.values = values
+        # One numpy array per metadata column (int64/float64 if all values are numbers, else str)
+        self.meta = meta
+        # Position of the first row in the whole file
+        self.sample_offset = sample_offset
+
+    def __len__(self) -> int:
+        return self.values.shape[0]
+
+
+class ReflectanceListReader:
+    """Streams a reflectance-list CSV as ReflectanceChunks."""
+
+    def __init__(self, csv_file: Path, delimiter: str = ';', block_size: int = DEFAULT_BLOCK_SIZE):
+        self.csv_file = Path(csv_file)
+        self.delimiter = delimiter
+        self.block_size = block_size
+        with open(self.csv_file, 'rb') as f:
+            header_line = f.readline()
+            self._data_start = f.tell()
+        if not header_line.strip():
+            raise ValueError("CSV file is empty or could not be read")
+        header = np.loadtxt(io.StringIO(header_line.decode('utf-8-sig'), newline=None), delimiter=delimiter,
+                            quotechar='"', dtype=str, ndmin=1).tolist()
+        self.header: List[str] = [name.strip() for name in header]
+        # Columns whose name is not a number are metadata, as in DecodeReflectanceList$score()
+        self.meta_positions = [j for j, name in enumerate(self.header) if not _is_number(name)]
+        self.value_positions = [j for j, name in enumerate(self.header) if _is_number(name)]
+        self.meta_columns = [self.header[j] for j in self.meta_positions]
+        if not self.value_positions:
+            raise ValueError("Could not find any wavelength column in the CSV header")
+        self.wavelengths = np.asarray([float(self.header[j]) for j in self.value_positions])
+        # One structured row: a str field per metadata column, a float64 subarray per run of wavelength columns
+        fields = []
+        value_set = set(self.value_positions)
+        for is_value, run in itertools.groupby(range(len(self.header)), key=lambda j: j in value_set):
+            run = list(run)
+            if is_value:
+                fields.append((f'values{run[0]}', np.float64, (len(run),)))
+            else:
+                fields.extend((f'meta{j}', object) for j in run)
+        self._row_dtype = np.dtype(fields)
+        self._value_fields = [field[0] for field in fields if len(field) == 3]
+        # NA and empty fields between separators or line ends, and their NaN spellings
+        d = delimiter
+        self._na_spellings = [(f'{d}NA{d}', f'{d}{MISSING_NA}{d}'), (f'\nNA{d}', f'\n{MISSING_NA}{d}'),
+                              (f'{d}NA\n', f'{d}{MISSING_NA}\n'), (f'{d}NA\r', f'{d}{MISSING_NA}\r'),
+                              ('\nNA\n', f'\n{MISSING_NA}\n'), ('\nNA\r', f'\n{MISSING_NA}\r')]
+        self._empty_spellings = [(d + d, f'{d}{MISSING_EMPTY}{d}'), (f'\n{d}', f'\n{MISSING_EMPTY}{d}'),
+                                 (f'{d}\n', f'{d}{MISSING_EMPTY}\n'), (f'{d}\r', f'{d}{MISSING_EMPTY}\r')]
+
+    def line_spans(self, span_bytes: int) -> List[Tuple[int, int]]:
+        """Byte ranges of the data rows, each about `span_bytes` long and cut at line ends."""
+        size = self.csv_file.stat().st_size
+        cuts = [self._data_start]
+        with open(self.csv_file, 'rb') as f:
+            while cuts[-1] + span_bytes < size:
+                f.seek(cuts[-1] + span_bytes - 1)
+                f.readline()
+                if f.tell() >= size:
+                    break
+                cuts.append(f.tell())
+        return list(zip(cuts, cuts[1:] + [size]))
+
+    def _blocks(self, span: Optional[Tuple[int, int]] = None) -> Iterator[bytes]:
+        """Blocks of about block_size bytes, each ending at a line end."""
+        start, stop = span if span is not None else (self._data_start, self.csv_file.stat().st_size)
+        with open(self.csv_file, 'rb') as f:
+            f.seek(start)
+            rest = b''
+            while True:
+                block = f.read(min(self.block_size, stop - f.tell()))
+                if not block:
+                    if rest.strip():
+                        yield rest
+                    return
+                block = rest + block
+                cut = block.rfind(b'\n') + 1
+                if cut == 0:
+                    rest = block
+                    continue
+                rest = block[cut:]
+                yield block[:cut]
+
+    def _has_empty_fields(self, block: bytes) -> bool:
+        """Whether a separator follows a line start or precedes another separator or a line end."""
+        data = np.frombuffer(block, dtype=np.uint8)
+        separator = data == ord(self.delimiter)
+        line_end = (data == ord('\n')) | (data == ord('\r'))
+        return bool(separator[0] or separator[-1] or np.any(separator[:-1] & (separator[1:] | line_end[1:]))
+                    or np.any(line_end[:-1] & separator[1:]))
+
+    def _text(self, block: bytes) -> str:
+        """Block text with NA and empty fields respelled as NaN, between two line breaks."""
+        spellings = (self._na_spellings if b'NA' in block else []) + \
+            (self._empty_spellings if self._has_empty_fields(block) else [])
+        text = '\n' + block.decode('utf-8') + '\n'
+        spellings = [(old, new) for old, new in spellings if old in text]
+        if not spellings:
+            return text
+        if '"' in text:
+            pieces = text.split('"')
+            if self.delimiter in ''.join(pieces[1::2]):
+                # Quoted fields contain the delimiter: only fill outside of quotes
+                pieces[::2] = [self._respell(piece, spellings) for piece in pieces[::2]]
+                return '"'.join(pieces)
+        return self._respell(text, spellings)
+
+    @staticmethod
+    def _respell(text: str, spellings: List[Tuple[str, str]]) -> str:
+        for old, new in spellings:
+            # Twice, since neighbouring missing fields share the separator
+            text = text.replace(old, new).replace(old, new)
+        return text
+
+    def _parse(self, block: bytes) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        text = self._text(block)
+        with warnings.catch_warnings():
+            # Blank lines are skipped; numpy warns about their max_rows semantics
+            warnings.simplefilter('ignore', UserWarning)
+            rows = np.loadtxt(io.StringIO(text, newline=None), dtype=self._row_dtype, delimiter=self.delimiter,
+                              quotechar='"', ndmin=1)
+        if len(rows) == 0:
+            return np.empty((0, len(self.value_positions))), {}
+        values = [rows[name] for name in self._value_fields]
+        values = np.ascontiguousarray(values[0]) if len(values) == 1 else np.concatenate(values, axis=1)
+        meta = {name: self._meta_column(rows[f'meta{j}']) for name, j in zip(self.meta_columns, self.meta_positions)}
+        return values, meta
+
+    @staticmethod
+    def _meta_column(column: np.ndarray) -> np.ndarray:
+        """Numeric metadata (e.g. LabelNumber) as int64 or float64, like read.csv() column types."""
+        column = column.astype(str)
+        column[column == MISSING_NA] = 'NA'
+        column[column == MISSING_EMPTY] = ''
+        try:
+            numbers = column.astype(np.float64)
+        except ValueError:
+            return column
+        if np.all(np.isfinite(numbers) & (numbers == np.round(numbers))):
+            return numbers.astype(np.int64)
+        return numbers
+
+    def iter_chunks(self, span: Optional[Tuple[int, int]] = None) -> Iterator[ReflectanceChunk]:
+        """Yield the chunks of the file, or of one byte range of line_spans().
+
+        Sample offsets of a range count from its first row.
+        """
+        sample_offset = 0
+        for block in self._blocks(span):
+            values, meta = self._parse(block)
+            if len(values):
+                yield ReflectanceChunk(values, meta, sample_offset)
+            sample_offset += len(values)
+
+    def read(self) -> ReflectanceChunk:
+        """Read the whole file into one chunk."""
+        chunks = list(self.iter_chunks())
+        if not chunks:
+            return ReflectanceChunk(np.empty((0, len(self.value_positions))),
+                                    {name: np.empty(0, dtype=str) for name in self.meta_columns}, 0)
+        meta = {name: np.concatenate([chunk.meta[name] for chunk in chunks]) for name in self.meta_columns}
+        return ReflectanceChunk(np.concatenate([chunk.values for chunk in chunks]), meta, 0)
+
+
+def main():
+    """Read a reflectance list chunk by chunk and report the throughput."""
+    if len(sys.argv) < 2:
+        print("Usage: python reflectance_list_reader.py <reflectance_list.csv> [--block-size BYTES]")
+        print("\nExample: python reflectance_list_reader.py ../example/data/Reflectance_List_S8330_ColorChecker.csv")
+        print("\nRequirements:")
+        print("  pip install numpy")
+        sys.exit(1)
+    block_size = DEFAULT_BLOCK_SIZE
+    if '--block-size' in sys.argv:
+        block_size = int(sys.argv[sys.argv.index('--block-size') + 1])
+    reader = ReflectanceListReader(Path(sys.argv[1]), block_size=block_size)
+    print(f"📄 Metadata columns: {', '.join(reader.meta_columns) or '-'}")
+    print(f"📄 Wavelengths: {', '.join(f'{w:g}' for w in reader.wavelengths)}")
+    start = time.perf_counter()
+    n_rows = 0
+    n_chunks = 0
+    for chunk in reader.iter_chunks():
+        n_rows += len(chunk)
+        n_chunks += 1
+    elapsed = time.perf_counter() - start
+    print(f"✅ Read {n_rows} rows in {n_chunks} chunks in {elapsed:.2f} s "
+          f"({n_rows / elapsed if elapsed > 0 else 0:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
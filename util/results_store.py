@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+"""
+Incremental Results Store for Index Tables
+
+Keeps the index values of an archive of exports in a directory, one .npy
+file per input file and index, so that catalogue updates only recompute what
+changed. Every stored column records
+
+- the definition hash of its index (IndexCatalogue.definition_hash(): bands
+  and formula; descriptions and other metadata do not count)
+- the input version of the file it was scored from: the content hash of the
+  file combined with the scoring settings (--no-average, --no-multipoint,
+  --sensor, precision, meta columns) and the content of the sensor folder
+
+An update compares the current catalogue and inputs against the store:
+
+- new or changed input files are scored completely
+- for unchanged files only the new indices and the indices whose definition
+  hash changed are scored (ExportScorer(indices=...) builds the DAG of just
+  those indices)
+- columns of indices deleted from the catalogue are dropped
+- everything else is left untouched
+
+Without inputs the files already in the store are updated. Files are only
+re-hashed when their size or modification time changed. The manifest
+(store.json) is replaced atomically after every file, so an interrupted
+update loses at most the file in progress.
+
+-o exports the store as the table score_exports.py would write for the same
+files (.csv, .parquet or .arrow, see table_writers.py).
+
+Usage: python results_store.py <store_dir> [export.json | directory | glob ...] [-o indices.csv] [--workers N]
+
+Requirements: pip install numpy (compiling the catalogue additionally needs sympy pandas)
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from index_catalogue import default_artifact_path, load_catalogue
+from precision_validation import DEFAULT_OVERRIDES_FILE, load_float64_indices
+from reflectance_cube import CUBE_SUFFIX, meta_path
+from score_exports import DEFAULT_XML_FOLDER, ExportScorer, collect_inputs
+from sensor_registry import DEFAULT_SENSORS_DIRECTORY, get_registry
+from table_writers import open_table_writer
+
+
+STORE_VERSION = 1
+MANIFEST_NAME = 'store.json'
+ROWS_NAME = 'rows.json'
+HASH_BLOCK_SIZE = 2 ** 20
+
+
+def content_hash(path: Path) -> str:
+    """SHA-256 of a file; a reflectance cube includes its metadata file."""
+    digest = hashlib.sha256()
+    paths = [path]
+    if path.suffix.lower() == CUBE_SUFFIX and meta_path(path).exists():
+        paths.append(meta_path(path))
+    for file in paths:
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def settings_hash(options: Dict, meta_columns: Sequence[str]) -> str:
+    """Hash over everything besides the input file and the index definitions that changes stored values."""
+    settings = {
+        'store_version': STORE_VERSION,
+        'average_sensor_values': options.get('average_sensor_values', True),
+        'multipoint': options.get('multipoint', True),
+        'list_sensor': options.get('list_sensor'),
+        'precision': options.get('precision', 'float64'),
+        'float64_indices': sorted(options.get('float64_indices') or ()),
+        'meta_columns': list(meta_columns),
+    }
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    # valid_vi and multi_calibration come from the sensor files
+    sensors_directory = Path(options.get('sensors_directory') or DEFAULT_SENSORS_DIRECTORY)
+    for sensor_file in sorted(sensors_directory.glob('*.json')):
+        digest.update(sensor_file.name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(sensor_file.read_bytes())
+    return digest.hexdigest()
+
+
+def column_file_name(index_name: str) -> str:
+    # Index names contain characters such as '/' that are not valid in file names
+    return hashlib.sha1(index_name.encode('utf-8')).hexdigest()[:16] + '.npy'
+
+
+class ResultsStore:
+    """Directory of scored columns with the definition hash and input version of every column."""
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        manifest_file = self.directory / MANIFEST_NAME
+        if manifest_file.exists():
+            with open(manifest_file, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+            if self.manifest.get('version') != STORE_VERSION:
+                raise ValueError(f"Unsupported results store version {self.manifest.get('version')}")
+        else:
+            self.manifest = {'version': STORE_VERSION, 'batches': {}}
+
+    @property
+    def batches(self) -> Dict[str, Dict]:
+        """Stored input files by resolved path, in the order they were added."""
+        return self.manifest['batches']
+
+    def input_version(self, path: Path, settings: str) -> Tuple[str, Dict]:
+        """(input version, file state) of a file, re-hashing it only if its size or mtime changed."""
+        stat = path.stat()
+        state = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        batch = self.batches.get(str(path.resolve()))
+        if batch is not None and all(batch.get(key) == value for key, value in state.items()):
+            state['content_hash'] = batch['content_hash']
+        else:
+            state['content_hash'] = content_hash(path)
+        version = hashlib.sha256(f"{state['content_hash']}\0{settings}".encode('utf-8')).hexdigest()
+        return version, state
+
+    def missing_columns(self, path: Path, version: str, definitions: Dict[str, str]) -> Optional[List[str]]:
+        """Indices to score for a file: None for all of them, [] if the stored columns are current."""
+        batch = self.batches.get(str(path.resolve()))
+        if batch is None or batch['input'] != version:
+            return None
+        columns = batch['columns']
+        return [name for name, definition in definitions.items()
+                if name not in columns or columns[name]['definition'] != definition
+                or columns[name]['input'] != version]
+
+    def store_batch(self, path: Path, version: str, state: Dict, result: Dict, definitions: Dict[str, str],
+                    index_names: Optional[Sequence[str]]):
+        """Write the scored columns of a file; index_names=None replaces all its columns and rows."""
+        key = str(path.resolve())
+        batch = self.batches.get(key)
+        if index_names is None or batch is None:
+            directory = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+            if batch is not None:
+                shutil.rmtree(self.directory / batch['directory'], ignore_errors=True)
+            batch = {'path': key, 'source_file': path.name, 'directory': directory, 'columns': {}}
+            (self.directory / directory).mkdir(parents=True, exist_ok=True)
+            rows = {'sample': result['sample']}
+            rows.update((name, value) for name, value in result.items()
+                        if name not in ('sample', 'scores', 'n_rows'))
+            self._write_atomic(self.directory / directory / ROWS_NAME,
+                               lambda f: f.write(json.dumps(rows).encode('utf-8')))
+            batch['n_rows'] = result['n_rows']
+            index_names = list(definitions)
+        elif result['n_rows'] != batch['n_rows']:
+            raise ValueError(f"{path.name}: scored {result['n_rows']} rows, the store has {batch['n_rows']}")
+        batch.update(state)
+        batch['input'] = version
+        batch_directory = self.directory / batch['directory']
+        for name in index_names:
+            values = result['scores'].get(name)
+            file_name = None
+            if values is not None:
+                file_name = column_file_name(name)
+                self._write_atomic(batch_directory / file_name, lambda f: np.save(f, values))
+            elif name in batch['columns'] and batch['columns'][name]['file']:
+                (batch_directory / batch['columns'][name]['file']).unlink(missing_ok=True)
+            # file None: the index is not computable on this file's grid (NA in the table)
+            batch['columns'][name] = {'definition': definitions[name], 'input': version, 'file': file_name}
+        self.batches[key] = batch
+        self.save()
+
+    def drop_indices(self, index_names: Sequence[str]) -> int:
+        """Delete the columns of indices no longer in the catalogue, returning the number of files removed."""
+        removed = 0
+        for batch in self.batches.values():
+            for name in index_names:
+                column = batch['columns'].pop(name, None)
+                if column is not None and column['file']:
+                    (self.directory / batch['directory'] / column['file']).unlink(missing_ok=True)
+                    removed += 1
+        self.save()
+        return removed
+
+    def stored_indices(self) -> List[str]:
+        names = {}
+        for batch in self.batches.values():
+            names.update(dict.fromkeys(batch['columns']))
+        return list(names)
+
+    def save(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._write_atomic(self.directory / MANIFEST_NAME,
+                           lambda f: f.write(json.dumps(self.manifest, indent=1).encode('utf-8')))
+
+    @staticmethod
+    def _write_atomic(path: Path, write):
+        handle, tmp_path = tempfile.mkstemp(suffix=path.suffix, dir=path.parent)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def export(self, output_file: Path, definitions: Dict[str, str],
+               meta_columns: Sequence[str]) -> Tuple[int, Dict[str, List[str]]]:
+        """Write all stored files as one table like score_exports.py, returning (number of rows, outdated columns).
+
+        Columns are written in the order of the current definitions. A column whose stored definition hash
+        differs from the current one, or that was never scored for a file (files not passed to the last
+        update), is written as NA and reported by source file instead of exporting values of an old definition.
+        """
+        columns = {'source_file': 'string', 'sample': 'float64'}
+        columns.update((name, 'string') for name in meta_columns)
+        n_rows = 0
+        outdated = {}
+        with open_table_writer(output_file, list(definitions), columns) as writer:
+            for batch in self.batches.values():
+                batch_directory = self.directory / batch['directory']
+                with open(batch_directory / ROWS_NAME, 'r', encoding='utf-8') as f:
+                    rows = json.load(f)
+                meta = {'source_file': [batch['source_file']] * batch['n_rows'], 'sample': rows['sample']}
+                meta.update((name, rows.get(name)) for name in meta_columns)
+                stale = [name for name, definition in definitions.items()
+                         if batch['columns'].get(name, {}).get('definition') != definition]
+                if stale:
+                    outdated[batch['source_file']] = stale
+                current = set(definitions).difference(stale)
+                scores = {name: np.load(batch_directory / column['file'], mmap_mode='r')
+                          for name, column in batch['columns'].items() if column['file'] and name in current}
+                writer.write_batch(scores, meta)
+                n_rows += batch['n_rows']
+        return n_rows, outdated
+
+
+_worker_scorer: Optional[ExportScorer] = None
+
+
+def _init_worker(options: Dict):
+    global _worker_scorer
+    _worker_scorer = ExportScorer(**options)
+
+
+def _score_task(task: Tuple) -> Tuple[Tuple, Optional[Dict], Optional[str], float]:
+    """Score the given indices (None: all) of one file."""
+    file, index_names, meta_columns = task
+    _worker_scorer.selected_indices = None if index_names is None else frozenset(index_names)
+    start = time.perf_counter()
+    result = None
+    error = None
+    try:
+        result = _worker_scorer.score_file(Path(file), meta_columns=meta_columns)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return task, result, error, time.perf_counter() - start
+
+
+def update_store(store: ResultsStore, files: Sequence[Path], options: Dict, definitions: Dict[str, str],
+                 meta_columns: Sequence[str], workers: int = 1, dry_run: bool = False) -> Dict[str, int]:
+    """Bring the store up to date with the catalogue definitions and input files."""
+    counts = {'files_scored': 0, 'files_updated': 0, 'files_current': 0, 'columns_scored': 0,
+              'columns_dropped': 0, 'errors': 0}
+    deleted = [name for name in store.stored_indices() if name not in definitions]
+    if deleted:
+        print(f"⚠️ {len(deleted)} indices deleted from the catalogue: {', '.join(deleted)}")
+        if not dry_run:
+            counts['columns_dropped'] = store.drop_indices(deleted)
+
+    settings = settings_hash(options, meta_columns)
+    tasks = []
+    versions = {}
+    for file in files:
+        version, state = store.input_version(file, settings)
+        missing = store.missing_columns(file, version, definitions)
+        if missing is None:
+            counts['files_scored'] += 1
+            counts['columns_scored'] += len(definitions)
+            print(f"📄 {file.name}: new or changed, scoring all {len(definitions)} indices")
+        elif missing:
+            counts['files_updated'] += 1
+            counts['columns_scored'] += len(missing)
+            print(f"📄 {file.name}: scoring {len(missing)} new or changed indices")
+        else:
+            counts['files_current'] += 1
+            continue
+        versions[str(file)] = (version, state)
+        tasks.append((str(file), missing, tuple(meta_columns)))
+    if dry_run or not tasks:
+        return counts
+
+    if workers > 1 and len(tasks) > 1:
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=_init_worker,
+                                       initargs=(options,))
+        results = executor.map(_score_task, tasks)
+    else:
+        executor = None
+        _init_worker(options)
+        results = map(_score_task, tasks)
+    try:
+        for task, result, error, seconds in results:
+            file, index_names, _ = task
+            if error is None:
+                try:
+                    store.store_batch(Path(file), *versions[file], result, definitions, index_names)
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                counts['errors'] += 1
+                print(f"❌ {Path(file).name}: {error}")
+                continue
+            scored = len(definitions) if index_names is None else len(index_names)
+            print(f"✅ {Path(file).name}: {scored} indices, {result['n_rows']} samples in {seconds:.2f} s")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return counts
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Incrementally score exports into a results store.")
+    parser.add_argument('store', type=Path, help="Results store directory (created if missing)")
+    parser.add_argument('inputs', nargs='*',
+                        help="Export files, directories or glob patterns (default: the files in the store)")
+    parser.add_argument('-o', '--output', type=Path, help="Export the store as a table (.csv, .parquet or .arrow)")
+    parser.add_argument('--dry-run', action='store_true', help="Only report what an update would score")
+    parser.add_argument('--workers', type=int, default=0, help="Number of worker processes (default: all cores)")
+    parser.add_argument('--xml-folder', type=Path, default=DEFAULT_XML_FOLDER, help="Folder with index XML files")
+    parser.add_argument('--catalogue', type=Path,
+                        help="Compiled index catalogue, rebuilt when missing or stale (default: in the user cache directory)")
+    parser.add_argument('--sensors', type=Path, default=DEFAULT_SENSORS_DIRECTORY, help="Folder with sensor JSON files")
+    parser.add_argument('--sensor', help="Sensor serial of reflectance-list CSV inputs (e.g. S8330)")
+    parser.add_argument('--float32', action='store_true',
+                        help="Score in single precision, except for the indices listed in --float64-indices")
+    parser.add_argument('--float64-indices', type=Path, default=DEFAULT_OVERRIDES_FILE,
+                        help="JSON list of indices kept in double precision")
+    parser.add_argument('--no-average', action='store_true', help="Do not average sensor values per LED")
+    parser.add_argument('--no-multipoint', action='store_true', help="Skip the multi_calibration factors")
+    parser.add_argument('--calibration-cache', type=Path,
+                        help="Directory persisting fitted calibration coefficients across workers and runs")
+    parser.add_argument('--meta-columns', default='uuid,filename',
+                        help="Comma-separated metadata columns to copy (default: uuid,filename)")
+    args = parser.parse_args()
+    if args.catalogue is None:
+        args.catalogue = default_artifact_path(args.xml_folder)
+    return args
+
+
+def main():
+    """Update a results store and optionally export it as a table."""
+    if len(sys.argv) < 2:
+        print("Usage: python results_store.py <store_dir> [export.json | directory | glob ...] [-o indices.csv] "
+              "[--workers N]")
+        print("\nExample: python results_store.py archive_store/ ../example/data/ -o indices.parquet")
+        print("         python results_store.py archive_store/ -o indices.csv   (after editing index XMLs)")
+        print("\nRequirements:")
+        print("  pip install numpy (Parquet/Arrow output additionally needs pyarrow)")
+        sys.exit(1)
+    args = parse_arguments()
+    try:
+        store = ResultsStore(args.store)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    if args.inputs:
+        files = collect_inputs(args.inputs)
+    else:
+        files = []
+        for batch in store.batches.values():
+            if Path(batch['path']).is_file():
+                files.append(Path(batch['path']))
+            else:
+                print(f"⚠️ {batch['source_file']}: input file missing, keeping the stored results")
+    meta_columns = [name.strip() for name in args.meta_columns.split(',') if name.strip()]
+
+    catalogue = load_catalogue(args.xml_folder, args.catalogue)
+    definitions = catalogue.definition_hashes()
+    catalogue.close()
+    registry_index = args.catalogue.with_name('sensor_registry_index.json')
+    get_registry(args.sensors, registry_index)
+    options = {
+        'catalogue_path': args.catalogue,
+        'xml_folder': args.xml_folder,
+        'sensors_directory': args.sensors,
+        'registry_index': registry_index,
+        'average_sensor_values': not args.no_average,
+        'multipoint': not args.no_multipoint,
+        'list_sensor': args.sensor,
+        'precision': 'float32' if args.float32 else 'float64',
+        'float64_indices': sorted(load_float64_indices(args.float64_indices)) if args.float32 else None,
+        'calibration_cache_dir': args.calibration_cache,
+    }
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+
+    start = time.perf_counter()
+    counts = update_store(store, files, options, definitions, meta_columns, workers, args.dry_run)
+    elapsed = time.perf_counter() - start
+    print(f"\n{'='*60}")
+    print(f"{'📊 Would score' if args.dry_run else '✅ Scored'}: {counts['columns_scored']} columns "
+          f"({counts['files_scored']} new or changed files, {counts['files_updated']} files with new or changed "
+          f"indices, {counts['files_current']} files current) in {elapsed:.2f} s")
+    if counts['columns_dropped']:
+        print(f"✅ Dropped: {counts['columns_dropped']} columns of deleted indices")
+    if counts['errors']:
+        print(f"❌ Errors: {counts['errors']} files")
+    if args.output and not args.dry_run:
+        n_rows, outdated = store.export(args.output, definitions, meta_columns)
+        print(f"📊 Table saved to: {args.output.absolute()} ({n_rows} rows)")
+        for source_file, names in outdated.items():
+            listed = ', '.join(names[:5]) + (f" and {len(names) - 5} more" if len(names) > 5 else '')
+            print(f"⚠️ {source_file}: {len(names)} indices not scored with the current definitions, "
+                  f"written as NA: {listed}")
+        if outdated:
+            print(f"⚠️ Run python results_store.py {args.store} without inputs to update all stored files")
+    print(f"{'='*60}")
+
+
+if __name__ == "__main__":
+    main()
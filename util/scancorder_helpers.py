@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+ScanCorder Helpers
+
+Python counterparts of the shared helper methods of the R ScanCorderHelpers
+class (field lookup with device/external fallback, JSON to array conversion,
+field name sanitizing and info filtering). They are used by the Python
+decoders so that both implementations produce the same metadata columns.
+"""
+
+import re
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+class ScanCorderHelpers:
+    """Shared helpers for parsing ScanCorder JSON structures."""
+
+    def nested_key_exists(self, dictionary: Any, keys: Sequence[str]) -> bool:
+        """Check if a nested key path exists and is not null."""
+        current = dictionary
+        for key in keys:
+            if isinstance(current, dict) and current.get(key) is not None:
+                current = current[key]
+            else:
+                return False
+        return True
+
+    def get_nested(self, dictionary: Any, keys: Sequence[str], default: Any = None) -> Any:
+        """Return the value at a nested key path, or `default` if it does not exist."""
+        current = dictionary
+        for key in keys:
+            if isinstance(current, dict) and current.get(key) is not None:
+                current = current[key]
+            else:
+                return default
+        return current
+
+    def get_field_base(self, device_info: Optional[Dict], external_info: Optional[Dict], field_name: str) -> Any:
+        """Get a field from device sensor info, falling back to external (package) sensor info."""
+        if device_info is not None and device_info.get(field_name) is not None:
+            return device_info[field_name]
+        if external_info is not None and external_info.get(field_name) is not None:
+            return external_info[field_name]
+        return None
+
+    def convert_json_to_vector(self, json_data: Any) -> np.ndarray:
+        """Convert (nested) JSON numbers to a flat float vector, null becomes NaN."""
+        return np.asarray(json_data, dtype=np.float64).ravel()
+
+    def convert_json_to_matrix(self, json_data: Any) -> np.ndarray:
+        """Convert a JSON list of rows to a float matrix, null becomes NaN."""
+        matrix = np.asarray(json_data, dtype=np.float64)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(-1, 1)
+        return matrix
+
+    def ensure_list(self, x: Any) -> List:
+        """Wrap a JSON object (or scalar) into a one-element list; leave JSON arrays as they are."""
+        if isinstance(x, list):
+            return x
+        return [x]
+
+    def sanitize_field_name(self, field_name: str) -> str:
+        """Sanitize a field name the same way as the R helpers."""
+        sanitized = field_name.strip()
+        sanitized = sanitized.replace('-', '_').replace('.', '_')
+        sanitized = re.sub(r'[^A-Za-z0-9_]', '_', sanitized)
+        if re.match(r'^[0-9]', sanitized):
+            sanitized = 'X' + sanitized
+        return sanitized
+
+    def filter_info_fields(self, info: Any) -> Any:
+        """Keep only numeric or single string info fields, with sanitized names."""
+        if not isinstance(info, dict):
+            return info
+        filtered_info = {}
+        for field_name, field_value in info.items():
+            # JSON booleans are not numeric in R either
+            if isinstance(field_value, bool):
+                continue
+            if isinstance(field_value, (int, float, str)):
+                filtered_info[self.sanitize_field_name(field_name)] = field_value
+        return filtered_info
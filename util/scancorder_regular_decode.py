@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+Streaming Decoder for Compolytics Regular ScanCorder Exports
+
+This module reads ScanCorder JSON exports incrementally and yields fixed-size
+batches of samples as preallocated arrays with a columnar metadata table,
+instead of parsing the whole export and growing per-sample lists as the R
+DecodeCompolyticsRegularScanner does. Memory use is bounded by the batch size
+and the largest single export entry, not by the file size.
+
+Every batch holds the dark-current corrected raw sensor values of its samples
+as one (n_samples, n_leds, n_sensors) array. A new batch is started whenever
+the sensor head or the matrix shape changes, so every batch is homogeneous.
+Calibration measurements are decoded once per distinct calibration set:
+a sample whose calibration block equals a recently decoded one (a plain
+object comparison, no serialization) reuses its key and arrays. Sets are
+deduplicated within the batch; calibration itself is applied separately.
+
+json_array_spans() cuts a large export into byte ranges of whole entries
+without parsing it: a numpy scan of the brackets and quotes finds where the
+top-level entries start, so each range can be decoded on its own (e.g. by
+the workers of score_exports.py).
+
+Usage: python scancorder_regular_decode.py <export.json> [batch_size]
+
+Requirements: pip install numpy
+"""
+
+import hashlib
+import json
+import mmap
+import re
+import sys
+from collections import deque
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from scancorder_helpers import ScanCorderHelpers
+
+
+DEFAULT_BATCH_SIZE = 1024
+DEFAULT_CHUNK_SIZE = 1 << 20
+DEFAULT_SCAN_BLOCK = 16 << 20
+# Distinct calibration blocks remembered by the decoder
+RECENT_CALIBRATIONS = 8
+
+
+def iter_json_entries(json_file_path: Path, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Any]:
+    """Yield the elements of a top-level JSON array one at a time.
+
+    A top-level JSON object is yielded as a single element. Only the element
+    currently being decoded is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    with open(json_file_path, 'r', encoding='utf-8') as f:
+        buffer = f.read(chunk_size)
+        position = 0
+        eof = len(buffer) < chunk_size
+
+        def skip_whitespace():
+            nonlocal buffer, position, eof
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n':
+                    position += 1
+                if position < len(buffer) or eof:
+                    return
+                buffer = f.read(chunk_size)
+                position = 0
+                eof = len(buffer) < chunk_size
+
+        def decode_value():
+            nonlocal buffer, position, eof
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                    # A number cut at the end of the buffer may continue in the next chunk
+                    if eof or (end < len(buffer) and buffer[end] not in '0123456789.eE+-'):
+                        position = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                # Grow the read size with the buffer so retries stay linear overall
+                more = f.read(max(chunk_size, len(buffer) - position))
+                eof = len(more) == 0
+                buffer = buffer[position:] + more
+                position = 0
+
+        skip_whitespace()
+        if position >= len(buffer):
+            return
+        if buffer[position] != '[':
+            yield decode_value()
+            return
+        position += 1
+        skip_whitespace()
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        while True:
+            skip_whitespace()
+            yield decode_value()
+            skip_whitespace()
+            if position >= len(buffer):
+                raise ValueError("Unexpected end of JSON array")
+            if buffer[position] == ']':
+                return
+            if buffer[position] != ',':
+                raise ValueError(f"Expected ',' or ']' in JSON array, got '{buffer[position]}'")
+            position += 1
+
+
+def _unescaped_quotes(data: np.ndarray, backslashes: int) -> np.ndarray:
+    """Positions of the unescaped quotes in a block; the previous block ended with `backslashes` backslashes."""
+    quotes = np.flatnonzero(data == ord('"'))
+    if not len(quotes):
+        return quotes
+    preceded = data[quotes - 1] == ord('\\')
+    if quotes[0] == 0:
+        preceded[0] = backslashes > 0
+    escaped = []
+    for quote in quotes[preceded].tolist():
+        start = quote - 1
+        while start >= 0 and data[start] == ord('\\'):
+            start -= 1
+        # A quote after an odd number of backslashes is part of the string
+        if (quote - 1 - start + (backslashes if start < 0 else 0)) % 2:
+            escaped.append(quote)
+    return np.setdiff1d(quotes, escaped) if escaped else quotes
+
+
+def json_array_spans(json_file_path: Path, span_bytes: int,
+                     block_size: int = DEFAULT_SCAN_BLOCK) -> List[Tuple[int, int]]:
+    """Byte ranges of consecutive top-level array elements, each about `span_bytes` long.
+
+    Only brackets outside strings are tracked, block by block with numpy, to
+    find where the objects and arrays of the top-level array start; nothing
+    is decoded. Every range starts at such an element and ends at the next
+    range (the last one at the closing bracket). An empty list means the
+    file cannot be split: it is not an array or has fewer than two such
+    elements.
+    """
+    with open(json_file_path, 'rb') as f:
+        if f.read(64).lstrip()[:1] != b'[':
+            return []
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    starts = []
+    end = None
+    depth = 0
+    in_string = False
+    backslashes = 0
+    try:
+        for offset in range(0, len(buffer), block_size):
+            data = np.frombuffer(buffer, dtype=np.uint8, count=min(block_size, len(buffer) - offset), offset=offset)
+            quotes = _unescaped_quotes(data, backslashes)
+            opening = np.flatnonzero((data == ord('[')) | (data == ord('{')))
+            closing = np.flatnonzero((data == ord(']')) | (data == ord('}')))
+            brackets = np.concatenate((opening, closing))
+            steps = np.concatenate((np.ones(len(opening), dtype=np.int64), np.full(len(closing), -1, dtype=np.int64)))
+            order = np.argsort(brackets, kind='stable')
+            brackets, steps = brackets[order], steps[order]
+            outside = (np.searchsorted(quotes, brackets) + in_string) % 2 == 0
+            brackets, steps = brackets[outside], steps[outside]
+            depth_before = depth + np.cumsum(steps) - steps
+            starts.extend((brackets[(depth_before == 1) & (steps == 1)] + offset).tolist())
+            if end is None:
+                last = brackets[(depth_before == 1) & (steps == -1)]
+                if len(last):
+                    end = int(last[0]) + offset
+            depth += int(steps.sum())
+            in_string ^= bool(len(quotes) % 2)
+            trailing = 0
+            while trailing < len(data) and data[-1 - trailing] == ord('\\'):
+                trailing += 1
+            backslashes = trailing if trailing < len(data) else backslashes + trailing
+            del data
+    finally:
+        buffer.close()
+    if end is None:
+        raise ValueError("Unexpected end of JSON array")
+    if len(starts) < 2:
+        return []
+    cuts = [starts[0]]
+    for start in starts:
+        if start - cuts[-1] >= span_bytes:
+            cuts.append(start)
+    return list(zip(cuts, cuts[1:] + [end]))
+
+
+_WHITESPACE = re.compile(r'[ \t\r\n]*')
+
+
+def iter_json_elements(text: str) -> Iterator[Any]:
+    """Yield the comma-separated JSON values of `text`, e.g. the inside of an array, one at a time."""
+    decoder = json.JSONDecoder()
+    position = _WHITESPACE.match(text).end()
+    while position < len(text):
+        value, position = decoder.raw_decode(text, position)
+        yield value
+        position = _WHITESPACE.match(text, position).end()
+        if position < len(text):
+            if text[position] != ',':
+                raise ValueError(f"Expected ',' between JSON array elements, got '{text[position]}'")
+            position = _WHITESPACE.match(text, position + 1).end()
+            if position == len(text):
+                raise ValueError("Trailing ',' after the last JSON array element")
+
+
+def iter_json_span(json_file_path: Path, span: Tuple[int, int]) -> Iterator[Any]:
+    """Yield the array elements in a byte range of json_array_spans()."""
+    start, stop = span
+    with open(json_file_path, 'rb') as f:
+        f.seek(start)
+        text = f.read(stop - start).decode('utf-8').rstrip(' \t\r\n')
+    # Every range but the last ends with the separator before the next range
+    return iter_json_elements(text[:-1] if text.endswith(',') else text)
+
+
+class SampleBatch:
+    """A homogeneous batch of decoded samples."""
+
+    def __init__(self, values: np.ndarray, meta: Dict[str, List], sensor_name: Optional[str],
+                 device_sensor_info: Optional[Dict], calibrations: List[Dict], calibration_index: np.ndarray,
+                 sample_offset: int, sample_index: Optional[np.ndarray] = None):
+        # Dark-current corrected raw sensor values (n_samples, n_leds, n_sensors)
+        self.values = values
+        # Columnar metadata (uuid, filename, info fields); missing values are None
+        self.meta = meta
+        self.sensor_name = sensor_name
+        self.device_sensor_info = device_sensor_info
+        # Unique calibration maps of the batch and the map used by each sample (-1: none)
+        self.calibrations = calibrations
+        self.calibration_index = calibration_index
+        # Position of the first sample of this batch in the whole export
+        self.sample_offset = sample_offset
+        # Position of every sample in the whole export
+        if sample_index is None:
+            sample_index = np.arange(sample_offset, sample_offset + values.shape[0])
+        self.sample_index = sample_index
+
+    def __len__(self) -> int:
+        return self.values.shape[0]
+
+
+class _BatchBuilder:
+    """Fills preallocated arrays for one batch."""
+
+    def __init__(self, batch_size: int, shape: Tuple[int, int], sensor_name: Optional[str],
+                 device_sensor_info: Optional[Dict], sample_offset: int):
+        self.values = np.empty((batch_size,) + shape, dtype=np.float64)
+        self.calibration_index = np.full(batch_size, -1, dtype=np.intp)
+        self.sample_index = np.empty(batch_size, dtype=np.intp)
+        self.meta: Dict[str, List] = {}
+        self.calibrations: List[Dict] = []
+        self._calibration_keys: Dict[str, int] = {}
+        self.sensor_name = sensor_name
+        self.device_sensor_info = device_sensor_info
+        self.sample_offset = sample_offset
+        self.count = 0
+
+    def is_full(self) -> bool:
+        return self.count == self.values.shape[0]
+
+    def add(self, values: np.ndarray, kv_list: Dict[str, Any], calibration_key: Optional[str],
+            calibration_map: Optional[Dict], sample_index: int):
+        row = self.count
+        self.values[row] = values
+        self.sample_index[row] = sample_index
+        # Same column union semantics as add_row_by_kv(): new columns are back-filled with NA
+        for key, value in kv_list.items():
+            column = self.meta.get(key)
+            if column is None:
+                column = self.meta[key] = [None] * row
+            column.append(value)
+        for column in self.meta.values():
+            if len(column) == row:
+                column.append(None)
+        if calibration_key is not None:
+            position = self._calibration_keys.get(calibration_key)
+            if position is None:
+                position = self._calibration_keys[calibration_key] = len(self.calibrations)
+                self.calibrations.append(calibration_map)
+            self.calibration_index[row] = position
+        self.count += 1
+
+    def build(self) -> SampleBatch:
+        n = self.count
+        return SampleBatch(self.values[:n], self.meta, self.sensor_name, self.device_sensor_info,
+                           self.calibrations, self.calibration_index[:n], self.sample_offset,
+                           self.sample_index[:n])
+
+
+class RegularScannerStreamDecoder:
+    """Streams Regular ScanCorder JSON exports as fixed-size sample batches."""
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.helpers = ScanCorderHelpers()
+        # (calibration block, sample shape, key, calibration map), most recent first
+        self._recent_calibrations = deque(maxlen=RECENT_CALIBRATIONS)
+
+    def iter_samples(self, json_file_path: Path, span: Optional[Tuple[int, int]] = None) -> Iterator[Dict]:
+        """Yield flattened samples, with info/filename of their export entry attached.
+
+        With `span` (see json_array_spans()) only the entries in that byte range are read.
+        """
+        entries = iter_json_entries(json_file_path, self.chunk_size) if span is None else \
+            iter_json_span(json_file_path, span)
+        return self.flatten_samples(entries)
+
+    def flatten_samples(self, entries: Iterable) -> Iterator[Dict]:
+        """Yield the samples of already parsed export entries (e.g. scans posted to scoring_service.py)."""
+        for entry in entries:
+            for item in self.helpers.ensure_list(entry):
+                if isinstance(item, dict) and 'data' in item:
+                    info = self.helpers.filter_info_fields(self.helpers.get_nested(item, ('store', 'meta', 'meta', 'info')))
+                    filename = item.get('filename')
+                    for d in item['data']:
+                        yield dict(d, info=info, filename=filename)
+                else:
+                    yield item
+
+    def subtract_dark_current(self, values: np.ndarray, source: Dict) -> np.ndarray:
+        """Subtract per-LED dark current (preferred) or per-sensor dark current."""
+        if source.get('perLEDDarkCurrent') is not None:
+            return values - self.helpers.convert_json_to_matrix(source['perLEDDarkCurrent'])
+        if source.get('darkCurrent') is not None:
+            dark_current = np.asarray(source['darkCurrent'], dtype=np.float64)
+            # A per-sensor vector applies to every LED row
+            return values - (dark_current.ravel() if dark_current.ndim == 1 else dark_current)
+        return values
+
+    def decode_calibration(self, sample: Dict) -> Optional[Dict]:
+        """Build the calibration map of a sample: true value key -> stacked measurements and true factor."""
+        if sample.get('calibration') is None:
+            return None
+        calibration_map = {}
+        for calibration in self.helpers.ensure_list(sample['calibration']):
+            data = self.helpers.convert_json_to_matrix(calibration['sensorValue'])
+            if calibration.get('perLEDDarkCurrent') is not None or calibration.get('darkCurrent') is not None:
+                data = self.subtract_dark_current(data, calibration)
+            elif sample.get('shape') is not None and sample['shape'][0] + 1 == data.shape[0]:
+                # Legacy format: the first sensor reading is the dark current
+                data = data[1:] - data[0]
+            true_value = calibration.get('trueValuePercentage')
+            key = str(int(true_value)) if isinstance(true_value, float) and true_value.is_integer() else str(true_value)
+            if key not in calibration_map:
+                calibration_map[key] = {'sensor_values': [data], 'true_factor': calibration.get('trueValueFactor')}
+            else:
+                calibration_map[key]['sensor_values'].append(data)
+        for entry in calibration_map.values():
+            entry['sensor_values'] = np.stack(entry['sensor_values'])
+        return calibration_map
+
+    def calibration_for(self, sample: Dict) -> Tuple[Optional[str], Optional[Dict]]:
+        """Content key and decoded map of a sample's calibration, decoding each distinct set once."""
+        block = sample.get('calibration')
+        if block is None:
+            return None, None
+        shape = sample.get('shape')
+        for recent in self._recent_calibrations:
+            if recent[1] == shape and (recent[0] is block or recent[0] == block):
+                return recent[2], recent[3]
+        calibration_map = self.decode_calibration(sample)
+        raw = json.dumps(block, sort_keys=True, separators=(',', ':'))
+        key = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+        self._recent_calibrations.appendleft((block, shape, key, calibration_map))
+        return key, calibration_map
+
+    def _metadata(self, sample: Dict) -> Dict[str, Any]:
+        kv_list = {}
+        if sample.get('uuid') is not None:
+            kv_list['uuid'] = sample['uuid']
+        if sample.get('filename') is not None:
+            kv_list['filename'] = sample['filename']
+        if isinstance(sample.get('info'), dict):
+            for key, value in sample['info'].items():
+                kv_list[key.strip()] = value
+        return kv_list
+
+    def iter_batches(self, json_file_path: Path, span: Optional[Tuple[int, int]] = None) -> Iterator[SampleBatch]:
+        """Yield SampleBatches of at most `batch_size` samples from an export file.
+
+        With `span`, only the entries in that byte range are decoded and the
+        sample positions count from the start of the range.
+        """
+        return self.batches_from_samples(self.iter_samples(json_file_path, span))
+
+    def batches_from_samples(self, samples: Iterable[Dict]) -> Iterator[SampleBatch]:
+        """Group flattened samples into SampleBatches, see iter_batches()."""
+        builder = None
+        sample_count = -1
+        for sample in samples:
+            sample_count += 1
+            if not isinstance(sample, dict) or 'values' not in sample:
+                raise ValueError("Regular Scanner input json needs to contain a 'values' key containing sensor data")
+            values = self.subtract_dark_current(self.helpers.convert_json_to_matrix(sample['values']), sample)
+            sensor_name = self.helpers.get_nested(sample, ('config', 'sensorHead', 'name'))
+            if builder is not None and (builder.is_full() or builder.values.shape[1:] != values.shape
+                                        or builder.sensor_name != sensor_name):
+                yield builder.build()
+                builder = None
+            if builder is None:
+                device_sensor_info = self.helpers.get_nested(sample, ('config', 'sensorHead', 'additionalInfo'))
+                builder = _BatchBuilder(self.batch_size, values.shape, sensor_name, device_sensor_info, sample_count)
+            calibration_key, calibration_map = self.calibration_for(sample)
+            builder.add(values, self._metadata(sample), calibration_key, calibration_map, sample_count)
+        if builder is not None and builder.count > 0:
+            yield builder.build()
+
+
+def main():
+    """Decode an export and print a summary of its batches."""
+    if len(sys.argv) < 2:
+        print("Usage: python scancorder_regular_decode.py <export.json> [batch_size]")
+        print("\nExample: python scancorder_regular_decode.py ../example/data/Compolytics_R-Package_VI_Test_File.json 256")
+        print("\nRequirements:")
+        print("  pip install numpy")
+        sys.exit(1)
+    batch_size = int(sys.argv[2]) if len(sys.argv) >= 3 else DEFAULT_BATCH_SIZE
+    decoder = RegularScannerStreamDecoder(batch_size=batch_size)
+    total = 0
+    for batch in decoder.iter_batches(Path(sys.argv[1])):
+        total += len(batch)
+        print(f"📦 Batch at sample {batch.sample_offset}: {len(batch)} samples, values {batch.values.shape}, "
+              f"sensor '{batch.sensor_name}', {len(batch.calibrations)} calibration set(s), "
+              f"metadata columns: {', '.join(batch.meta)}")
+    print(f"\n✅ Decoded {total} samples")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+"""
+Batch Scoring of ScanCorder Exports
+
+Scores a directory or glob of Regular ScanCorder JSON exports (or of
+reflectance cubes converted with reflectance_cube.py) on a pool of worker
+processes and merges the results of all files into one index table
+with per-file provenance. Each file runs through the steps of
+example/01_generate_indices_table_from_Scancorder.R:
+
+1. streaming decode (scancorder_regular_decode.py) and calibration
+   against the reference measurements (calibration.py)
+2. feature extraction with the sensor's channel mask (feature_extraction.py),
+   averaging the sensor values per LED unless --no-average is given
+3. the sensor's precomputed multi_calibration factors (skip: --no-multipoint)
+4. scoring of all indices computable on the feature grid (catalogue_dag.py),
+   restricted to the sensor's valid_vi list when it has one
+
+Every worker loads the compiled index catalogue (index_catalogue.py) and the
+sensor registry (sensor_registry.py) once. Files larger than --split-size
+are cut into spans of about that many bytes, each scored as a separate task:
+exports at entry boundaries found by a bracket scan that decodes nothing
+(scancorder_regular_decode.py), reflectance lists at line ends and cubes at
+multiples of --chunk-samples. Every span is parsed by exactly one worker and
+comes back as one bounded chunk of rows; sample positions of export and
+list spans are made file positions again by the parent.
+
+Reflectance cubes skip steps 1-3: their memory-mapped samples are scored
+directly on the cube's wavelength grid and valid_vi list. Reflectance-list
+CSVs (.csv) are streamed with reflectance_list_reader.py and scored on the
+grid of the --sensor given, like DecodeReflectanceList.
+
+The output format follows the file extension (.csv, .parquet, .arrow), see
+table_writers.py. Its columns are source_file, sample (1-based position in
+the file), the --meta-columns and one column per index of the catalogue.
+
+Calibration coefficients are cached per reference set (calibration.py);
+--calibration-cache DIR also keeps them on disk, shared by all workers and
+later runs against the same references.
+
+--aggregate-by LabelName (or any metadata column, or source_file) writes
+count, mean, standard deviation, min, max and quantiles of every index per
+group instead of the sample table (aggregation.py). Workers aggregate their
+tasks into mergeable running moments and quantile sketches, so no rows are
+kept in memory or sent between processes.
+
+--float32 evaluates the indices in single precision; the indices that
+precision_validation.py found ill-conditioned stay in double precision.
+
+--report writes the stage timers of all workers (instrumentation.py) as
+JSON; --per-index adds evaluation time and NaN/Inf counts per index (scored
+index by index instead of through the shared DAG) and --cprofile writes one
+merged cProfile dump of the worker tasks.
+
+Usage: python score_exports.py <export.json | directory | glob> [...] -o indices.csv [--workers N]
+
+Requirements: pip install numpy (Parquet/Arrow output additionally needs pyarrow)
+"""
+
+import argparse
+import contextlib
+import glob
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Collection, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from aggregation import DEFAULT_QUANTILES, GroupedAggregator, parse_quantiles
+from band_plan import BandPlanner
+from calibration import CalibrationCache, CalibrationReflectanceMultipoint, calibrate_batch
+from catalogue_dag import build_catalogue_dag
+from feature_extraction import FeatureExtractor, FeaturePlan
+from index_catalogue import default_artifact_path, load_catalogue
+from instrumentation import NULL_INSTRUMENTATION, Instrumentation, merge_profiles
+from precision_validation import DEFAULT_OVERRIDES_FILE, load_float64_indices
+from reflectance_cube import CUBE_SUFFIX, open_reflectance_cube
+from reflectance_list_reader import ReflectanceListReader, reflectance_list_grid
+from scancorder_regular_decode import DEFAULT_BATCH_SIZE, RegularScannerStreamDecoder, json_array_spans
+from sensor_registry import DEFAULT_SENSORS_DIRECTORY, get_registry
+from table_writers import open_table_writer
+
+
+DEFAULT_XML_FOLDER = Path(__file__).resolve().parent.parent / 'inst' / 'extdata' / 'indices'
+DEFAULT_SPLIT_SIZE = 16 * 2 ** 20
+DEFAULT_CHUNK_SAMPLES = 4096
+
+
+class ExportReflectance:
+    """Turns decoded SampleBatches into calibrated reflectance on the sensor's feature grid."""
+
+    def __init__(self, sensors_directory: Optional[Path] = None, registry_index: Optional[Path] = None,
+                 average_sensor_values: bool = True, multipoint: bool = True, batch_size: int = DEFAULT_BATCH_SIZE,
+                 instrumentation: Instrumentation = NULL_INSTRUMENTATION, calibration_cache_dir: Optional[Path] = None):
+        self.registry = get_registry(sensors_directory, registry_index)
+        self.extractor = FeatureExtractor()
+        self.decoder = RegularScannerStreamDecoder(batch_size=batch_size)
+        self.average_sensor_values = average_sensor_values
+        self.multipoint = multipoint
+        self.instrumentation = instrumentation
+        # Mean references and fitted coefficients per reference set, shared with other runs via the directory
+        self.calibration_cache = CalibrationCache(cache_dir=calibration_cache_dir)
+
+    def reflectance(self, batch) -> Tuple[np.ndarray, FeaturePlan, Optional[Dict]]:
+        """(features, feature plan, package sensor info) of one SampleBatch."""
+        instrumentation = self.instrumentation
+        n_samples = len(batch)
+        external = self.registry.find_sensor_metadata(batch.sensor_name) if batch.sensor_name else None
+        with instrumentation.stage('calibration', n_samples):
+            reflectance = calibrate_batch(batch, self.calibration_cache)
+        with instrumentation.stage('feature_extraction', n_samples):
+            feature_plan = self.extractor.compile_for_sensor(batch.device_sensor_info, external,
+                                                             batch.values.shape[1:], self.average_sensor_values)
+            features = feature_plan.apply(reflectance)
+        if self.multipoint:
+            with instrumentation.stage('multipoint_calibration', n_samples):
+                calibrator = CalibrationReflectanceMultipoint.from_sensor_info(batch.device_sensor_info, external)
+                features = calibrator.score(features)
+        if feature_plan.wavelengths is None:
+            raise ValueError("Cannot load LED wavelengths from sensor metadata")
+        return features, feature_plan, external
+
+    @staticmethod
+    def valid_vi(batch, external: Optional[Dict]) -> Optional[List[str]]:
+        """valid_vi of a batch, taken from the package sensor info first as in the R decoder."""
+        sensor_info = external if external is not None else batch.device_sensor_info
+        return (sensor_info or {}).get('valid_vi')
+
+
+class ExportScorer(ExportReflectance):
+    """Decodes, calibrates and scores exports with cached per-sensor plans."""
+
+    def __init__(self, catalogue_path: Optional[Path], xml_folder: Path = DEFAULT_XML_FOLDER,
+                 sensors_directory: Optional[Path] = None, registry_index: Optional[Path] = None,
+                 average_sensor_values: bool = True, multipoint: bool = True, batch_size: int = DEFAULT_BATCH_SIZE,
+                 instrumentation: Instrumentation = NULL_INSTRUMENTATION, list_sensor: Optional[str] = None,
+                 precision: str = 'float64', float64_indices: Optional[Collection[str]] = None,
+                 calibration_cache_dir: Optional[Path] = None, indices: Optional[Collection[str]] = None):
+        super().__init__(sensors_directory, registry_index, average_sensor_values, multipoint, batch_size,
+                         instrumentation, calibration_cache_dir)
+        # Sensor serial of reflectance-list CSV inputs
+        self.list_sensor = list_sensor
+        # Evaluation precision; float64_indices stay in double precision in float32 mode
+        self.dtype = np.dtype(precision)
+        self.float64_indices = frozenset(float64_indices or ())
+        # Indices to score (default: all); other indices are left out of the results
+        self.selected_indices = None if indices is None else frozenset(indices)
+        catalogue = load_catalogue(xml_folder, catalogue_path)
+        self.engine = catalogue.engine()
+        self.index_names = catalogue.index_names()
+        self.planner = BandPlanner(self.engine.indices.values())
+        self._dags = {}
+
+    def _dag_passes(self, plan) -> List[Tuple]:
+        """(DAG, dtype) pairs scoring a plan in the configured precision."""
+        key = (id(plan), self.dtype.str, self.float64_indices)
+        passes = self._dags.get(key)
+        if passes is None:
+            active = plan.pruned()
+            double = [name for name in active.index_names if name in self.float64_indices]
+            if self.dtype == np.float64 or not double:
+                passes = [(build_catalogue_dag(self.engine, plan), self.dtype)]
+            else:
+                single = [name for name in active.index_names if name not in self.float64_indices]
+                passes = [(build_catalogue_dag(self.engine, active.subset(single)), self.dtype),
+                          (build_catalogue_dag(self.engine, active.subset(double)), np.dtype(np.float64))]
+            self._dags[key] = passes
+        return passes
+
+    def score_batch(self, batch) -> Dict[str, np.ndarray]:
+        """Index values of one SampleBatch (indices outside the sensor's valid_vi are left out)."""
+        features, feature_plan, external = self.reflectance(batch)
+        return self.score_reflectance(features, feature_plan.wavelengths, feature_plan.fwhm,
+                                      self.valid_vi(batch, external))
+
+    def score_reflectance(self, features: np.ndarray, wavelengths: np.ndarray, fwhm: Optional[np.ndarray],
+                          valid_vi: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+        """Index values of reflectance on a wavelength grid, restricted to `valid_vi` and the selected indices."""
+        instrumentation = self.instrumentation
+        with instrumentation.stage('planning', features.shape[0]):
+            plan = self.planner.plan(wavelengths, fwhm)
+            index_names = None
+            if valid_vi:
+                listed = set(valid_vi)
+                index_names = [name for name in plan.index_names if name in listed] or None
+            if self.selected_indices is not None:
+                index_names = [name for name in (index_names or plan.index_names) if name in self.selected_indices]
+                if not index_names:
+                    return {}
+            # A DAG of only the listed indices skips the nodes no listed index needs
+            passes = None if instrumentation.per_index else \
+                self._dag_passes(plan if index_names is None else plan.subset(index_names))
+        if passes is None:
+            # Index by index, so that every index gets its own evaluation time
+            return self.engine.score(features, plan, index_names, instrumentation=instrumentation,
+                                     dtype=self.dtype, float64_indices=self.float64_indices)
+        results = {}
+        for dag, dtype in passes:
+            results.update(dag.score(features, index_names, instrumentation=instrumentation, dtype=dtype))
+        return results
+
+    def score_file(self, json_file: Path, span: Optional[Tuple[int, int]] = None,
+                   chunk_samples: int = DEFAULT_CHUNK_SAMPLES, meta_columns: Sequence[str] = ()) -> Dict[str, List]:
+        """Score the samples of one file (or of one span of it, see file_spans()), returning columns of the output table.
+
+        Sample positions of an export or reflectance-list span count from the start of the span.
+        """
+        columns: Dict[str, List] = {'sample': []}
+        columns.update((name, []) for name in meta_columns)
+        scores: Dict[str, List[np.ndarray]] = {}
+        n_rows = 0
+        for samples, meta, results in self._file_batches(json_file, span, chunk_samples, meta_columns):
+            columns['sample'].extend(samples)
+            for name in meta_columns:
+                columns[name].extend(meta[name])
+            for name in set(scores) | set(results):
+                # Indices missing from a batch (e.g. another sensor head) are NA
+                previous = scores.setdefault(name, [np.full(n_rows, np.nan)] if n_rows else [])
+                previous.append(results.get(name, np.full(len(samples), np.nan)))
+            n_rows += len(samples)
+        columns['scores'] = {name: np.concatenate(parts) for name, parts in scores.items()}
+        columns['n_rows'] = n_rows
+        return columns
+
+    def aggregate_file(self, json_file: Path, span: Optional[Tuple[int, int]] = None,
+                       chunk_samples: int = DEFAULT_CHUNK_SAMPLES, group_columns: Sequence[str] = ()) -> GroupedAggregator:
+        """Aggregate the scores of one file (or span) per group without keeping its rows.
+
+        The group column source_file is the file name, the others are metadata columns.
+        """
+        aggregator = GroupedAggregator(self.index_names, group_columns)
+        meta_columns = [name for name in group_columns if name != 'source_file']
+        for samples, meta, results in self._file_batches(json_file, span, chunk_samples, meta_columns):
+            if 'source_file' in group_columns:
+                meta = dict(meta, source_file=[Path(json_file).name] * len(samples))
+            with self.instrumentation.stage('aggregation', len(samples)):
+                aggregator.update(meta, results, len(samples))
+        return aggregator
+
+    def _file_batches(self, json_file: Path, span: Optional[Tuple[int, int]], chunk_samples: int,
+                      meta_columns: Sequence[str]):
+        """(samples, meta, scores) batches of one file (or of one span of it)."""
+        suffix = Path(json_file).suffix.lower()
+        if suffix == CUBE_SUFFIX:
+            return self._cube_batches(Path(json_file), span, chunk_samples, meta_columns)
+        if suffix == '.csv':
+            return self._list_batches(Path(json_file), span, meta_columns)
+        return self._export_batches(Path(json_file), span, meta_columns)
+
+    def _export_batches(self, json_file: Path, span: Optional[Tuple[int, int]], meta_columns: Sequence[str]):
+        for batch in self.instrumentation.iterate('decode', self.decoder.iter_batches(json_file, span)):
+            meta = {name: batch.meta.get(name, [None] * len(batch)) for name in meta_columns}
+            yield (batch.sample_index + 1).tolist(), meta, self.score_batch(batch)
+
+    def _list_batches(self, csv_file: Path, span: Optional[Tuple[int, int]], meta_columns: Sequence[str]):
+        """Score a reflectance-list CSV (or a byte range of it) block by block."""
+        reader = ReflectanceListReader(csv_file)
+        sensor_info = self.registry.find_sensor_metadata(self.list_sensor) if self.list_sensor else None
+        wavelengths, fwhm = reflectance_list_grid(sensor_info, reader.wavelengths)
+        if len(wavelengths) != len(reader.wavelengths):
+            raise ValueError(f"Number of wavelengths in CSV ({len(reader.wavelengths)}) does not match "
+                             f"sensor metadata ({len(wavelengths)})")
+        valid_vi = None if sensor_info is None else sensor_info.get('valid_vi')
+        for chunk in self.instrumentation.iterate('decode', reader.iter_chunks(span)):
+            n_rows = len(chunk)
+            meta = {name: chunk.meta[name].tolist() if name in chunk.meta else [None] * n_rows
+                    for name in meta_columns}
+            samples = list(range(chunk.sample_offset + 1, chunk.sample_offset + n_rows + 1))
+            yield samples, meta, self.score_reflectance(chunk.values, wavelengths, fwhm, valid_vi)
+
+    def _cube_batches(self, cube_file: Path, span: Optional[Tuple[int, int]], chunk_samples: int,
+                      meta_columns: Sequence[str]):
+        """Score a reflectance cube (or a sample range of it) chunk by chunk on views of the memory-mapped samples."""
+        with open_reflectance_cube(cube_file) as cube:
+            names = cube.meta.names if cube.meta is not None else []
+            for start, reflectance in cube.batches(chunk_samples, *(span or ())):
+                stop = start + len(reflectance)
+                # Cubes converted from exports keep the sample position in the export
+                samples = cube.meta.rows('sample', start, stop) if 'sample' in names \
+                    else list(range(start + 1, stop + 1))
+                meta = {name: cube.meta.rows(name, start, stop) if name in names else [None] * len(reflectance)
+                        for name in meta_columns}
+                yield samples, meta, self.score_reflectance(reflectance, cube.wavelengths, cube.fwhm, cube.valid_vi)
+
+
+_worker_scorer: Optional[ExportScorer] = None
+_worker_instrumentation: Optional[Dict] = None
+
+
+def _init_worker(options: Dict, instrumentation: Optional[Dict] = None):
+    """Load the catalogue and sensor registry once per worker process.
+
+    `instrumentation` holds the Instrumentation options (per_index, profile
+    and profile_directory) when the run is instrumented.
+    """
+    global _worker_scorer, _worker_instrumentation
+    _worker_scorer = ExportScorer(**options)
+    _worker_instrumentation = instrumentation
+
+
+def _score_task(task: Tuple) -> Tuple[Tuple, Optional[Dict], Optional[str], float, Optional[Dict]]:
+    """Score one task; the last element is its instrumentation report (None if disabled).
+
+    With group columns the result is the task's GroupedAggregator instead of its table columns.
+    """
+    json_file, span, _, _, chunk_samples, meta_columns, group_columns = task
+    instrumentation = NULL_INSTRUMENTATION
+    if _worker_instrumentation is not None:
+        # A fresh instance per task, so the parent can merge the reports without double counting
+        instrumentation = Instrumentation(per_index=_worker_instrumentation['per_index'],
+                                          profile=_worker_instrumentation['profile'])
+    _worker_scorer.instrumentation = instrumentation
+    start = time.perf_counter()
+    result = None
+    error = None
+    instrumentation.start_profile()
+    try:
+        if group_columns:
+            result = _worker_scorer.aggregate_file(Path(json_file), span, chunk_samples, group_columns)
+        else:
+            result = _worker_scorer.score_file(Path(json_file), span, chunk_samples, meta_columns)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        instrumentation.stop_profile()
+    seconds = time.perf_counter() - start
+    report = None
+    if instrumentation.enabled:
+        report = instrumentation.report()
+        if _worker_instrumentation['profile']:
+            handle, profile_file = tempfile.mkstemp(suffix='.prof', dir=_worker_instrumentation['profile_directory'])
+            os.close(handle)
+            instrumentation.dump_profile(Path(profile_file))
+            report['profile_file'] = profile_file
+    return task, result, error, seconds, report
+
+
+def collect_inputs(inputs: Sequence[str]) -> List[Path]:
+    """Expand directories (*.json, *.srcube) and glob patterns to a sorted, de-duplicated file list.
+
+    Reflectance-list CSVs are only picked up when given as files or glob patterns.
+    """
+    files = []
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            files.extend(sorted(list(path.glob('*.json')) + list(path.glob(f'*{CUBE_SUFFIX}'))))
+        elif path.is_file():
+            files.append(path)
+        else:
+            files.extend(sorted(Path(match) for match in glob.glob(item, recursive=True)))
+    unique = []
+    seen = set()
+    for file in files:
+        key = file.resolve()
+        if key not in seen:
+            seen.add(key)
+            unique.append(file)
+    return unique
+
+
+def file_spans(file: Path, split_size: int, chunk_samples: int) -> List[Optional[Tuple[int, int]]]:
+    """Spans of about `split_size` bytes of a file; [None] when it is scored as a whole.
+
+    Spans are byte ranges of whole entries (exports) or lines (reflectance
+    lists) and sample ranges of multiples of `chunk_samples` (cubes).
+    """
+    size = file.stat().st_size
+    if split_size <= 0 or size <= split_size:
+        return [None]
+    suffix = file.suffix.lower()
+    if suffix == CUBE_SUFFIX:
+        with open_reflectance_cube(file) as cube:
+            n_samples = cube.n_samples
+        step = -(-n_samples // -(-size // split_size))
+        step = max(chunk_samples, -(-step // chunk_samples) * chunk_samples)
+        spans = [(start, min(start + step, n_samples)) for start in range(0, n_samples, step)]
+    elif suffix == '.csv':
+        spans = ReflectanceListReader(file).line_spans(split_size)
+    else:
+        spans = json_array_spans(file, split_size)
+    return spans if len(spans) > 1 else [None]
+
+
+def plan_tasks(files: Sequence[Path], split_size: int, chunk_samples: int,
+               meta_columns: Sequence[str], group_columns: Sequence[str] = ()) -> List[Tuple]:
+    """One task per file, or per span of the files above `split_size` bytes (see file_spans())."""
+    tasks = []
+    for file in files:
+        spans = file_spans(file, split_size, chunk_samples)
+        tasks.extend((str(file), span, part, len(spans), chunk_samples, tuple(meta_columns), tuple(group_columns))
+                     for part, span in enumerate(spans))
+    return tasks
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Score ScanCorder JSON exports on a process pool.")
+    parser.add_argument('inputs', nargs='+', help="Export files, directories or glob patterns")
+    parser.add_argument('-o', '--output', type=Path, required=True,
+                        help="Output table (.csv, .parquet or .arrow)")
+    parser.add_argument('--workers', type=int, default=0, help="Number of worker processes (default: all cores)")
+    parser.add_argument('--xml-folder', type=Path, default=DEFAULT_XML_FOLDER, help="Folder with index XML files")
+    parser.add_argument('--catalogue', type=Path,
+                        help="Compiled index catalogue, rebuilt when missing or stale (default: in the user cache directory)")
+    parser.add_argument('--sensors', type=Path, default=DEFAULT_SENSORS_DIRECTORY, help="Folder with sensor JSON files")
+    parser.add_argument('--sensor', help="Sensor serial of reflectance-list CSV inputs (e.g. S8330)")
+    parser.add_argument('--float32', action='store_true',
+                        help="Score in single precision, except for the indices listed in --float64-indices")
+    parser.add_argument('--float64-indices', type=Path, default=DEFAULT_OVERRIDES_FILE,
+                        help="JSON list of indices kept in double precision "
+                             "(default: float32_overrides.json written by precision_validation.py)")
+    parser.add_argument('--no-average', action='store_true', help="Do not average sensor values per LED")
+    parser.add_argument('--no-multipoint', action='store_true', help="Skip the multi_calibration factors")
+    parser.add_argument('--calibration-cache', type=Path,
+                        help="Directory persisting fitted calibration coefficients across workers and runs")
+    parser.add_argument('--meta-columns', default='uuid,filename',
+                        help="Comma-separated metadata columns to copy (default: uuid,filename)")
+    parser.add_argument('--aggregate-by',
+                        help="Write per-group statistics of every index instead of the sample table, grouped by "
+                             "these comma-separated metadata columns (source_file: the input file)")
+    parser.add_argument('--quantiles', default=','.join(f"{q:g}" for q in DEFAULT_QUANTILES),
+                        help="Comma-separated quantiles of --aggregate-by (default: 0.05,0.25,0.5,0.75,0.95)")
+    parser.add_argument('--split-size', type=int, default=DEFAULT_SPLIT_SIZE,
+                        help=f"Score files larger than this many bytes in spans of about this size "
+                             f"(default: {DEFAULT_SPLIT_SIZE})")
+    parser.add_argument('--chunk-samples', type=int, default=DEFAULT_CHUNK_SAMPLES,
+                        help=f"Samples per scoring batch and span granularity of reflectance cubes "
+                             f"(default: {DEFAULT_CHUNK_SAMPLES})")
+    parser.add_argument('--report', type=Path, help="Write the instrumentation report (JSON) to this file")
+    parser.add_argument('--per-index', action='store_true',
+                        help="Include evaluation time and NaN/Inf counts per index in the report")
+    parser.add_argument('--cprofile', type=Path, help="Write a merged cProfile dump of the worker tasks")
+    args = parser.parse_args()
+    if args.catalogue is None:
+        args.catalogue = default_artifact_path(args.xml_folder)
+    return args
+
+
+def main():
+    """Score all exports and write the merged table."""
+    if len(sys.argv) < 2:
+        print("Usage: python score_exports.py <export.json | directory | glob> [...] -o indices.csv [--workers N]")
+        print("\nExample: python score_exports.py ../example/data/ -o indices.parquet --workers 8")
+        print("\nRequirements:")
+        print("  pip install numpy (pyarrow for Parquet/Arrow output)")
+        sys.exit(1)
+    args = parse_arguments()
+    files = collect_inputs(args.inputs)
+    if not files:
+        print("❌ No export files found")
+        sys.exit(1)
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    meta_columns = [name.strip() for name in args.meta_columns.split(',') if name.strip()]
+    group_columns = [name.strip() for name in (args.aggregate_by or '').split(',') if name.strip()]
+    try:
+        quantiles = parse_quantiles(args.quantiles)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    tasks = plan_tasks(files, args.split_size, args.chunk_samples, meta_columns, group_columns)
+    print(f"📄 Found {len(files)} export files ({len(tasks)} tasks, {workers} workers)")
+
+    # Compile the catalogue and the registry index once before the workers start
+    catalogue = load_catalogue(args.xml_folder, args.catalogue)
+    index_names = catalogue.index_names()
+    catalogue.close()
+    registry_index = args.catalogue.with_name('sensor_registry_index.json')
+    get_registry(args.sensors, registry_index)
+    options = {
+        'catalogue_path': args.catalogue,
+        'xml_folder': args.xml_folder,
+        'sensors_directory': args.sensors,
+        'registry_index': registry_index,
+        'average_sensor_values': not args.no_average,
+        'multipoint': not args.no_multipoint,
+        'list_sensor': args.sensor,
+        'precision': 'float32' if args.float32 else 'float64',
+        'float64_indices': sorted(load_float64_indices(args.float64_indices)) if args.float32 else None,
+        'calibration_cache_dir': args.calibration_cache,
+    }
+
+    instrumented = args.report is not None or args.per_index or args.cprofile is not None
+    instrumentation = Instrumentation(enabled=instrumented, per_index=args.per_index)
+    profile_directory = tempfile.TemporaryDirectory() if args.cprofile else None
+    worker_instrumentation = None
+    if instrumented:
+        worker_instrumentation = {'per_index': args.per_index, 'profile': args.cprofile is not None,
+                                  'profile_directory': profile_directory.name if profile_directory else None}
+    profile_files = []
+
+    start = time.perf_counter()
+    n_samples = 0
+    errors = {}
+    # Samples of the previous spans per file, added to the span-relative positions of exports and lists
+    # (None after a failed span, whose length is unknown)
+    sample_offsets: Dict[str, Optional[int]] = {}
+    columns = {'source_file': 'string', 'sample': 'float64'}
+    columns.update((name, 'string') for name in meta_columns)
+    # With --aggregate-by the workers return partial aggregates, merged here instead of writing rows
+    aggregator = GroupedAggregator(index_names, group_columns) if group_columns else None
+    output = contextlib.nullcontext() if aggregator is not None else open_table_writer(args.output, index_names, columns)
+    with output as writer:
+        if workers > 1 and len(tasks) > 1:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                           initargs=(options, worker_instrumentation))
+            results = executor.map(_score_task, tasks)
+        else:
+            executor = None
+            _init_worker(options, worker_instrumentation)
+            results = map(_score_task, tasks)
+        try:
+            for task, result, error, seconds, report in results:
+                if report is not None:
+                    instrumentation.merge(report)
+                    if 'profile_file' in report:
+                        profile_files.append(report['profile_file'])
+                name = Path(task[0]).name
+                label = name if task[3] == 1 else f"{name} [part {task[2] + 1}/{task[3]}]"
+                if error is not None:
+                    sample_offsets[task[0]] = None
+                    errors[label] = error
+                    print(f"❌ {label}: {error}")
+                    continue
+                if aggregator is not None:
+                    with instrumentation.stage('aggregation', result.n_rows):
+                        aggregator.merge(result)
+                    n_samples += result.n_rows
+                    print(f"✅ {label}: {result.n_rows} samples in {seconds:.2f} s")
+                    continue
+                n_rows = result['n_rows']
+                samples = result['sample']
+                if task[1] is not None and Path(task[0]).suffix.lower() != CUBE_SUFFIX:
+                    offset = sample_offsets.get(task[0], 0)
+                    if offset is None:
+                        samples = [np.nan] * n_rows
+                    else:
+                        samples = [position + offset for position in samples]
+                        sample_offsets[task[0]] = offset + n_rows
+                meta = {'source_file': [name] * n_rows, 'sample': samples}
+                meta.update((column, result[column]) for column in meta_columns)
+                if n_rows:
+                    with instrumentation.stage('output', n_rows):
+                        writer.write_batch(result['scores'], meta)
+                n_samples += n_rows
+                print(f"✅ {label}: {n_rows} samples in {seconds:.2f} s")
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    if aggregator is not None:
+        n_summary = aggregator.write(args.output, quantiles)
+    elapsed = time.perf_counter() - start
+    print(f"\n{'='*60}")
+    print(f"✅ Scored: {n_samples} samples from {len(files)} files in {elapsed:.2f} s "
+          f"({n_samples / elapsed if elapsed > 0 else 0:,.0f} samples/s)")
+    if errors:
+        print(f"❌ Errors: {len(errors)} tasks")
+    if aggregator is not None:
+        print(f"📊 Summary of {len(aggregator.groups)} groups ({n_summary} rows) saved to: {args.output.absolute()}")
+    else:
+        print(f"📊 Table saved to: {args.output.absolute()}")
+    if instrumented:
+        # Stage times are summed over all worker processes, so they can exceed the elapsed time
+        for stage_name, stage in instrumentation.report()['stages'].items():
+            print(f"⏱️ {stage_name}: {stage['wall_seconds']:.3f} s wall, {stage['cpu_seconds']:.3f} s CPU "
+                  f"({stage['calls']} calls)")
+        failing = {name: index for name, index in instrumentation.indices.items() if index['errors']}
+        for index_name, index in failing.items():
+            print(f"⚠️ {index_name}: {index['errors']} evaluation errors, last: {index['last_error']}")
+    if args.report:
+        instrumentation.write_json(args.report)
+        print(f"📄 Report saved to: {args.report.absolute()}")
+    if args.cprofile:
+        if merge_profiles(profile_files, args.cprofile):
+            print(f"📄 Profile saved to: {args.cprofile.absolute()}")
+        profile_directory.cleanup()
+    print(f"{'='*60}")
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,675 @@
+#!/usr/bin/env python3
+"""
+Local Batching Scoring Service
+
+Small asyncio HTTP service (TCP or Unix socket) that scores posted scans with
+the compiled index catalogue, band plans, DAGs and sensor registry kept
+resident in one ExportScorer (score_exports.py). Concurrent requests are
+queued and micro-batched: after the first queued request the batcher waits at
+most --max-latency-ms, or until --max-batch-size samples are collected, and
+then scores all requests sharing a wavelength grid in one vectorized
+evaluation, handing every request its own rows back.
+
+Endpoints:
+
+- POST /score: a JSON array of ScanCorder export entries or samples (the
+  content of an export file), decoded and calibrated like score_exports.py,
+  or an object {"reflectance": [[...], ...], "wavelengths": [...],
+  "fwhm": [...], "valid_vi": [...]} with already calibrated reflectance;
+  "sensor": "S8330" takes the grid and valid_vi from the sensor registry
+  instead. ?indices=NDVI,ARI limits the returned indices. Non-finite index
+  values are returned as null.
+- GET /metrics: request and sample counters, micro-batch sizes, latency
+  percentiles and throughput
+- GET /health
+
+Request bodies are decoded, and responses merged and encoded, on a small
+thread pool next to the scorer thread, so large bodies do not stall the
+event loop. Networking only uses the standard library. ScoringClient is a matching
+blocking client; --selftest starts the service on a loopback port (or the
+--unix socket) and checks concurrent client requests against direct scoring.
+
+Usage: python scoring_service.py [--host 127.0.0.1] [--port 8765 | --unix /tmp/scoring.sock]
+           [--max-batch-size 4096] [--max-latency-ms 5] [--selftest]
+
+Requirements: pip install numpy
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from index_catalogue import default_artifact_path
+from precision_validation import DEFAULT_OVERRIDES_FILE, load_float64_indices
+from reflectance_list_reader import ReflectanceListReader, reflectance_list_grid
+from scancorder_regular_decode import iter_json_elements
+from score_exports import DEFAULT_XML_FOLDER, ExportScorer
+from sensor_registry import DEFAULT_SENSORS_DIRECTORY
+
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+EXAMPLE_JSON = REPO_DIR / 'example' / 'data' / 'Compolytics_R-Package_VI_Test_File.json'
+EXAMPLE_REFLECTANCE_LIST = REPO_DIR / 'example' / 'data' / 'Reflectance_List_S8330_ColorChecker.csv'
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_MAX_BATCH_SIZE = 4096
+DEFAULT_MAX_LATENCY_MS = 5.0
+MAX_BODY_SIZE = 64 * 2 ** 20
+# Threads decoding request bodies and encoding responses
+CODEC_THREADS = 2
+# Latencies kept for the percentiles of /metrics
+LATENCY_WINDOW = 10000
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    """Error answered with an HTTP status and a JSON {"error": message} body."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _json_values(values: np.ndarray) -> List[Optional[float]]:
+    """Index values as JSON numbers, non-finite ones as null."""
+    values = np.asarray(values, dtype=np.float64)
+    result = values.tolist()
+    for position in np.flatnonzero(~np.isfinite(values)):
+        result[position] = None
+    return result
+
+
+class ScoringRequest:
+    """Reflectance of one request waiting for the next micro-batch."""
+
+    def __init__(self, reflectance: np.ndarray, wavelengths: np.ndarray, fwhm: Optional[np.ndarray],
+                 valid_vi: Optional[Sequence[str]], future: asyncio.Future):
+        self.reflectance = reflectance
+        self.wavelengths = wavelengths
+        self.fwhm = fwhm
+        self.valid_vi = valid_vi
+        self.future = future
+        # Requests with equal keys are scored together
+        self.grid_key = (wavelengths.tobytes(), None if fwhm is None else fwhm.tobytes(),
+                         None if valid_vi is None else tuple(valid_vi))
+
+    def __len__(self) -> int:
+        return self.reflectance.shape[0]
+
+
+class ServiceMetrics:
+    """Counters and latency window behind GET /metrics."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.samples = 0
+        self.batches = 0
+        self.batch_requests = 0
+        self.batch_samples = 0
+        self.max_batch_samples = 0
+        self.scoring_seconds = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def record_request(self, seconds: float, n_samples: int, error: bool = False):
+        self.requests += 1
+        self.errors += int(error)
+        self.samples += n_samples
+        self.latencies.append(seconds)
+
+    def record_batch(self, n_requests: int, n_samples: int, seconds: float):
+        self.batches += 1
+        self.batch_requests += n_requests
+        self.batch_samples += n_samples
+        self.max_batch_samples = max(self.max_batch_samples, n_samples)
+        self.scoring_seconds += seconds
+
+    def snapshot(self) -> Dict:
+        uptime = time.perf_counter() - self.started
+        latency = None
+        if self.latencies:
+            latencies = np.asarray(self.latencies) * 1000
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            latency = {'p50': p50, 'p95': p95, 'p99': p99, 'max': float(latencies.max()),
+                       'mean': float(latencies.mean()), 'window': len(latencies)}
+        return {
+            'uptime_seconds': uptime,
+            'requests': self.requests,
+            'errors': self.errors,
+            'samples': self.samples,
+            'requests_per_second': self.requests / uptime if uptime > 0 else None,
+            'samples_per_second': self.samples / uptime if uptime > 0 else None,
+            'batches': self.batches,
+            'mean_batch_requests': self.batch_requests / self.batches if self.batches else None,
+            'mean_batch_samples': self.batch_samples / self.batches if self.batches else None,
+            'max_batch_samples': self.max_batch_samples,
+            'scoring_seconds': self.scoring_seconds,
+            'latency_ms': latency,
+        }
+
+
+class ScoringService:
+    """Micro-batching asyncio front end of an ExportScorer."""
+
+    def __init__(self, scorer: ExportScorer, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_latency: float = DEFAULT_MAX_LATENCY_MS / 1000):
+        self.scorer = scorer
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.metrics = ServiceMetrics()
+        # One thread keeps the event loop free; the scorer's plan, DAG and calibration caches are not thread-safe
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # JSON decoding and encoding, kept off the event loop and the scorer thread
+        self._codec_executor = ThreadPoolExecutor(max_workers=CODEC_THREADS)
+        self._queue: Optional[asyncio.Queue] = None
+        self._batcher: Optional[asyncio.Task] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        # Open connections and their handler tasks, closed on shutdown
+        self._connections: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    async def start(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, unix_path: Optional[Path] = None):
+        """Start the batcher and listen on host:port (port 0: any free port) or on a Unix socket."""
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch_loop())
+        if unix_path is not None:
+            self._server = await asyncio.start_unix_server(self._handle_connection, path=str(unix_path))
+        else:
+            self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server
+
+    @property
+    def address(self):
+        """Socket address the service listens on ((host, port) or the socket path)."""
+        return self._server.sockets[0].getsockname()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # Idle keep-alive connections end with EOF instead of being cancelled mid-read
+            for writer in self._connections.values():
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+        if self._batcher is not None:
+            self._batcher.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._batcher
+        self._executor.shutdown(wait=True)
+        self._codec_executor.shutdown(wait=True)
+
+    async def score(self, reflectance: np.ndarray, wavelengths: np.ndarray, fwhm: Optional[np.ndarray] = None,
+                    valid_vi: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+        """Queue reflectance for the next micro-batch and wait for its index values."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(ScoringRequest(reflectance, wavelengths, fwhm, valid_vi, future))
+        return await future
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self._queue.get()]
+            n_samples = len(pending[0])
+            deadline = loop.time() + self.max_latency
+            while n_samples < self.max_batch_size:
+                try:
+                    request = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                pending.append(request)
+                n_samples += len(request)
+            groups: Dict[Tuple, List[ScoringRequest]] = {}
+            for request in pending:
+                groups.setdefault(request.grid_key, []).append(request)
+            for requests in groups.values():
+                await self._score_group(requests)
+
+    async def _score_group(self, requests: List[ScoringRequest]):
+        """Score requests sharing a grid in one evaluation and split the rows back."""
+        first = requests[0]
+        reflectance = first.reflectance if len(requests) == 1 else \
+            np.concatenate([request.reflectance for request in requests])
+        start = time.perf_counter()
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self.scorer.score_reflectance, reflectance, first.wavelengths, first.fwhm,
+                first.valid_vi)
+        except Exception as e:
+            for request in requests:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+        self.metrics.record_batch(len(requests), reflectance.shape[0], time.perf_counter() - start)
+        offset = 0
+        for request in requests:
+            n_rows = len(request)
+            # Skip requests whose client has gone away
+            if not request.future.done():
+                request.future.set_result({name: values[offset:offset + n_rows] for name, values in results.items()})
+            offset += n_rows
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve HTTP/1.1 requests of one (keep-alive) connection."""
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HTTPError as e:
+                    self._write_response(writer, e.status, self._encode({'error': str(e)}), keep_alive=False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, target, keep_alive, body = request
+                status, payload = await self._dispatch(method, target, body)
+                body = await asyncio.get_running_loop().run_in_executor(self._codec_executor, self._encode, payload)
+                self._write_response(writer, status, body, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            del self._connections[task]
+            writer.close()
+            with suppress(ConnectionError):
+                await writer.wait_closed()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, bool, bytes]]:
+        """(method, target, keep-alive, body) of the next request, None when the client closed the connection."""
+        request_line = await ScoringService._readline(reader)
+        if not request_line.strip():
+            return None
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise HTTPError(400, "Malformed request line")
+        method, target, version = parts
+        headers = {}
+        while True:
+            line = await ScoringService._readline(reader)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = headers.get('content-length') or '0'
+        if not (length.isascii() and length.isdigit()):
+            raise HTTPError(400, f"Invalid Content-Length: {length}")
+        length = int(length)
+        if length > MAX_BODY_SIZE:
+            raise HTTPError(413, f"Request body larger than {MAX_BODY_SIZE} bytes")
+        body = await reader.readexactly(length) if length else b''
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+        return method, target, keep_alive, body
+
+    @staticmethod
+    async def _readline(reader: asyncio.StreamReader) -> bytes:
+        try:
+            return await reader.readline()
+        except ValueError:
+            # Longer than the stream limit
+            raise HTTPError(400, "Request line or header too long")
+
+    @staticmethod
+    def _decode(body: bytes):
+        """Parsed request body. A top-level array is decoded one element at a time, so the event loop
+        gets the GIL back between elements instead of waiting for a single json.loads() of the whole body."""
+        text = body.decode('utf-8').strip(' \t\r\n')
+        if text.startswith('[') and text.endswith(']'):
+            return list(iter_json_elements(text[1:-1]))
+        return json.loads(text)
+
+    @staticmethod
+    def _encode(payload: Dict) -> bytes:
+        return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: int, body: bytes, keep_alive: bool):
+        head = (f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+
+    async def _dispatch(self, method: str, target: str, body: bytes) -> Tuple[int, Dict]:
+        path, _, query = target.partition('?')
+        try:
+            if path == '/score':
+                if method != 'POST':
+                    raise HTTPError(405, "Use POST for /score")
+                return 200, await self._score_request(body, urllib.parse.parse_qs(query))
+            if method != 'GET':
+                raise HTTPError(405, f"Use GET for {path}")
+            if path == '/metrics':
+                metrics = self.metrics.snapshot()
+                metrics['queue_depth'] = self._queue.qsize()
+                metrics['calibration_cache'] = dict(self.scorer.calibration_cache.stats)
+                return 200, metrics
+            if path == '/health':
+                return 200, {'status': 'ok', 'indices': len(self.scorer.index_names)}
+            raise HTTPError(404, f"Unknown path: {path}")
+        except HTTPError as e:
+            return e.status, {'error': str(e)}
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {'error': f"{type(e).__name__}: {e}"}
+        except Exception as e:
+            return 500, {'error': f"{type(e).__name__}: {e}"}
+
+    async def _score_request(self, body: bytes, params: Dict[str, List[str]]) -> Dict:
+        start = time.perf_counter()
+        n_samples = 0
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                payload = await loop.run_in_executor(self._codec_executor, self._decode, body)
+            except ValueError:
+                raise HTTPError(400, "Request body is not valid JSON")
+            response = {}
+            if isinstance(payload, dict) and 'reflectance' in payload:
+                # On the scorer thread, which owns the sensor registry
+                reflectance, wavelengths, fwhm, valid_vi = await loop.run_in_executor(
+                    self._executor, self._reflectance_payload, payload)
+                parts = [(len(reflectance), await self.score(reflectance, wavelengths, fwhm, valid_vi))]
+            else:
+                entries = payload if isinstance(payload, list) else [payload]
+                # Decoding and calibration run on the scorer thread as well
+                prepared = await loop.run_in_executor(self._executor, self._prepare_scans, entries)
+                scores = await asyncio.gather(*(self.score(*batch[:4]) for batch in prepared))
+                parts = [(len(batch[0]), result) for batch, result in zip(prepared, scores)]
+                for column in ('uuid', 'filename'):
+                    values = [value for batch in prepared for value in batch[4].get(column, [None] * len(batch[0]))]
+                    if any(value is not None for value in values):
+                        response[column] = values
+            n_samples = sum(n_rows for n_rows, _ in parts)
+            response['n_samples'] = n_samples
+            response['indices'] = await loop.run_in_executor(self._codec_executor, self._merge_parts, parts, params)
+        except Exception:
+            self.metrics.record_request(time.perf_counter() - start, n_samples, error=True)
+            raise
+        self.metrics.record_request(time.perf_counter() - start, n_samples)
+        return response
+
+    def _reflectance_payload(self, payload: Dict) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray], Optional[List]]:
+        reflectance = np.asarray(payload['reflectance'], dtype=np.float64)
+        if reflectance.ndim == 1:
+            reflectance = reflectance[None, :]
+        if reflectance.ndim != 2:
+            raise HTTPError(400, "reflectance must be a list of spectra")
+        valid_vi = payload.get('valid_vi')
+        if payload.get('sensor') is not None:
+            sensor_info = self.scorer.registry.find_sensor_metadata(str(payload['sensor']))
+            if sensor_info is None:
+                raise HTTPError(400, f"Unknown sensor: {payload['sensor']}")
+            wavelengths, fwhm = reflectance_list_grid(sensor_info, np.asarray(payload.get('wavelengths') or [],
+                                                                              dtype=np.float64))
+            if valid_vi is None:
+                valid_vi = sensor_info.get('valid_vi')
+        else:
+            if payload.get('wavelengths') is None:
+                raise HTTPError(400, "Either wavelengths or sensor is required")
+            wavelengths = np.asarray(payload['wavelengths'], dtype=np.float64)
+            fwhm = None if payload.get('fwhm') is None else np.asarray(payload['fwhm'], dtype=np.float64)
+        if len(wavelengths) != reflectance.shape[1] or (fwhm is not None and len(fwhm) != len(wavelengths)):
+            raise HTTPError(400, f"{reflectance.shape[1]} reflectance values per spectrum, but "
+                                 f"{len(wavelengths)} wavelengths")
+        return reflectance, wavelengths, fwhm, valid_vi
+
+    def _prepare_scans(self, entries: List) -> List[Tuple]:
+        """(features, wavelengths, fwhm, valid_vi, meta) of every batch of posted export entries."""
+        scorer = self.scorer
+        prepared = []
+        for batch in scorer.decoder.batches_from_samples(scorer.decoder.flatten_samples(entries)):
+            features, feature_plan, external = scorer.reflectance(batch)
+            prepared.append((features, feature_plan.wavelengths, feature_plan.fwhm,
+                             scorer.valid_vi(batch, external), batch.meta))
+        return prepared
+
+    def _merge_parts(self, parts: List[Tuple[int, Dict[str, np.ndarray]]],
+                     params: Dict[str, List[str]]) -> Dict[str, List[Optional[float]]]:
+        """Concatenate the index values of a request's batches; indices missing from a batch are null."""
+        if 'indices' in params:
+            names = [name.strip() for value in params['indices'] for name in value.split(',') if name.strip()]
+        else:
+            computed = set().union(*(results.keys() for _, results in parts)) if parts else set()
+            names = [name for name in self.scorer.index_names if name in computed]
+        merged = {}
+        for name in names:
+            merged[name] = [value for n_rows, results in parts
+                            for value in (_json_values(results[name]) if name in results else [None] * n_rows)]
+        return merged
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection over a Unix domain socket."""
+
+    def __init__(self, unix_path: Path, timeout: float):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = str(unix_path)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class ScoringClient:
+    """Blocking client of the scoring service, reusing one keep-alive connection."""
+
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, unix_path: Optional[Path] = None,
+                 timeout: float = 30.0):
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.timeout = timeout
+        self._connection = None
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self._connection is None:
+            if self.unix_path is not None:
+                self._connection = _UnixHTTPConnection(self.unix_path, self.timeout)
+            else:
+                self._connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return self._connection
+
+    def request(self, method: str, path: str, payload=None) -> Dict:
+        body = None if payload is None else json.dumps(payload).encode('utf-8')
+        connection = self._connect()
+        try:
+            connection.request(method, path, body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            data = json.loads(response.read())
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status}: {data.get('error')}")
+        return data
+
+    @staticmethod
+    def _score_path(indices: Optional[Sequence[str]]) -> str:
+        return '/score' if not indices else '/score?' + urllib.parse.urlencode({'indices': ','.join(indices)})
+
+    def score_scans(self, entries: List, indices: Optional[Sequence[str]] = None) -> Dict:
+        """Score ScanCorder export entries (as loaded from an export JSON)."""
+        return self.request('POST', self._score_path(indices), entries)
+
+    def score_reflectance(self, reflectance, wavelengths=None, fwhm=None, sensor: Optional[str] = None,
+                          valid_vi: Optional[Sequence[str]] = None, indices: Optional[Sequence[str]] = None) -> Dict:
+        """Score calibrated reflectance on a wavelength grid or on the grid of a sensor."""
+        payload = {'reflectance': np.asarray(reflectance, dtype=np.float64).tolist()}
+        for key, value in (('wavelengths', wavelengths), ('fwhm', fwhm), ('sensor', sensor), ('valid_vi', valid_vi)):
+            if value is not None:
+                payload[key] = np.asarray(value).tolist() if key in ('wavelengths', 'fwhm') else value
+        return self.request('POST', self._score_path(indices), payload)
+
+    def metrics(self) -> Dict:
+        return self.request('GET', '/metrics')
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def _matches(values: List[Optional[float]], expected: np.ndarray) -> bool:
+    received = np.asarray([np.nan if value is None else value for value in values], dtype=np.float64)
+    expected = np.where(np.isfinite(expected), expected, np.nan)
+    return np.array_equal(received, expected, equal_nan=True)
+
+
+async def selftest(scorer: ExportScorer, max_batch_size: int, max_latency: float, rounds: int = 4,
+                   concurrency: int = 16, unix_path: Optional[Path] = None) -> bool:
+    """Start the service, score the example data through concurrent loopback clients and compare."""
+    with open(EXAMPLE_JSON, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    # Direct scoring of every entry, before the service shares the scorer
+    expected = []
+    for entry in entries:
+        batches = list(scorer.decoder.batches_from_samples(scorer.decoder.flatten_samples([entry])))
+        expected.append([scorer.score_batch(batch) for batch in batches])
+    reader = ReflectanceListReader(EXAMPLE_REFLECTANCE_LIST)
+    spectra = reader.read().values
+    sensor_info = scorer.registry.find_sensor_metadata('8330')
+    wavelengths, fwhm = reflectance_list_grid(sensor_info, reader.wavelengths)
+    expected_list = scorer.score_reflectance(spectra, wavelengths, fwhm, (sensor_info or {}).get('valid_vi'))
+
+    service = ScoringService(scorer, max_batch_size, max_latency)
+    await service.start(DEFAULT_HOST, 0, unix_path)
+    host, port = (DEFAULT_HOST, 0) if unix_path is not None else service.address[:2]
+    print(f"✅ Service listening on {unix_path or f'{host}:{port}'}")
+    loop = asyncio.get_running_loop()
+    clients = {}
+
+    def client() -> ScoringClient:
+        # One keep-alive connection per client thread
+        thread = threading.get_ident()
+        if thread not in clients:
+            clients[thread] = ScoringClient(host, port, unix_path)
+        return clients[thread]
+
+    def post_entry(position: int) -> bool:
+        response = client().score_scans([entries[position]])
+        parts = expected[position]
+        offset = 0
+        for part in parts:
+            n_rows = len(next(iter(part.values())))
+            for name, values in part.items():
+                if not _matches(response['indices'][name][offset:offset + n_rows], values):
+                    return False
+            offset += n_rows
+        return offset == response['n_samples']
+
+    def post_spectrum(row: int) -> bool:
+        response = client().score_reflectance(spectra[row:row + 1], sensor='8330')
+        return all(_matches(response['indices'][name], values[row:row + 1]) for name, values in expected_list.items())
+
+    failures = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        jobs = [loop.run_in_executor(pool, post_entry, position)
+                for _ in range(rounds) for position in range(len(entries))]
+        jobs += [loop.run_in_executor(pool, post_spectrum, row) for _ in range(rounds) for row in range(len(spectra))]
+        for ok in await asyncio.gather(*jobs):
+            failures += int(not ok)
+        elapsed = time.perf_counter() - start
+        metrics = await loop.run_in_executor(pool, lambda: client().metrics())
+    for scoring_client in clients.values():
+        scoring_client.close()
+    await service.close()
+
+    latency = metrics['latency_ms']
+    print(f"📊 {metrics['requests']} requests, {metrics['samples']} samples in {elapsed:.2f} s "
+          f"({metrics['requests'] / elapsed:,.0f} requests/s)")
+    print(f"📦 {metrics['batches']} micro-batches, {metrics['mean_batch_requests']:.1f} requests and "
+          f"{metrics['mean_batch_samples']:.1f} samples on average (max {metrics['max_batch_samples']})")
+    print(f"⏱️ Latency p50 {latency['p50']:.2f} ms, p95 {latency['p95']:.2f} ms, p99 {latency['p99']:.2f} ms")
+    if failures:
+        print(f"❌ {failures} of {len(jobs)} responses differ from direct scoring")
+    else:
+        print(f"✅ All {len(jobs)} responses match direct scoring")
+    return failures == 0
+
+
+async def serve(service: ScoringService, host: str, port: int, unix_path: Optional[Path]):
+    await service.start(host, port, unix_path)
+    print(f"✅ Listening on {unix_path or f'http://{host}:{port}'} "
+          f"(max batch {service.max_batch_size} samples, max latency {service.max_latency * 1000:g} ms)")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await service.close()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Micro-batching HTTP service scoring spectral indices.")
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f"Address to listen on (default: {DEFAULT_HOST})")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"TCP port (default: {DEFAULT_PORT})")
+    parser.add_argument('--unix', type=Path, help="Listen on this Unix socket instead of TCP")
+    parser.add_argument('--xml-folder', type=Path, default=DEFAULT_XML_FOLDER, help="Folder with index XML files")
+    parser.add_argument('--catalogue', type=Path,
+                        help="Compiled index catalogue, rebuilt when missing or stale (default: in the user cache directory)")
+    parser.add_argument('--sensors', type=Path, default=DEFAULT_SENSORS_DIRECTORY, help="Folder with sensor JSON files")
+    parser.add_argument('--no-average', action='store_true', help="Do not average sensor values per LED")
+    parser.add_argument('--no-multipoint', action='store_true', help="Skip the multi_calibration factors")
+    parser.add_argument('--float32', action='store_true', help="Evaluate in single precision (see score_exports.py)")
+    parser.add_argument('--calibration-cache', type=Path, help="Directory persisting fitted calibration coefficients")
+    parser.add_argument('--max-batch-size', type=int, default=DEFAULT_MAX_BATCH_SIZE,
+                        help=f"Samples that close a micro-batch (default: {DEFAULT_MAX_BATCH_SIZE})")
+    parser.add_argument('--max-latency-ms', type=float, default=DEFAULT_MAX_LATENCY_MS,
+                        help=f"Longest wait for more requests after the first one (default: {DEFAULT_MAX_LATENCY_MS:g})")
+    parser.add_argument('--selftest', action='store_true',
+                        help="Score the example data through concurrent loopback clients and exit")
+    parser.add_argument('--concurrency', type=int, default=16, help="Client threads of --selftest (default: 16)")
+    args = parser.parse_args()
+    if args.catalogue is None:
+        args.catalogue = default_artifact_path(args.xml_folder)
+    return args
+
+
+def main():
+    """Run the scoring service (or its loopback self test)."""
+    args = parse_arguments()
+    scorer = ExportScorer(args.catalogue, args.xml_folder, args.sensors,
+                          args.catalogue.with_name('sensor_registry_index.json'),
+                          average_sensor_values=not args.no_average, multipoint=not args.no_multipoint,
+                          precision='float32' if args.float32 else 'float64',
+                          float64_indices=load_float64_indices(DEFAULT_OVERRIDES_FILE) if args.float32 else None,
+                          calibration_cache_dir=args.calibration_cache)
+    print(f"📄 {len(scorer.index_names)} indices loaded from {args.catalogue}")
+    if args.selftest:
+        ok = asyncio.run(selftest(scorer, args.max_batch_size, args.max_latency_ms / 1000,
+                                  concurrency=args.concurrency, unix_path=args.unix))
+        sys.exit(0 if ok else 1)
+    service = ScoringService(scorer, args.max_batch_size, args.max_latency_ms / 1000)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        print("\n✅ Service stopped")
+
+
+if __name__ == "__main__":
+    main()
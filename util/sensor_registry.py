@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Indexed Sensor Metadata Registry
+
+The R find_sensor_metadata() parses every sensor JSON file until one
+sensor_serial contains the requested 4-digit code, for every lookup. This
+module builds the serial -> file index once, persists it as a small JSON file
+and reuses it as long as the sensor directory is unchanged (names, sizes and
+modification times of its JSON files). Lookups are dictionary hits; parsed
+records are cached with their numeric fields converted to NumPy arrays.
+Every lookup re-checks that signature (one directory scan), so sensor files
+edited in place are picked up by long-running processes.
+
+Matching follows the R function: the first 4-digit code of the query is
+compared with all 4-digit codes of each sensor_serial (numeric serials are
+zero padded), and the first file in sorted order wins.
+
+Usage: python sensor_registry.py <serial> [sensors_directory]
+
+Requirements: pip install numpy
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+DEFAULT_SENSORS_DIRECTORY = Path(__file__).resolve().parent.parent / 'inst' / 'extdata' / 'sensors'
+DEFAULT_INDEX_NAME = "sensor_registry_index.json"
+INDEX_VERSION = 1
+SERIAL_CODE_PATTERN = re.compile(r'\d{4}')
+
+
+def serial_codes(sensor_serial: Any) -> List[str]:
+    """All 4-digit codes of a sensor_serial value, as matched by the R function."""
+    if isinstance(sensor_serial, bool):
+        text = str(sensor_serial).upper()
+    elif isinstance(sensor_serial, (int, float)):
+        text = f"{int(sensor_serial):04d}"
+    elif isinstance(sensor_serial, list):
+        text = ' '.join(str(value) for value in sensor_serial)
+    else:
+        text = str(sensor_serial)
+    return SERIAL_CODE_PATTERN.findall(text)
+
+
+def query_code(serial_name: Any) -> str:
+    """The first 4-digit code of a lookup query (e.g. a sensor head name)."""
+    codes = SERIAL_CODE_PATTERN.findall(str(serial_name))
+    if not codes:
+        raise ValueError(f"No 4-digit code found in serial_name: '{serial_name}'. Please include a 4-digit number.")
+    return codes[0]
+
+
+def directory_signature(directory: Path) -> str:
+    """Hash over the names, sizes and modification times of the JSON files of a directory."""
+    digest = hashlib.sha256()
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        if entry.name.endswith('.json') and entry.is_file():
+            stat = entry.stat()
+            digest.update(f"{entry.name}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _float_array(value: Any) -> Optional[np.ndarray]:
+    """Convert a JSON number (array) to float64, null becomes NaN."""
+    if value is None:
+        return None
+    return np.asarray(value, dtype=np.float64)
+
+
+class SensorRecord:
+    """Sensor metadata with typed, array-backed fields."""
+
+    def __init__(self, path: Path, info: Dict):
+        self.path = Path(path)
+        # The parsed JSON, e.g. for BandPlanner.plan_for_sensor()
+        self.info = info
+        self.sensor_serial = info.get('sensor_serial')
+        self.channel_wl_real = _float_array(info.get('channel_wl_real'))
+        self.channel_fwhm_real = _float_array(info.get('channel_fwhm_real'))
+        self.led_wl_real = _float_array(info.get('led_wl_real'))
+        self.led_fwhm_real = _float_array(info.get('led_fwhm_real'))
+        # (depth, n_features, 3) quadratic factors, see CalibrationReflectanceMultipoint
+        self.multi_calibration = _float_array(info.get('multi_calibration'))
+        self.channel_mask = None
+        if info.get('channel_mask') is not None:
+            self.channel_mask = np.asarray(info['channel_mask'], dtype=np.int64)
+        valid_vi = info.get('valid_vi')
+        self.valid_vi = None if valid_vi is None else [str(name) for name in
+                                                       (valid_vi if isinstance(valid_vi, list) else [valid_vi])]
+
+    def __repr__(self) -> str:
+        return f"SensorRecord({self.path.name}, sensor_serial={self.sensor_serial!r})"
+
+
+class SensorRegistry:
+    """Serial code -> sensor metadata index over a directory of sensor JSON files."""
+
+    def __init__(self, directory: Optional[Path] = None, index_path: Optional[Path] = None):
+        self.directory = Path(DEFAULT_SENSORS_DIRECTORY if directory is None else directory)
+        if not self.directory.is_dir():
+            raise ValueError(f"Cannot find sensors directory: {self.directory}")
+        self.index_path = None if index_path is None else Path(index_path)
+        self.codes: Dict[str, str] = {}
+        self.files: List[str] = []
+        self._records: Dict[str, SensorRecord] = {}
+        self._signature = None
+        self.refresh()
+
+    def refresh(self, force: bool = False):
+        """Load the persisted index if it matches the directory, otherwise rebuild it."""
+        signature = self._signature = directory_signature(self.directory)
+        if not force and self._load_index(signature):
+            return
+        self._build_index()
+        self._save_index(signature)
+
+    def _load_index(self, signature: str) -> bool:
+        if self.index_path is None:
+            return False
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if (data.get('version') != INDEX_VERSION or data.get('signature') != signature
+                or data.get('directory') != str(self.directory.resolve())):
+            return False
+        self.codes = data['codes']
+        self.files = data['files']
+        self._records = {}
+        return True
+
+    def _save_index(self, signature: str):
+        if self.index_path is None:
+            return
+        # A unique temp file per writer: concurrent processes share the index next to the catalogue
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=self.index_path.name + '.',
+                                            dir=self.index_path.parent)
+        try:
+            with os.fdopen(handle, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'version': INDEX_VERSION,
+                    'directory': str(self.directory.resolve()),
+                    'signature': signature,
+                    'files': self.files,
+                    'codes': self.codes,
+                }, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _build_index(self):
+        self.codes = {}
+        self.files = sorted(path.name for path in self.directory.glob('*.json'))
+        if not self.files:
+            raise ValueError(f"No JSON files found in directory: {self.directory}")
+        self._records = {}
+        for file_name in self.files:
+            try:
+                with open(self.directory / file_name, 'r', encoding='utf-8') as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not isinstance(info, dict) or info.get('sensor_serial') is None:
+                continue
+            for code in serial_codes(info['sensor_serial']):
+                # The first file in sorted order wins, as in the R scan
+                self.codes.setdefault(code, file_name)
+            self._records[file_name] = SensorRecord(self.directory / file_name, info)
+
+    def _check_directory(self):
+        # The directory mtime misses files edited in place, so compare the per-file sizes and mtimes
+        if directory_signature(self.directory) != self._signature:
+            self.refresh()
+
+    def record_for_file(self, file_name: str) -> SensorRecord:
+        record = self._records.get(file_name)
+        if record is None:
+            path = self.directory / file_name
+            with open(path, 'r', encoding='utf-8') as f:
+                record = self._records[file_name] = SensorRecord(path, json.load(f))
+        return record
+
+    def lookup(self, serial_name: Any) -> Optional[SensorRecord]:
+        """Return the SensorRecord whose sensor_serial contains the 4-digit code of `serial_name`, or None."""
+        code = query_code(serial_name)
+        self._check_directory()
+        file_name = self.codes.get(code)
+        if file_name is None:
+            return None
+        return self.record_for_file(file_name)
+
+    def find_sensor_metadata(self, serial_name: Any) -> Optional[Dict]:
+        """Parsed JSON of the matching sensor, like the R find_sensor_metadata()."""
+        record = self.lookup(serial_name)
+        return None if record is None else record.info
+
+    def serials(self) -> List[Tuple[str, str]]:
+        """(code, file name) pairs of the index."""
+        return sorted(self.codes.items())
+
+
+_registries: Dict[Tuple[str, str], SensorRegistry] = {}
+
+
+def get_registry(directory: Optional[Path] = None, index_path: Optional[Path] = None) -> SensorRegistry:
+    """Return a process-wide cached registry for a sensors directory."""
+    directory = Path(DEFAULT_SENSORS_DIRECTORY if directory is None else directory)
+    key = (str(directory), str(index_path))
+    registry = _registries.get(key)
+    if registry is None:
+        registry = _registries[key] = SensorRegistry(directory, index_path)
+    return registry
+
+
+def find_sensor_metadata(serial_name: Any, directory: Optional[Path] = None) -> Optional[Dict]:
+    """Drop-in counterpart of the R find_sensor_metadata() backed by the cached registry."""
+    return get_registry(directory).find_sensor_metadata(serial_name)
+
+
+def main():
+    """Look up a sensor by serial and print its main fields."""
+    if len(sys.argv) < 2:
+        print("Usage: python sensor_registry.py <serial> [sensors_directory]")
+        print("\nExample: python sensor_registry.py B7696_S3956 ../inst/extdata/sensors/")
+        print("\nRequirements:")
+        print("  pip install numpy")
+        sys.exit(1)
+    directory = Path(sys.argv[2]) if len(sys.argv) >= 3 else None
+    try:
+        registry = get_registry(directory, Path(DEFAULT_INDEX_NAME))
+        record = registry.lookup(sys.argv[1])
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    if record is None:
+        print(f"❌ No sensor found for '{sys.argv[1]}' in {registry.directory}")
+        sys.exit(1)
+    print(f"✅ {record.path.name} (sensor_serial {record.sensor_serial})")
+    for field in ('channel_wl_real', 'channel_fwhm_real', 'led_wl_real', 'led_fwhm_real',
+                  'multi_calibration', 'channel_mask'):
+        value = getattr(record, field)
+        print(f"  {field}: {'-' if value is None else value.shape}")
+    print(f"  valid_vi: {'-' if record.valid_vi is None else len(record.valid_vi)} indices")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Streaming Table Writers for Index and Reflectance Tables
+
+Writers that append result batches (e.g. from SpectralIndexEngine.score())
+to an output file one batch at a time, so that tables with hundreds of index
+columns and millions of rows are never held in memory as a whole:
+
+- CsvTableWriter: delimited text in the format of write_indices_csv() /
+  write_reflectance_csv() (";" separator, quoted header and strings, NA for
+  missing values) with a fixed float format
+- ArrowTableWriter: Parquet (one row group per batch) or Arrow IPC files;
+  IPC files can be memory-mapped, and both are read back one batch at a
+  time by iter_arrow_batches()
+
+The schema is fixed when the writer is created. Unlike
+calculate_indices_table(), columns that are NA for every row are kept, as
+that is only known once the whole table has been written.
+
+Requirements: pip install numpy (Parquet/Arrow output additionally needs pyarrow)
+"""
+
+from pathlib import Path
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+
+DEFAULT_FLOAT_FORMAT = '%.15g'
+ARROW_FORMATS = {'.parquet': 'parquet', '.arrow': 'ipc', '.ipc': 'ipc', '.feather': 'ipc'}
+CSV_SUFFIXES = {'.csv', '.txt'}
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Parquet/Arrow output requires pyarrow: pip install pyarrow") from None
+    return pyarrow
+
+
+class TableWriter:
+    """Base class: fixed schema of metadata columns followed by float value columns."""
+
+    def __init__(self, output_file: Path, value_columns: Sequence[str],
+                 meta_columns: Union[Sequence[str], Mapping[str, str], None] = None):
+        self.output_file = Path(output_file)
+        self.value_columns = list(value_columns)
+        # Metadata column name -> 'string' or 'float64'
+        if meta_columns is None:
+            meta_columns = {}
+        elif not isinstance(meta_columns, Mapping):
+            meta_columns = {name: 'string' for name in meta_columns}
+        self.meta_columns = dict(meta_columns)
+        self.rows_written = 0
+
+    def _value_matrix(self, values: Union[np.ndarray, Mapping[str, np.ndarray]], n_rows: Optional[int]) -> np.ndarray:
+        """Bring a batch into (n_rows, n_value_columns) layout; columns absent from a dict are NaN."""
+        if isinstance(values, Mapping):
+            if n_rows is None:
+                n_rows = len(next(iter(values.values()))) if values else 0
+            matrix = np.full((n_rows, len(self.value_columns)), np.nan)
+            for j, name in enumerate(self.value_columns):
+                column = values.get(name)
+                if column is not None:
+                    matrix[:, j] = column
+            return matrix
+        matrix = np.asarray(values, dtype=np.float64)
+        if matrix.ndim != 2 or matrix.shape[1] != len(self.value_columns):
+            raise ValueError(f"Expected a batch with {len(self.value_columns)} value columns, got shape {matrix.shape}")
+        return matrix
+
+    def write_batch(self, values: Union[np.ndarray, Mapping[str, np.ndarray]],
+                    meta: Optional[Mapping[str, Sequence]] = None):
+        """Append a batch given as matrix or {column: array}, plus optional {meta column: values}."""
+        meta = meta or {}
+        n_rows = None
+        if meta:
+            n_rows = len(next(iter(meta.values())))
+        matrix = self._value_matrix(values, n_rows)
+        n_rows = matrix.shape[0]
+        meta_values = {}
+        for name in self.meta_columns:
+            column = meta.get(name)
+            meta_values[name] = [None] * n_rows if column is None else list(column)
+            if len(meta_values[name]) != n_rows:
+                raise ValueError(f"Metadata column '{name}' has {len(meta_values[name])} values, expected {n_rows}")
+        if n_rows:
+            self._write(matrix, meta_values)
+            self.rows_written += n_rows
+
+    def _write(self, matrix: np.ndarray, meta: Dict[str, List]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> 'TableWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CsvTableWriter(TableWriter):
+    """Chunked delimited text writer compatible with read_indices_csv()."""
+
+    def __init__(self, output_file: Path, value_columns: Sequence[str],
+                 meta_columns: Union[Sequence[str], Mapping[str, str], None] = None,
+                 float_format: str = DEFAULT_FLOAT_FORMAT, sep: str = ';', na_rep: str = 'NA'):
+        super().__init__(output_file, value_columns, meta_columns)
+        self.float_format = float_format
+        self.sep = sep
+        self.na_rep = na_rep
+        self._file = open(self.output_file, 'w', encoding='utf-8', newline='')
+        header = [self._quote(name) for name in list(self.meta_columns) + self.value_columns]
+        self._file.write(self.sep.join(header) + '\n')
+
+    def _quote(self, value: str) -> str:
+        # write.table() default: quoted, embedded quotes escaped with a backslash
+        return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    def _format_meta(self, name: str, column: List) -> List[str]:
+        if self.meta_columns[name] == 'float64':
+            return self._format_floats(np.asarray([np.nan if v is None else v for v in column], dtype=np.float64))
+        return [self.na_rep if v is None else self._quote(v) for v in column]
+
+    def _format_floats(self, column: np.ndarray) -> List[str]:
+        text = np.char.mod(self.float_format, column).astype(object)
+        text[np.isnan(column)] = self.na_rep
+        text[np.isposinf(column)] = 'Inf'
+        text[np.isneginf(column)] = '-Inf'
+        return text.tolist()
+
+    def _write(self, matrix: np.ndarray, meta: Dict[str, List]):
+        columns = [self._format_meta(name, column) for name, column in meta.items()]
+        columns.extend(self._format_floats(matrix[:, j]) for j in range(matrix.shape[1]))
+        self._file.write(''.join(self.sep.join(row) + '\n' for row in zip(*columns)))
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class ArrowTableWriter(TableWriter):
+    """Parquet or Arrow IPC writer; every batch becomes one record batch / row group."""
+
+    def __init__(self, output_file: Path, value_columns: Sequence[str],
+                 meta_columns: Union[Sequence[str], Mapping[str, str], None] = None,
+                 file_format: Optional[str] = None, compression: Optional[str] = None):
+        super().__init__(output_file, value_columns, meta_columns)
+        self._pa = _import_pyarrow()
+        pa = self._pa
+        self.file_format = file_format or ARROW_FORMATS.get(self.output_file.suffix.lower(), 'parquet')
+        if self.file_format not in ('parquet', 'ipc'):
+            raise ValueError(f"Unknown Arrow file format '{self.file_format}'")
+        fields = [pa.field(name, pa.float64() if kind == 'float64' else pa.string())
+                  for name, kind in self.meta_columns.items()]
+        fields.extend(pa.field(name, pa.float64()) for name in self.value_columns)
+        self.schema = pa.schema(fields)
+        if self.file_format == 'parquet':
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(str(self.output_file), self.schema, compression=compression or 'snappy')
+        else:
+            import pyarrow.ipc
+            options = pa.ipc.IpcWriteOptions(compression=compression)
+            self._writer = pa.ipc.new_file(str(self.output_file), self.schema, options=options)
+
+    def _write(self, matrix: np.ndarray, meta: Dict[str, List]):
+        pa = self._pa
+        arrays = []
+        for name, column in meta.items():
+            if self.meta_columns[name] == 'float64':
+                arrays.append(pa.array(column, type=pa.float64(), from_pandas=True))
+            else:
+                arrays.append(pa.array([None if v is None else str(v) for v in column], type=pa.string()))
+        # NaN is stored as null, the Arrow counterpart of R's NA
+        arrays.extend(pa.array(matrix[:, j], mask=np.isnan(matrix[:, j])) for j in range(matrix.shape[1]))
+        batch = pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if self.file_format == 'parquet':
+            self._writer.write_batch(batch)
+        else:
+            self._writer.write(batch)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def open_table_writer(output_file: Path, value_columns: Sequence[str],
+                      meta_columns: Union[Sequence[str], Mapping[str, str], None] = None, **options) -> TableWriter:
+    """Create the writer matching the file extension (.csv/.txt, .parquet, .arrow/.ipc/.feather)."""
+    suffix = Path(output_file).suffix.lower()
+    if suffix in CSV_SUFFIXES:
+        return CsvTableWriter(output_file, value_columns, meta_columns, **options)
+    if suffix in ARROW_FORMATS:
+        return ArrowTableWriter(output_file, value_columns, meta_columns, **options)
+    raise ValueError(f"Unsupported output format '{suffix}'")
+
+
+def open_arrow_table(input_file: Path):
+    """Open an Arrow IPC file memory-mapped (zero copy) or read a whole Parquet file into memory as a pyarrow Table.
+
+    Parquet columns are decoded, so the table takes memory in proportion to the file; iter_arrow_batches()
+    reads large tables in bounded memory.
+    """
+    pa = _import_pyarrow()
+    input_file = Path(input_file)
+    if ARROW_FORMATS.get(input_file.suffix.lower()) == 'ipc':
+        import pyarrow.ipc
+        return pa.ipc.open_file(pa.memory_map(str(input_file), 'r')).read_all()
+    import pyarrow.parquet as pq
+    return pq.read_table(str(input_file), memory_map=True)
+
+
+def iter_arrow_batches(input_file: Path, batch_size: int) -> Tuple[List[str], Iterator]:
+    """(column names, pyarrow RecordBatches of at most batch_size rows) of an Arrow IPC or Parquet file.
+
+    IPC batches are zero-copy slices of the memory-mapped file; Parquet is decoded one batch at a time.
+    """
+    pa = _import_pyarrow()
+    input_file = Path(input_file)
+    if ARROW_FORMATS.get(input_file.suffix.lower()) == 'ipc':
+        import pyarrow.ipc
+        reader = pa.ipc.open_file(pa.memory_map(str(input_file), 'r'))
+        batches = (batch.slice(offset, batch_size)
+                   for batch in map(reader.get_batch, range(reader.num_record_batches))
+                   for offset in range(0, batch.num_rows, batch_size))
+        return reader.schema.names, batches
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(str(input_file), memory_map=True)
+    return parquet_file.schema_arrow.names, parquet_file.iter_batches(batch_size=batch_size)